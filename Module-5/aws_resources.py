@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+# Shared AWS resources for the Doc Support skill.
+# Objects created here live at module level, so they are built once per Lambda container
+# and reused by every handler on warm invocations instead of being rebuilt on each turn.
+import logging
+import threading
+import time
+
+from ask_sdk_model.services import ApiClient
+
+from metrics import InstrumentedClient, timed
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def boto3_session():
+    # type: () -> boto3.session.Session
+    """Return the container's boto3 session, importing boto3 the first time a client is needed.
+
+    Importing boto3 is the slowest part of loading the skill, and turns such as LaunchRequest and
+    Cancel/Stop never call AWS. Every client is built from this one session, so the endpoint data
+    and service models botocore loads are shared by the STS, Kendra and SNS clients.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            with timed("boto3_import"):
+                import boto3
+                _session = boto3.session.Session()
+        return _session
+
+
+class CredentialProvider(object):
+    """Assumes the AWS resource role once and caches the credentials until shortly before they expire.
+
+    Credentials are refreshed ahead of time once they enter the ``refresh_margin`` window. While a
+    refresh is running, other threads keep using the current credentials. Only when the credentials
+    are missing or inside the ``expiry_margin`` window does a caller block on ``assume_role``.
+
+    A caller waits at most ``wait_timeout`` seconds for another thread's ``assume_role`` before it
+    assumes the role itself. That thread may never answer in time, for example a background thread
+    that Lambda froze with the container while it was waiting for STS.
+    """
+    def __init__(self, role_arn, session_name, refresh_margin=300, expiry_margin=60, wait_timeout=None):
+        # type: (str, str, int, int, float) -> None
+        self.role_arn = role_arn
+        self.session_name = session_name
+        self.refresh_margin = refresh_margin
+        self.expiry_margin = expiry_margin
+        self.wait_timeout = wait_timeout
+        self.generation = 0
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "wait_timeouts": 0}
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._sts_client = None
+        self._credentials = None
+        self._expiration = 0.0
+
+    def get_credentials(self):
+        # type: () -> dict
+        """Return the cached ``Credentials`` dict from ``assume_role``, assuming the role if needed."""
+        return self.get_credentials_and_generation()[0]
+
+    def get_credentials_and_generation(self):
+        # type: () -> tuple
+        """Return the cached credentials and their generation, read together so they always match."""
+        now = time.time()
+        with self._lock:
+            credentials = self._credentials
+            generation = self.generation
+            expiration = self._expiration
+            if credentials is not None and now < expiration - self.expiry_margin:
+                self.stats["hits"] += 1
+                refresh_due = now >= expiration - self.refresh_margin
+            else:
+                credentials = None
+                refresh_due = False
+
+        if credentials is None:
+            # Nothing usable is cached, so every caller has to wait for fresh credentials.
+            if not self._refresh_lock.acquire(timeout=-1 if self.wait_timeout is None else self.wait_timeout):
+                with self._lock:
+                    self.stats["wait_timeouts"] += 1
+                    self.stats["misses"] += 1
+                logger.warning("Gave up waiting %.1fs for another thread to assume the role", self.wait_timeout)
+                return self._assume_role()
+            try:
+                with self._lock:
+                    if self._credentials is not None and time.time() < self._expiration - self.expiry_margin:
+                        # Another thread assumed the role while this one was waiting.
+                        self.stats["hits"] += 1
+                        return self._credentials, self.generation
+                    self.stats["misses"] += 1
+                return self._assume_role()
+            finally:
+                self._refresh_lock.release()
+
+        if refresh_due and self._refresh_lock.acquire(False):
+            # Refresh ahead of expiry on this thread only; the others keep the still valid credentials.
+            try:
+                with self._lock:
+                    still_due = time.time() >= self._expiration - self.refresh_margin
+                if still_due:
+                    with self._lock:
+                        self.stats["refreshes"] += 1
+                    credentials, generation = self._assume_role()
+            except Exception:
+                logger.warning("Refreshing credentials ahead of expiry failed, keeping the cached ones", exc_info=True)
+            finally:
+                self._refresh_lock.release()
+
+        return credentials, generation
+
+    def invalidate(self):
+        # type: () -> None
+        """Drop the cached credentials so the next call assumes the role again."""
+        with self._lock:
+            self._credentials = None
+            self._expiration = 0.0
+
+    def _assume_role(self):
+        # type: () -> tuple
+        sts_client = self._sts_client
+        if sts_client is None:
+            # Built outside the lock, so callers that only read the cached credentials don't wait for it.
+            with timed("client_build"):
+                sts_client = InstrumentedClient(boto3_session().client('sts'), 'sts')
+            with self._lock:
+                if self._sts_client is None:
+                    self._sts_client = sts_client
+                sts_client = self._sts_client
+        assumed_role_object = sts_client.assume_role(RoleArn=self.role_arn, RoleSessionName=self.session_name)
+        credentials = assumed_role_object['Credentials']
+        expiration = credentials['Expiration']
+        if hasattr(expiration, 'timestamp'):
+            expiration = expiration.timestamp()
+        with self._lock:
+            self._credentials = credentials
+            self._expiration = float(expiration)
+            self.generation += 1
+            generation = self.generation
+        logger.info("Assumed role %s (credential generation %d)", self.role_arn, generation)
+        return credentials, generation
+
+
+class ClientFactory(object):
+    """Builds boto3 clients once per container and hands out the same client on warm invocations.
+
+    Clients are keyed by service, region and credential generation, so a client (and its
+    connection pool) is only rebuilt after the credential provider has assumed the role again.
+    """
+    def __init__(self, credential_provider, max_pool_connections=10, tcp_keepalive=True,
+                 retry_mode='standard', max_attempts=3):
+        # type: (CredentialProvider, int, bool, str, int) -> None
+        self.credential_provider = credential_provider
+        self.max_pool_connections = max_pool_connections
+        self.tcp_keepalive = tcp_keepalive
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.stats = {"hits": 0, "builds": 0}
+
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def client_config(self, **overrides):
+        # type: (...) -> Config
+        """Return the botocore ``Config`` used for every client, with optional per-call overrides."""
+        from botocore.config import Config
+        options = {
+            'max_pool_connections': self.max_pool_connections,
+            'retries': {'mode': self.retry_mode, 'max_attempts': self.max_attempts},
+        }
+        # Older botocore releases (before 1.27.84) have no tcp_keepalive option.
+        # Reusing the client still keeps its HTTP connections alive between invocations.
+        if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = self.tcp_keepalive
+        options.update(overrides)
+        return Config(**options)
+
+    def get_client(self, service_name, region_name=None, **config_overrides):
+        # type: (str, str, ...) -> object
+        """Return a cached client for the service and region, built with the current credentials.
+
+        Keyword arguments such as ``read_timeout`` override the client config. Each distinct set of
+        overrides gets its own cached client, so callers should keep the number of variants small.
+        """
+        credentials, generation = self.credential_provider.get_credentials_and_generation()
+        variant = repr(sorted(config_overrides.items()))
+        key = (service_name, region_name, variant, generation)
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.stats["hits"] += 1
+                return client
+
+        # The client is built outside the lock, so a slow build doesn't hold up callers whose client is cached.
+        with timed("client_build"):
+            client = boto3_session().client(
+                service_name,
+                region_name=region_name,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=self.client_config(**config_overrides))
+        # Every API call made with the client is timed in the request's metrics.
+        client = InstrumentedClient(client, service_name)
+
+        with self._lock:
+            cached = self._clients.get(key)
+            if cached is not None:
+                # Another thread built the same client in the meantime, so everyone keeps using that one.
+                self.stats["hits"] += 1
+                return cached
+            # Clients built with older credentials will never be handed out again. A caller that read
+            # the credentials just before a refresh may still build one, but it doesn't evict newer clients.
+            for stale_key in [k for k in self._clients if k[3] < generation]:
+                del self._clients[stale_key]
+            self._clients[key] = client
+            self.stats["builds"] += 1
+        logger.info("Built %s client for region %s (credential generation %d)", service_name, region_name, generation)
+        return client
+
+    def clear(self):
+        # type: () -> None
+        """Drop every cached client."""
+        with self._lock:
+            self._clients.clear()
+
+
+class TopicResolver(object):
+    """Resolves the Amazon SNS topic ARN once per container instead of calling ``create_topic`` on every email.
+
+    The ARN is resolved lazily, by the first call, which is a keep-warm event's ``topic`` step or else
+    the first email a container sends. If ``topic_arn`` is given, that call checks that the topic exists
+    with ``get_topic_attributes``. Otherwise the ARN is looked up with ``create_topic``, which returns
+    the existing topic if there is one. The ARN is resolved again after ``refresh_interval`` seconds.
+
+    The SNS calls are made outside the lock, so threads that only read the cached ARN never wait for
+    them. Threads that find no ARN at the same time may each resolve it, which gives the same ARN.
+    """
+    def __init__(self, client_factory, topic_name, topic_arn=None, refresh_interval=3600):
+        # type: (ClientFactory, str, str, int) -> None
+        self.client_factory = client_factory
+        self.topic_name = topic_name
+        self.configured_arn = topic_arn
+        self.refresh_interval = refresh_interval
+        self.stats = {"hits": 0, "resolves": 0}
+
+        self._lock = threading.Lock()
+        self._topic_arn = None
+        self._resolved_at = 0.0
+
+    def get_topic_arn(self):
+        # type: () -> str
+        """Return the cached topic ARN, resolving it on first use and after the refresh interval."""
+        with self._lock:
+            if self._topic_arn is not None and time.time() - self._resolved_at < self.refresh_interval:
+                self.stats["hits"] += 1
+                return self._topic_arn
+
+        sns = self.client_factory.get_client('sns')
+        topic_arn = None
+        if self.configured_arn is not None and self.check_topic(sns, self.configured_arn):
+            topic_arn = self.configured_arn
+        if topic_arn is None:
+            topic_arn = sns.create_topic(Name=self.topic_name)['TopicArn']
+        with self._lock:
+            self._topic_arn = topic_arn
+            self._resolved_at = time.time()
+            self.stats["resolves"] += 1
+        logger.info("Resolved SNS topic %s to %s", self.topic_name, topic_arn)
+        return topic_arn
+
+    def check_topic(self, sns, topic_arn):
+        # type: (object, str) -> bool
+        """Return True if the topic exists, logging why it couldn't be read otherwise."""
+        try:
+            sns.get_topic_attributes(TopicArn=topic_arn)
+        except Exception:
+            logger.error("SNS topic %s could not be found, looking it up by name instead", topic_arn, exc_info=True)
+            return False
+        return True
+
+    def invalidate(self):
+        # type: () -> None
+        """Forget the cached ARN so the next call resolves it again."""
+        with self._lock:
+            self._topic_arn = None
+
+
+class LazyApiClient(ApiClient):
+    """The SDK's ``DefaultApiClient``, built the first time the skill calls an Alexa API.
+
+    ``DefaultApiClient`` imports the requests library, which only SendEmailIntentHandler needs, to
+    read the user's profile. Importing it up front would slow down loading the skill for every turn.
+    """
+    def __init__(self):
+        # type: () -> None
+        self._lock = threading.Lock()
+        self._client = None
+
+    def invoke(self, request):
+        # type: (ApiClientRequest) -> ApiClientResponse
+        with self._lock:
+            if self._client is None:
+                from ask_sdk_core.api_client import DefaultApiClient
+                self._client = DefaultApiClient()
+        return self._client.invoke(request)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Dialog state of a Doc Support session.
+# The state is kept in one compact, versioned session attribute instead of a session attribute per
+# field, and the dialog status only changes through the transitions in TRANSITIONS.
+import logging
+
+from ask_sdk_core.dispatch_components import AbstractRequestInterceptor, AbstractResponseInterceptor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STATE_ATTRIBUTE = "S"
+VERSION = 1
+
+# Dialog statuses.
+NONE_ASKED = 0
+NEW_ASK = 1
+NEW_PASS = 2
+ASKED_NOT_ANSWERED = 3
+ASKED_AND_ANSWERED = 4
+NEW_QUERY = 5
+
+# The handler that offered something to the user last.
+NO_HANDLER = 0
+CAPTURE_QUERY = 1
+READ_DOC = 2
+EMAIL = 3
+
+# Events that change the dialog status.
+LAUNCHED = "launched"
+NEW_QUESTION = "new question"
+PROMPTED = "prompted"
+NEXT_RESULT = "next result"
+NO_RESULTS = "no results"
+ACCEPTED = "accepted"
+REJECTED = "rejected"
+ANOTHER_QUESTION = "another question"
+FINISHED = "finished"
+
+ANY = None
+
+# (status, event) -> next status. ANY matches every status that has no transition of its own for the event.
+TRANSITIONS = {
+    (ANY, LAUNCHED): NONE_ASKED,
+    (ANY, NEW_QUESTION): NEW_ASK,
+    (ANY, PROMPTED): NEW_ASK,
+    (ASKED_NOT_ANSWERED, NEXT_RESULT): NEW_PASS,
+    (ANY, NO_RESULTS): NEW_ASK,
+    (ANY, ACCEPTED): ASKED_AND_ANSWERED,
+    (ANY, REJECTED): ASKED_NOT_ANSWERED,
+    (ANY, ANOTHER_QUESTION): NEW_QUERY,
+}
+
+# What a "Yes" (True) or "No" (False) means after each handler. Anything else wasn't a yes or no question.
+YES_NO_EVENTS = {
+    (CAPTURE_QUERY, True): ACCEPTED,
+    (READ_DOC, True): ACCEPTED,
+    (CAPTURE_QUERY, False): REJECTED,
+    (READ_DOC, False): REJECTED,
+    (EMAIL, True): ANOTHER_QUESTION,
+    (EMAIL, False): FINISHED,
+}
+
+NO_PREVIOUS_QUERY = "no previous query"
+
+# Session attributes written by earlier versions of the skill, one per field. The first version also
+# kept the text of the last result in the session, which is now looked up in the result store.
+LEGACY_ATTRIBUTES = frozenset(("LastQuery", "QueryStatus", "QueryCount", "LastOutput", "Candidates",
+                               "ResultId", "LastDocId", "LastHandler", "PendingEmails",
+                               "LastDocText", "QueryResult", "LastSourceURI"))
+LEGACY_STATUSES = {
+    "none asked": NONE_ASKED,
+    "new ask": NEW_ASK,
+    "new pass": NEW_PASS,
+    "asked not answered": ASKED_NOT_ANSWERED,
+    "asked and answered": ASKED_AND_ANSWERED,
+    "new query": NEW_QUERY,
+}
+LEGACY_HANDLERS = {"capture query": CAPTURE_QUERY, "read doc": READ_DOC, "email": EMAIL}
+
+
+class InvalidTransition(ValueError):
+    """Raised when an event can't happen in the dialog's current status."""
+
+
+class DialogState(object):
+    """Everything the skill remembers between the turns of a session.
+
+    ``candidates`` holds the Kendra result IDs offered for ``last_query``, ``query_count`` is the
+    position of the one offered last, and ``result_id`` and ``last_doc_id`` point to the last
+    result and the last document offered. ``read_offset`` is where the part of ``last_doc_id``
+    read last starts, or None if it hasn't been read, and ``read_passages`` is whether that offset
+    is in the document's passages rather than in the excerpt from the query result.
+    ``result_key`` and ``last_doc_key`` identify the document behind ``result_id`` and
+    ``last_doc_id``, so the same document can be found again when the result IDs have changed.
+    """
+    __slots__ = ("status", "last_handler", "query_count", "last_query", "candidates",
+                 "result_id", "last_doc_id", "last_output", "pending_emails", "read_offset",
+                 "read_passages", "result_key", "last_doc_key")
+
+    def __init__(self):
+        # type: () -> None
+        self.status = NONE_ASKED
+        self.last_handler = NO_HANDLER
+        self.query_count = 0
+        self.last_query = NO_PREVIOUS_QUERY
+        self.candidates = None
+        self.result_id = None
+        self.last_doc_id = None
+        self.last_output = None
+        self.pending_emails = None
+        self.read_offset = None
+        self.read_passages = None
+        self.result_key = None
+        self.last_doc_key = None
+
+    def transition(self, event):
+        # type: (str) -> int
+        """Move to the status the event leads to from the current status, and return it."""
+        status = TRANSITIONS.get((self.status, event))
+        if status is None:
+            status = TRANSITIONS.get((ANY, event))
+        if status is None:
+            raise InvalidTransition("%r can't happen in status %d" % (event, self.status))
+        self.status = status
+        return status
+
+    def encode(self):
+        # type: () -> list
+        """Return the state as a short list, with the result pointers stored as positions in ``candidates``."""
+        candidates = self.candidates
+        result_pointer = self.result_id
+        doc_pointer = self.last_doc_id
+        if candidates:
+            # A result the skill offered is nearly always among the candidates, which hold at most a few IDs.
+            if result_pointer in candidates:
+                result_pointer = candidates.index(result_pointer)
+            if doc_pointer in candidates:
+                doc_pointer = candidates.index(doc_pointer)
+        encoded = [VERSION, self.status, self.last_handler, self.query_count, self.last_query, candidates,
+                   result_pointer, doc_pointer, self.last_output, self.pending_emails,
+                   self.read_offset, self.read_passages, self.result_key, self.last_doc_key]
+        # Trailing fields that are empty are left out.
+        while encoded[-1] is None:
+            encoded.pop()
+        return encoded
+
+    @classmethod
+    def decode(cls, encoded):
+        # type: (list) -> DialogState
+        # Every field is set from the list, so __init__ is skipped.
+        state = cls.__new__(cls)
+        fields = encoded[1:]
+        missing = len(cls.__slots__) - len(fields)
+        if missing > 0:
+            fields.extend([None] * missing)
+        (state.status, state.last_handler, state.query_count, state.last_query, state.candidates,
+         result_pointer, doc_pointer, state.last_output, state.pending_emails, state.read_offset,
+         state.read_passages, state.result_key, state.last_doc_key) = fields
+        state.result_id = result_pointer
+        state.last_doc_id = doc_pointer
+        candidates = state.candidates
+        if candidates:
+            # A pointer is a position in candidates, or else a result ID kept as it is.
+            if type(result_pointer) is int and result_pointer < len(candidates):
+                state.result_id = candidates[result_pointer]
+            if type(doc_pointer) is int and doc_pointer < len(candidates):
+                state.last_doc_id = candidates[doc_pointer]
+        return state
+
+    @classmethod
+    def from_legacy(cls, session_attr):
+        # type: (dict) -> DialogState
+        """Return the state kept in the separate session attributes of earlier versions of the skill."""
+        state = cls()
+        state.status = LEGACY_STATUSES.get(session_attr.get("QueryStatus"), NONE_ASKED)
+        state.last_handler = LEGACY_HANDLERS.get(session_attr.get("LastHandler"), NO_HANDLER)
+        state.query_count = session_attr.get("QueryCount", 0)
+        state.last_query = session_attr.get("LastQuery", NO_PREVIOUS_QUERY)
+        state.candidates = session_attr.get("Candidates")
+        state.result_id = session_attr.get("ResultId")
+        state.last_doc_id = session_attr.get("LastDocId")
+        state.last_output = session_attr.get("LastOutput")
+        state.pending_emails = session_attr.get("PendingEmails")
+        return state
+
+    @classmethod
+    def load(cls, session_attr):
+        # type: (dict) -> DialogState
+        """Return the state saved in the session attributes, in the current or an earlier format."""
+        encoded = session_attr.get(STATE_ATTRIBUTE)
+        if encoded is not None:
+            if isinstance(encoded, list) and encoded and encoded[0] == VERSION:
+                return cls.decode(encoded)
+            logger.warning("Ignoring dialog state in unknown format %r", encoded[:1] if isinstance(encoded, list) else encoded)
+            return cls()
+        if not LEGACY_ATTRIBUTES.isdisjoint(session_attr):
+            # The session is migrated once, here, so saving the state never has to look for old attributes.
+            state = cls.from_legacy(session_attr)
+            for attr in LEGACY_ATTRIBUTES.intersection(session_attr):
+                del session_attr[attr]
+            state.save(session_attr)
+            return state
+        return cls()
+
+    def save(self, session_attr):
+        # type: (dict) -> None
+        """Write the state into the session attributes."""
+        session_attr[STATE_ATTRIBUTE] = self.encode()
+
+
+def dialog_state(handler_input):
+    # type: (HandlerInput) -> DialogState
+    """Return the dialog state of the request, loading it from the session attributes on first use."""
+    request_attr = handler_input.attributes_manager.request_attributes
+    state = request_attr.get(STATE_ATTRIBUTE)
+    if state is None:
+        state = DialogState.load(handler_input.attributes_manager.session_attributes)
+        request_attr[STATE_ATTRIBUTE] = state
+    return state
+
+
+class DialogStateRequestInterceptor(AbstractRequestInterceptor):
+    """Loads the dialog state from the session attributes before the request is handled."""
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        dialog_state(handler_input)
+
+
+class DialogStateResponseInterceptor(AbstractResponseInterceptor):
+    """Saves the dialog state to the session attributes after the request was handled.
+
+    When a handler raises, response interceptors don't run, so the session keeps the state it had
+    before the request.
+    """
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        state = handler_input.attributes_manager.request_attributes.get(STATE_ATTRIBUTE)
+        if state is not None:
+            state.save(handler_input.attributes_manager.session_attributes)
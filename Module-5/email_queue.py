@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# Email jobs for the Doc Support skill.
+# SendEmailIntentHandler puts a job on a queue and answers the user right away, and a separate
+# worker reads the user's profile, makes sure they are subscribed, and publishes the emails to
+# Amazon SNS in batches, retrying failures with backoff.
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+from subscriptions import CONFIRMED, filter_policy_for
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Amazon SNS accepts at most 10 messages in one publish_batch call.
+MAX_BATCH_SIZE = 10
+
+
+def make_email_job(user_id, name, query, result_id, query_result, source_uri):
+    # type: (str, str, str, str, str, str) -> dict
+    """Return an email job. The result text is included because the worker can't read this container's result store."""
+    return {
+        "JobId": str(uuid.uuid4()),
+        "UserId": user_id,
+        "Name": name,
+        "Query": query,
+        "ResultId": result_id,
+        "QueryResult": query_result,
+        "SourceURI": source_uri,
+        "EnqueuedAt": time.time(),
+    }
+
+
+def make_email_item(query, result_id, query_result, source_uri):
+    # type: (str, str, str, str) -> dict
+    """Return one result to include in a digest email."""
+    return {"Query": query, "ResultId": result_id, "QueryResult": query_result, "SourceURI": source_uri}
+
+
+def make_digest_job(user_id, name, items):
+    # type: (str, str, list) -> dict
+    """Return an email job that sends several results to the user in one email."""
+    if len(items) == 1:
+        item = items[0]
+        return make_email_job(user_id, name, item["Query"], item["ResultId"], item["QueryResult"], item["SourceURI"])
+    return {
+        "JobId": str(uuid.uuid4()),
+        "UserId": user_id,
+        "Name": name,
+        "Items": items,
+        "EnqueuedAt": time.time(),
+    }
+
+
+def email_message(job):
+    # type: (dict) -> dict
+    """Return the subject, message and attributes of the email for a job."""
+    if "Items" in job:
+        subject = 'You asked Doc Support about ' + str(len(job["Items"])) + ' things'
+        message = 'Hi ' + job["Name"] + ',\n' + 'Here is what you asked Doc Support about.\n'
+        for item in job["Items"]:
+            message += ('\nYou asked about ' + item["Query"] + '.'
+                        ' We found this: \n' + item["QueryResult"] +'\n'
+                        'More information can be found in the following documentation: ' + item["SourceURI"] + '\n')
+    else:
+        subject = 'You asked about ' + job["Query"]
+        message = ('Hi ' + job["Name"] + ',\n' + 'You asked Doc Support about ' + job["Query"] + '.'
+                   ' We found this: \n' + job["QueryResult"] +'\n'
+                   'More information can be found in the following documentation: ' + job["SourceURI"] + '')
+    return {
+        'Subject': subject,
+        'Message': message,
+        'MessageAttributes': {
+            'user_id':{
+                'DataType': 'String',
+                'StringValue': job["UserId"]
+            }
+        }
+    }
+
+
+def publish_email(sns, topic_arn, job):
+    # type: (object, str, dict) -> None
+    """Publish one email job to the topic."""
+    sns.publish(TopicArn=topic_arn, **email_message(job))
+
+
+class SqsEmailQueue(object):
+    """Email queue backed by Amazon SQS. The worker Lambda is triggered by the queue."""
+    def __init__(self, client_factory, queue_url, region_name=None):
+        # type: (object, str, str) -> None
+        self.client_factory = client_factory
+        self.queue_url = queue_url
+        self.region_name = region_name
+
+    def send(self, job):
+        # type: (dict) -> None
+        sqs = self.client_factory.get_client('sqs', region_name=self.region_name)
+        sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+
+    def receive(self, max_jobs=MAX_BATCH_SIZE):
+        # type: (int) -> list
+        """Return up to ``max_jobs`` ``(receipt, job)`` pairs."""
+        sqs = self.client_factory.get_client('sqs', region_name=self.region_name)
+        response = sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_jobs, 10))
+        return [(message['ReceiptHandle'], json.loads(message['Body'])) for message in response.get('Messages', [])]
+
+    def delete(self, receipt):
+        # type: (str) -> None
+        sqs = self.client_factory.get_client('sqs', region_name=self.region_name)
+        sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+class FileEmailQueue(object):
+    """Local stand-in for the SQS queue that keeps one JSON file per job in a directory.
+
+    Jobs are written to a temporary file and renamed into place, so a job is either fully
+    on disk or not there at all.
+    """
+    def __init__(self, directory='/tmp/doc_support_email_queue'):
+        # type: (str) -> None
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def send(self, job):
+        # type: (dict) -> None
+        name = "%017.6f-%s.json" % (job.get("EnqueuedAt", time.time()), job["JobId"])
+        temp_path = os.path.join(self.directory, "." + name + ".tmp")
+        with open(temp_path, 'w') as job_file:
+            json.dump(job, job_file)
+        os.rename(temp_path, os.path.join(self.directory, name))
+
+    def receive(self, max_jobs=MAX_BATCH_SIZE):
+        # type: (int) -> list
+        """Return up to ``max_jobs`` ``(receipt, job)`` pairs, oldest first."""
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+        jobs = []
+        for name in names[:max_jobs]:
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as job_file:
+                    jobs.append((path, json.load(job_file)))
+            except (IOError, OSError, ValueError):
+                logger.warning("Skipping unreadable email job %s", path, exc_info=True)
+        return jobs
+
+    def delete(self, receipt):
+        # type: (str) -> None
+        try:
+            os.remove(receipt)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.json')])
+
+
+class EmailWorker(object):
+    """Publishes email jobs in batches and retries the ones that fail with exponential backoff.
+
+    A job queued with a ``Profile`` (the Alexa API endpoint and access token of the user's request)
+    still needs the user's name and subscription. The worker reads the name and email address with
+    ``read_profile`` and looks the user up in ``subscription_index``, subscribing their email address
+    if the topic has no subscription for them yet. Until the user confirms the subscription, the job
+    is returned as failed, so the queue delivers it again later.
+    """
+    def __init__(self, client_factory, topic_resolver, max_attempts=4, base_delay=0.2, max_delay=5.0,
+                 subscription_index=None, read_profile=None):
+        # type: (object, object, int, float, float, SubscriptionIndex, object) -> None
+        self.client_factory = client_factory
+        self.topic_resolver = topic_resolver
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.subscription_index = subscription_index
+        self.read_profile = read_profile
+        self.stats = {"published": 0, "failed": 0, "retries": 0, "batches": 0, "unconfirmed": 0}
+
+    def process(self, jobs):
+        # type: (list) -> list
+        """Publish the jobs and return the ones that still failed after every attempt."""
+        failed = []
+        for start in range(0, len(jobs), MAX_BATCH_SIZE):
+            failed.extend(self._process_batch(jobs[start:start + MAX_BATCH_SIZE]))
+        return failed
+
+    def drain(self, queue, max_jobs=None):
+        # type: (object, int) -> int
+        """Process jobs from a queue until it is empty (or ``max_jobs`` were seen), and return how many were published.
+
+        Jobs that fail every attempt stay on the queue so they can be picked up again later.
+        """
+        published = 0
+        seen = 0
+        while max_jobs is None or seen < max_jobs:
+            received = queue.receive(MAX_BATCH_SIZE)
+            if not received:
+                break
+            seen += len(received)
+            failed_ids = set(job["JobId"] for job in self.process([job for _, job in received]))
+            for receipt, job in received:
+                if job["JobId"] not in failed_ids:
+                    queue.delete(receipt)
+                    published += 1
+            if len(failed_ids) == len(received):
+                break
+        return published
+
+    def _process_batch(self, jobs):
+        self.stats["batches"] += 1
+        sns = self.client_factory.get_client('sns')
+        topic_arn = self.topic_resolver.get_topic_arn()
+
+        pending = []
+        unready = []
+        for job in jobs:
+            try:
+                ready = self._prepare(sns, topic_arn, job)
+            except Exception:
+                logger.warning("Could not read the profile or subscription for email job %s", job["JobId"], exc_info=True)
+                ready = False
+            (pending if ready else unready).append(job)
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self.stats["retries"] += len(pending)
+                delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            pending = self._publish(sns, topic_arn, pending)
+            if not pending:
+                break
+
+        self.stats["published"] += len(jobs) - len(pending) - len(unready)
+        self.stats["failed"] += len(pending)
+        for job in pending:
+            logger.error("Giving up on email job %s for user %s", job["JobId"], job["UserId"])
+        return pending + unready
+
+    def _prepare(self, sns, topic_arn, job):
+        """Fill in the user's name, and return False if their subscription isn't confirmed yet."""
+        profile = job.get("Profile")
+        if profile is None:
+            # SendEmailIntentHandler already read the profile and checked the subscription.
+            return True
+        name, email = self.read_profile(profile)
+        job["Name"] = name
+        user_id = job["UserId"]
+        subscription = self.subscription_index.lookup(user_id)
+        if subscription is None or subscription["Status"] != CONFIRMED:
+            # The user may have confirmed their subscription since the index was last refreshed.
+            self.subscription_index.refresh(sns, topic_arn)
+            subscription = self.subscription_index.lookup(user_id)
+        if subscription is None:
+            response = sns.subscribe(TopicArn=topic_arn, Protocol='email', Endpoint=email,
+                                     Attributes={'FilterPolicy': filter_policy_for(user_id)})
+            subscription = self.subscription_index.record_subscription(user_id, response["SubscriptionArn"])
+        if subscription["Status"] != CONFIRMED:
+            self.stats["unconfirmed"] += 1
+            logger.info("Email job %s waits for user %s to confirm their subscription", job["JobId"], user_id)
+            return False
+        return True
+
+    def _publish(self, sns, topic_arn, jobs):
+        # Older botocore releases have no publish_batch, so fall back to one publish per job.
+        if hasattr(sns, 'publish_batch') and len(jobs) > 1:
+            entries = []
+            for job in jobs:
+                entry = email_message(job)
+                entry['Id'] = job["JobId"].replace('-', '')
+                entries.append(entry)
+            try:
+                response = sns.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+            except Exception:
+                logger.warning("publish_batch failed for %d email jobs", len(jobs), exc_info=True)
+                return jobs
+            failed_ids = set(failure['Id'] for failure in response.get('Failed', []))
+            return [job for job in jobs if job["JobId"].replace('-', '') in failed_ids]
+
+        failed = []
+        for job in jobs:
+            try:
+                publish_email(sns, topic_arn, job)
+            except Exception:
+                logger.warning("Publishing email job %s failed", job["JobId"], exc_info=True)
+                failed.append(job)
+        return failed
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Precomputed answers for the questions users ask most.
+# An offline build step runs a list of common questions through Amazon Kendra and the same
+# candidate selection CaptureQueryIntentHandler uses, and writes the candidates into a small,
+# read-only SQLite file that is deployed with the Lambda function. The skill answers questions
+# found in the file without calling Amazon Kendra.
+#
+# Build the file from the Module-5 folder, with credentials that can query your index:
+#   python faq_index.py --queries top_queries.txt --index indexID:us-east-1 --output faq_index.db
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from kendra_search import KendraResult, QueryCache, KendraSearcher, MultiIndexSearcher, normalize_query, select_candidates
+from metrics import count
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Version of the file layout, which the skill checks before using a file.
+FORMAT = 1
+
+
+def build_faq_index(path, queries, search, max_candidates=3, version=None):
+    # type: (str, list, object, int, str) -> dict
+    """Write an FAQ index for ``queries`` to ``path`` and return its metadata.
+
+    ``search`` is called with each question and returns its Kendra result items. Questions that
+    normalize to the same text are only searched once, and questions without candidates are left out.
+    The file is written next to ``path`` and then moved into place, so readers never see half a file.
+    """
+    built_at = time.time()
+    meta = {
+        "format": FORMAT,
+        "version": version or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(built_at)),
+        "built_at": built_at,
+        "max_candidates": max_candidates,
+    }
+    rows = {}
+    for query in queries:
+        key = normalize_query(query)
+        if not key or key in rows:
+            continue
+        candidates = select_candidates(search(query), max_candidates)
+        if candidates:
+            rows[key] = json.dumps([[candidate[field] for field, _ in KendraResult._FIELDS] for candidate in candidates],
+                                   separators=(',', ':'))
+    meta["questions"] = len(rows)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.faq_index_', suffix='.db', dir=directory)
+    os.close(handle)
+    try:
+        db = sqlite3.connect(temp_path)
+        try:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+            # An ordinary rowid table: its rows hold about 1.4 KB of candidates each, which a WITHOUT ROWID
+            # table would spill into an overflow page per row, doubling the file.
+            db.execute("CREATE TABLE answers (query TEXT PRIMARY KEY, candidates TEXT NOT NULL)")
+            db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [(key, json.dumps(value)) for key, value in meta.items()])
+            db.executemany("INSERT INTO answers (query, candidates) VALUES (?, ?)", sorted(rows.items()))
+            db.commit()
+            db.execute("VACUUM")
+        finally:
+            db.close()
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return meta
+
+
+class FaqIndex(object):
+    """Read-only answers for common questions, from a file written by ``build_faq_index``.
+
+    The file is opened once per container, read-only and memory-mapped, so lookups don't copy it into
+    the Lambda's memory. A question is looked up by its normalized text, so "How do I create a bucket?"
+    and "how do I create a bucket" find the same answer. If the file is missing, has another format,
+    or is older than ``max_age`` seconds, every lookup misses and the skill asks Amazon Kendra.
+    """
+    def __init__(self, path, max_age=None, mmap_size=64 * 1024 * 1024):
+        # type: (str, float, int) -> None
+        self.path = path
+        self.max_age = max_age
+        self.mmap_size = mmap_size
+        self.meta = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+        self._lock = threading.Lock()
+        self._db = self._open()
+
+    @property
+    def version(self):
+        # type: () -> str
+        return self.meta.get("version")
+
+    def lookup(self, query, limit=None):
+        # type: (str, int) -> list
+        """Return the precomputed candidates for the question, or None if it isn't in the index."""
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT candidates FROM answers WHERE query = ?", (normalize_query(query),)).fetchone()
+            self.stats["hits" if row is not None else "misses"] += 1
+        if row is None:
+            count("faq_misses")
+            return None
+        count("faq_hits")
+        return [KendraResult(*fields) for fields in json.loads(row[0])[:limit]]
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            logger.info("No FAQ index at %s, every question goes to Amazon Kendra", self.path)
+            return None
+        try:
+            # immutable=1 tells SQLite the file never changes, so it skips locking on the read-only package.
+            uri = 'file:%s?mode=ro&immutable=1' % urllib.parse.quote(os.path.abspath(self.path))
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            db.execute("PRAGMA mmap_size = %d" % int(self.mmap_size))
+            self.meta = dict((key, json.loads(value)) for key, value in db.execute("SELECT key, value FROM meta"))
+        except sqlite3.Error:
+            logger.warning("Could not open the FAQ index at %s", self.path, exc_info=True)
+            return None
+        if self.meta.get("format") != FORMAT:
+            logger.warning("Ignoring the FAQ index at %s, it has format %r instead of %d", self.path, self.meta.get("format"), FORMAT)
+            db.close()
+            return None
+        age = time.time() - self.meta.get("built_at", 0)
+        if self.max_age is not None and age > self.max_age:
+            logger.warning("Ignoring FAQ index version %s, it was built %.1f days ago", self.version, age / 86400.0)
+            db.close()
+            return None
+        logger.info("Loaded FAQ index version %s with %d questions", self.version, self.meta.get("questions", 0))
+        return db
+
+
+class _DefaultClientFactory(object):
+    # Clients with the default AWS credentials of whoever runs the build.
+    def __init__(self):
+        self._clients = {}
+
+    def get_client(self, service_name, region_name=None, **config_overrides):
+        import boto3
+        key = (service_name, region_name)
+        if key not in self._clients:
+            self._clients[key] = boto3.client(service_name, region_name=region_name)
+        return self._clients[key]
+
+
+def read_queries(path):
+    # type: (str) -> list
+    """Return the questions in a file with one question per line, skipping blank lines and ``#`` comments."""
+    with open(path) as lines:
+        return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the FAQ index the Doc Support skill answers common questions from.')
+    parser.add_argument('--queries', required=True, help='file with one question per line, most popular first')
+    parser.add_argument('--index', action='append', required=True, help='Kendra index as INDEX_ID:REGION, can be repeated')
+    parser.add_argument('--output', default='faq_index.db', help='file to write')
+    parser.add_argument('--candidates', type=int, default=3, help='results kept per question, as MAX_CANDIDATES in the skill')
+    parser.add_argument('--version', help='version stamp to write, defaults to the build time')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client_factory = _DefaultClientFactory()
+    query_cache = QueryCache(max_size=1)
+    searchers = [KendraSearcher(client_factory, query_cache, index_id=index_id, region_name=region_name)
+                 for index_id, _, region_name in [index.partition(':') for index in args.index]]
+    searcher = searchers[0] if len(searchers) == 1 else MultiIndexSearcher(searchers)
+
+    meta = build_faq_index(args.output, read_queries(args.queries), searcher.search, args.candidates, args.version)
+    print('Wrote FAQ index version %s with %d questions to %s (%d bytes)' % (
+        meta["version"], meta["questions"], args.output, os.path.getsize(args.output)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+# Helpers for querying Amazon Kendra from the Doc Support skill.
+import contextvars
+import logging
+import math
+import re
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
+
+from metrics import count
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+# Result types the skill can read out, optionally add or remove QUESTION_ANSWER.
+CANDIDATE_TYPES = ('ANSWER', 'QUESTION_ANSWER', 'DOCUMENT')
+
+
+def normalize_query(query):
+    # type: (str) -> str
+    """Lower-case the query and drop punctuation and repeated whitespace, so equivalent utterances share a key."""
+    query = _NON_WORD.sub(" ", query.lower())
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+class KendraResult(object):
+    """Compact view of one Kendra result item, holding only the fields the skill speaks or emails.
+
+    It can be read like the dicts the result store loads back (``result["Text"]``), and ``dict(result)``
+    turns it into one.
+    """
+    __slots__ = ('id', 'type', 'text', 'title', 'uri', 'document_id')
+
+    _FIELDS = (("Id", 'id'), ("Type", 'type'), ("Text", 'text'), ("Title", 'title'), ("URI", 'uri'),
+               ("DocumentId", 'document_id'))
+    _ATTRIBUTES = dict(_FIELDS)
+
+    def __init__(self, id, type, text, title, uri, document_id=None):
+        # type: (str, str, str, str, str, str) -> None
+        self.id = id
+        self.type = type
+        self.text = text
+        self.title = title
+        self.uri = uri
+        self.document_id = document_id
+
+    @classmethod
+    def from_item(cls, query_result):
+        # type: (dict) -> KendraResult
+        """Project a raw ``ResultItems`` entry, without touching its highlights or document attributes."""
+        title = query_result.get('DocumentTitle')
+        return cls(
+            query_result['Id'],
+            query_result['Type'],
+            query_result['DocumentExcerpt']['Text'],
+            title['Text'] if title else None,
+            query_result['DocumentURI'],
+            query_result.get('DocumentId'))
+
+    def keys(self):
+        return [key for key, _ in self._FIELDS]
+
+    def __getitem__(self, key):
+        return getattr(self, self._ATTRIBUTES[key])
+
+    def get(self, key, default=None):
+        attribute = self._ATTRIBUTES.get(key)
+        return getattr(self, attribute) if attribute is not None else default
+
+    def __repr__(self):
+        return "KendraResult(%r, %r)" % (self.id, self.type)
+
+
+def select_candidates(result_items, limit):
+    # type: (list, int) -> list
+    """Return the first ``limit`` usable results in ranked order, reduced to what the skill speaks or emails.
+
+    Items after the last candidate are never parsed.
+    """
+    candidates = []
+    if limit <= 0:
+        return candidates
+    from_item = KendraResult.from_item
+    for query_result in result_items:
+        if query_result['Type'] in CANDIDATE_TYPES:
+            candidates.append(from_item(query_result))
+            if len(candidates) >= limit:
+                break
+    return candidates
+
+
+class DeadlineExceeded(Exception):
+    """Raised when Amazon Kendra doesn't answer before the request deadline and there is nothing cached to fall back on."""
+    pass
+
+
+class Deadline(object):
+    """The point in time by which the skill has to have its response ready."""
+    def __init__(self, seconds):
+        # type: (float) -> None
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context, budget, margin):
+        # type: (object, float, float) -> Deadline
+        """Return a deadline ``margin`` seconds before the Lambda invocation times out, and at most ``budget`` seconds away."""
+        seconds = budget
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            seconds = min(budget, context.get_remaining_time_in_millis() / 1000.0 - margin)
+        return cls(max(0.0, seconds))
+
+    def remaining(self):
+        # type: () -> float
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        # type: () -> bool
+        return self.remaining() <= 0.0
+
+
+def _submit(executor, fn, *args):
+    # Run fn with the caller's context, so the time it takes is recorded in the caller's request metrics.
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class QueryCache(object):
+    """In-process cache of ``kendra.query`` result items with a time-to-live and least-recently-used eviction.
+
+    Entries are keyed by index ID and the normalized query text. The cache lives at module level,
+    so results are shared by every session that lands on the same warm container. Expired entries
+    are kept for up to ``stale_ttl`` seconds so ``get_stale`` can serve them when Kendra is too slow.
+    """
+    def __init__(self, max_size=256, ttl=900, stale_ttl=86400):
+        # type: (int, int, int) -> None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "stale_hits": 0}
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(index_id, query):
+        # type: (str, str) -> tuple
+        return (index_id, normalize_query(query))
+
+    def get(self, index_id, query):
+        # type: (str, str) -> list
+        """Return the cached result items for the query, or None if they are missing or expired."""
+        key = self.make_key(index_id, query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, result_items = entry
+            if now - stored_at > self.ttl:
+                if now - stored_at > self.stale_ttl:
+                    del self._entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return result_items
+
+    def get_stale(self, index_id, query):
+        # type: (str, str) -> list
+        """Return the result items for the query even if they have expired, or None if there are none."""
+        key = self.make_key(index_id, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.stale_ttl:
+                return None
+            self.stats["stale_hits"] += 1
+            return entry[1]
+
+    def put(self, index_id, query, result_items):
+        # type: (str, str, list) -> None
+        """Store the result items for the query, evicting the least recently used entries if the cache is full."""
+        key = self.make_key(index_id, query)
+        with self._lock:
+            self._entries[key] = (time.time(), result_items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, index_id=None, query=None):
+        # type: (str, str) -> int
+        """Remove one query, every query for an index, or everything, and return how many entries were removed."""
+        with self._lock:
+            if index_id is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            if query is not None:
+                return 1 if self._entries.pop(self.make_key(index_id, query), None) is not None else 0
+            stale_keys = [key for key in self._entries if key[0] == index_id]
+            for key in stale_keys:
+                del self._entries[key]
+            return len(stale_keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class KendraSearcher(object):
+    """Queries an Amazon Kendra index through the query cache, under a per-request deadline.
+
+    Each query runs on a small thread pool, with client connect and read timeouts derived from the
+    time left. If the deadline passes first, a stale cache entry is returned if there is one,
+    otherwise ``DeadlineExceeded`` is raised. The query keeps running in the background and caches
+    its results when it finishes, so asking again a moment later is answered from the cache.
+
+    With ``hedge`` turned on, a second identical query is sent if the first one hasn't answered after
+    ``hedge_delay`` seconds (or the observed 95th percentile latency if ``hedge_delay`` is None), and
+    the first answer wins. Hedged queries are capped at ``hedge_budget`` of all queries sent.
+
+    Queries only ask for ``page_size`` results and the ``requested_attributes`` document attributes.
+    """
+    def __init__(self, client_factory, query_cache, index_id, region_name, max_workers=8,
+                 hedge=False, hedge_delay=None, hedge_budget=0.05,
+                 page_size=10, requested_attributes=('_source_uri',)):
+        # type: (object, QueryCache, str, str, int, bool, float, float, int, tuple) -> None
+        self.client_factory = client_factory
+        self.query_cache = query_cache
+        self.index_id = index_id
+        self.region_name = region_name
+        self.page_size = page_size
+        self.requested_attributes = requested_attributes
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_budget = hedge_budget
+        self.stats = {"queries": 0, "deadline_misses": 0, "stale_served": 0, "hedges": 0, "hedge_wins": 0}
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+
+    def search(self, query, deadline=None):
+        # type: (str, Deadline) -> list
+        """Return the result items for the query, from the cache when possible."""
+        result_items = self.query_cache.get(self.index_id, query)
+        if result_items is not None:
+            count("kendra_cache_hits")
+            return result_items
+        count("kendra_cache_misses")
+
+        if deadline is None and not self.hedge:
+            return self._query(query, self._client())
+
+        try:
+            return self._run(query, deadline)
+        except FutureTimeoutError:
+            self._count("deadline_misses")
+            logger.warning("Kendra query missed the deadline (%d misses so far)", self.stats["deadline_misses"])
+
+        stale_items = self.query_cache.get_stale(self.index_id, query)
+        if stale_items is not None:
+            self._count("stale_served")
+            return stale_items
+        raise DeadlineExceeded(query)
+
+    def prime(self, deadline=None, connect=False):
+        # type: (Deadline, bool) -> None
+        """Build the client for this deadline's timeouts, so the first query doesn't have to.
+
+        A later query reuses the client only if its deadline rounds to the same timeouts; otherwise it
+        builds its own, but still with the credentials the client factory already has.
+        With ``connect``, also call ``describe_index``, which leaves an open connection in the client's
+        pool for the next query. An error response, such as a missing permission, does that too.
+        """
+        kendra = self._client(deadline)
+        if connect:
+            from botocore.exceptions import ClientError
+            try:
+                kendra.describe_index(Id=self.index_id)
+            except ClientError:
+                pass
+
+    def current_hedge_delay(self):
+        # type: () -> float
+        """Return how long to wait before hedging: the configured delay, or the observed 95th percentile latency."""
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return 1.0
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _run(self, query, deadline):
+        # Raises FutureTimeoutError if no query answers before the deadline.
+        client = self._client(deadline)
+        remaining = deadline.remaining() if deadline is not None else None
+        primary = _submit(self._executor, self._query, query, client)
+        if not self.hedge:
+            return primary.result(timeout=remaining)
+
+        delay = self.current_hedge_delay()
+        if remaining is not None:
+            delay = min(delay, remaining)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result(timeout=deadline.remaining() if deadline is not None else None)
+
+        hedge = _submit(self._executor, self._query, query, client)
+        futures = [primary, hedge]
+        error = None
+        for future in as_completed(futures, timeout=deadline.remaining() if deadline is not None else None):
+            try:
+                result_items = future.result()
+            except Exception as e:
+                # The other query may still succeed.
+                error = e
+                continue
+            if future is hedge:
+                self._count("hedge_wins")
+            return result_items
+        raise error
+
+    def _take_hedge(self):
+        with self._stats_lock:
+            if self.stats["hedges"] + 1 > self.hedge_budget * self.stats["queries"]:
+                return False
+            self.stats["hedges"] += 1
+            return True
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _client(self, deadline=None):
+        if deadline is None:
+            return self.client_factory.get_client('kendra', region_name=self.region_name)
+        # Round the timeouts so only a handful of client variants are ever built.
+        remaining = deadline.remaining()
+        return self.client_factory.get_client(
+            'kendra',
+            region_name=self.region_name,
+            connect_timeout=max(0.5, math.floor(min(2.0, remaining / 4.0) * 2) / 2.0),
+            read_timeout=max(1, int(math.ceil(remaining))),
+            retries={'mode': self.client_factory.retry_mode, 'total_max_attempts': 1})
+
+    def _query(self, query, kendra):
+        self._count("queries")
+        start = time.monotonic()
+        # Only ask for as many results and document attributes as the skill uses, to keep the response small.
+        response = kendra.query(
+            QueryText = query,
+            IndexId = self.index_id,
+            PageSize = self.page_size,
+            RequestedDocumentAttributes = list(self.requested_attributes))
+        with self._stats_lock:
+            self._latencies.append(time.monotonic() - start)
+        result_items = response['ResultItems']
+        self.query_cache.put(self.index_id, query, result_items)
+        return result_items
+
+
+# Answers come before documents when results from several indexes are merged.
+TYPE_PRIORITY = {'ANSWER': 0, 'QUESTION_ANSWER': 0, 'DOCUMENT': 1}
+CONFIDENCE_RANK = {'VERY_HIGH': 0, 'HIGH': 1, 'MEDIUM': 2, 'LOW': 3, 'NOT_AVAILABLE': 4}
+
+
+def score_confidence(query_result):
+    # type: (dict) -> str
+    return query_result.get('ScoreAttributes', {}).get('ScoreConfidence', 'NOT_AVAILABLE')
+
+
+def merge_result_items(result_lists):
+    # type: (list) -> list
+    """Merge result items from several indexes by type priority, then score confidence, then rank in their index."""
+    ranked = []
+    for result_items in result_lists:
+        for rank, query_result in enumerate(result_items):
+            ranked.append((
+                TYPE_PRIORITY.get(query_result['Type'], 2),
+                CONFIDENCE_RANK.get(score_confidence(query_result), 4),
+                rank,
+                len(ranked),
+                query_result))
+    ranked.sort(key=lambda entry: entry[:4])
+    return [entry[4] for entry in ranked]
+
+
+class MultiIndexSearcher(object):
+    """Queries several Amazon Kendra indexes at once under one shared deadline and merges their results.
+
+    It has the same ``search`` method as ``KendraSearcher``, and returns as soon as one index answers with
+    an ANSWER or QUESTION_ANSWER result whose score confidence is in ``early_confidence``, instead of
+    waiting for the slowest index. Indexes that fail or miss the deadline are left out of the merge.
+    """
+    def __init__(self, searchers, early_confidence=('VERY_HIGH',), max_workers=8):
+        # type: (list, tuple, int) -> None
+        self.searchers = searchers
+        self.early_confidence = early_confidence
+        self.stats = {"searches": 0, "early_returns": 0, "index_failures": 0}
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stats_lock = threading.Lock()
+
+    def search(self, query, deadline=None):
+        # type: (str, Deadline) -> list
+        """Return the merged result items from every index that answered in time."""
+        self._count("searches")
+        futures = [_submit(self._executor, searcher.search, query, deadline) for searcher in self.searchers]
+        result_lists = []
+        error = None
+        try:
+            for future in as_completed(futures, timeout=deadline.remaining() if deadline is not None else None):
+                try:
+                    result_items = future.result()
+                except Exception as e:
+                    self._count("index_failures")
+                    logger.warning("Kendra index query failed during fan-out", exc_info=True)
+                    error = e
+                    continue
+                result_lists.append(result_items)
+                if self._is_confident(result_items):
+                    self._count("early_returns")
+                    break
+        except FutureTimeoutError:
+            with self._stats_lock:
+                self.stats["index_failures"] += len([future for future in futures if not future.done()])
+            if not result_lists:
+                raise DeadlineExceeded(query)
+
+        if not result_lists and error is not None:
+            raise error
+        return merge_result_items(result_lists)
+
+    def prime(self, deadline=None, connect=False):
+        # type: (Deadline, bool) -> None
+        """Build the client of every index, and connect to it with ``connect``, so the first query doesn't have to."""
+        for searcher in self.searchers:
+            searcher.prime(deadline, connect)
+
+    def _is_confident(self, result_items):
+        for query_result in result_items:
+            if query_result['Type'] in ('ANSWER', 'QUESTION_ANSWER') and score_confidence(query_result) in self.early_confidence:
+                return True
+        return False
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
@@ -4,27 +4,328 @@
 # Please visit https://alexa.design/cookbook for additional examples on implementing slots, dialog management,
 # session persistence, api calls, and more.
 # This sample is built using the handler classes approach in skill builder.
+import json
 import logging
+import os
+import time
+import zlib
 import ask_sdk_core.utils as ask_utils
-import boto3 
 
-from ask_sdk_core.skill_builder import CustomSkillBuilder
-from ask_sdk_core.api_client import DefaultApiClient
 from ask_sdk_core.dispatch_components import AbstractRequestHandler
 from ask_sdk_core.dispatch_components import AbstractExceptionHandler
+from ask_sdk_core.dispatch_components import AbstractResponseInterceptor
 from ask_sdk_core.handler_input import HandlerInput
 
 from ask_sdk_model import Response
-from ask_sdk_model.ui import SimpleCard, AskForPermissionsConsentCard
+
+from aws_resources import CredentialProvider, ClientFactory, TopicResolver, LazyApiClient
+from kendra_search import QueryCache, KendraSearcher, MultiIndexSearcher, Deadline, DeadlineExceeded, select_candidates
+from faq_index import FaqIndex
+from local_search import LocalIndex
+from result_store import ResultStore
+from reading import DocumentChunks
+from passages import PassageCache, PassageRetriever
+from subscriptions import SubscriptionIndex, CONFIRMED, PENDING, filter_policy_for
+from routing import RoutedSkillBuilder
+from warmup import Warmer, Prewarmer, is_warmup_event
+from dialog_state import (dialog_state, DialogStateRequestInterceptor, DialogStateResponseInterceptor, YES_NO_EVENTS,
+                          NO_PREVIOUS_QUERY, ASKED_NOT_ANSWERED, ASKED_AND_ANSWERED, NEW_QUERY, CAPTURE_QUERY, READ_DOC, EMAIL,
+                          LAUNCHED, NEW_QUESTION, PROMPTED, NEXT_RESULT, NO_RESULTS, ACCEPTED, REJECTED, ANOTHER_QUESTION)
+from metrics import Stopwatch, MetricsRecorder, count, MetricsRequestInterceptor, MetricsResponseInterceptor, InstrumentedClient
+from email_queue import SqsEmailQueue, EmailWorker, make_email_job, make_email_item, make_digest_job, publish_email
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 PERMISSIONS = ['alexa::profile:given_name:read', 'alexa::profile:email:read']
 
+# Timings for each request are written to the log in CloudWatch embedded metric format.
+request_metrics = MetricsRecorder(namespace='DocSupport', enabled=True)
+
+# The role is assumed once per container and the credentials are shared by all handlers until they expire.
+credential_provider = CredentialProvider(
+    role_arn="<Your AWS resource role ARN>", # replace with your AWS resource role ARN
+    session_name="DocSupportSession",
+    wait_timeout=1.0) # seconds to wait for another thread's assume_role, such as the pre-warm's, before assuming the role again
+
+# Kendra and SNS clients are built once per container and rebuilt only when the credentials rotate.
+client_factory = ClientFactory(
+    credential_provider,
+    max_pool_connections=10,
+    tcp_keepalive=True,
+    retry_mode='standard')
+
+# Kendra results for popular questions are reused for up to 15 minutes instead of querying the index again.
+# Expired results are kept for a day, to answer with when Amazon Kendra is too slow.
+query_cache = QueryCache(max_size=256, ttl=900, stale_ttl=86400)
+
+# How many results the skill offers for one question before asking the user to rephrase it.
+MAX_CANDIDATES = 3
+
+# To search several indexes at once, add an (index ID, region name) pair for each one.
+# Their results are merged, with answers first and then by score confidence.
+KENDRA_INDEXES = [
+    ('indexID', 'us-east-1'), # replace with your index ID and index region name
+]
+
+kendra_searchers = [
+    KendraSearcher(
+        client_factory,
+        query_cache,
+        index_id=index_id,
+        region_name=region_name,
+        hedge=False, # set to True to send a second query when the first one is slow
+        hedge_delay=None, # seconds to wait before hedging, None uses the observed 95th percentile latency
+        hedge_budget=0.05) # hedged queries are capped at 5% of all queries
+    for index_id, region_name in KENDRA_INDEXES
+]
+if len(kendra_searchers) == 1:
+    kendra_searcher = kendra_searchers[0]
+else:
+    kendra_searcher = MultiIndexSearcher(kendra_searchers, early_confidence=('VERY_HIGH',))
+
+# Common questions are answered from faq_index.db, built offline with faq_index.py and deployed next to
+# this file. Only questions that aren't in it go to Amazon Kendra. An index older than a week is ignored.
+faq_index = FaqIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'faq_index.db'), max_age=7 * 86400)
+
+# When Amazon Kendra fails, is throttled or is too slow, questions are answered from local_index.db, a
+# small search index built offline with local_search.py and deployed next to this file. It is only
+# opened the first time it is needed.
+local_index = LocalIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_index.db'), max_postings=250)
+
+# Alexa waits 8 seconds for a response, so Kendra has to answer well before that.
+RESPONSE_BUDGET = 6.0
+DEADLINE_MARGIN = 0.5
+
+# When a session starts, the role is assumed and Amazon Kendra is connected to before the greeting is
+# returned, for up to half a second, so the first question doesn't wait for them.
+prewarmer = Prewarmer(min_interval=60, max_wait=0.5)
+prewarmer.add_step("credentials", lambda deadline: credential_provider.get_credentials())
+prewarmer.add_step("kendra", lambda deadline: kendra_searcher.prime(deadline, connect=True))
+
+# Result text is kept here, and session attributes only carry the Kendra result IDs.
+result_store = ResultStore()
+
+# Documents are read a chunk of whole sentences at a time, so Alexa starts speaking sooner and the
+# user says "continue" to hear more. Each document's chunk boundaries are worked out once per container.
+document_chunks = DocumentChunks(max_chars=600, max_documents=256)
+
+# When a document is offered, longer passages from it are fetched in the background, so reading it
+# doesn't wait for Amazon Kendra. Passages are kept per document and question for 15 minutes.
+passage_cache = PassageCache(max_size=128, ttl=900)
+passage_retriever = PassageRetriever(client_factory, passage_cache, KENDRA_INDEXES, page_size=20, max_passages=5, max_workers=4,
+                                     max_wait=0.3)
+
+# Maps each user to their email subscription, so sending an email doesn't scan every subscriber.
+subscription_index = SubscriptionIndex()
+
+# The topic ARN never changes, so it is resolved once per container, by a keep-warm event or the first
+# email, and re-checked every hour.
+topic_resolver = TopicResolver(
+    client_factory,
+    topic_name='DocSupportSNS',
+    topic_arn=None, # optionally set to your topic ARN to check it exists instead of calling create_topic
+    refresh_interval=3600)
+
+# LazyApiClient only imports the SDK's DefaultApiClient, and requests, when the skill calls an Alexa API.
+alexa_api_client = LazyApiClient()
+
+
+def read_profile(profile):
+    # type: (dict) -> tuple
+    """Return the user's given name and email address, read with the Alexa API access token of their request."""
+    from ask_sdk_core.serialize import DefaultSerializer
+    from ask_sdk_model.services import ApiConfiguration, ServiceClientFactory
+    configuration = ApiConfiguration(serializer=DefaultSerializer(), api_client=alexa_api_client,
+                                     authorization_value=profile["ApiAccessToken"], api_endpoint=profile["ApiEndpoint"])
+    service_client = InstrumentedClient(ServiceClientFactory(configuration).get_ups_service(), 'ups')
+    return service_client.get_profile_given_name(), service_client.get_profile_email()
+
+
+# With a queue URL, SendEmailIntentHandler only queues the email and answers the user. email_worker_handler
+# then reads the user's profile, subscribes them if needed, and publishes the email, so Amazon SNS is
+# never on the voice path. Without one, SendEmailIntentHandler does all of that itself.
+EMAIL_QUEUE_URL = None # replace with your Amazon SQS queue URL to send emails asynchronously
+email_queue = SqsEmailQueue(client_factory, EMAIL_QUEUE_URL) if EMAIL_QUEUE_URL else None
+email_worker = EmailWorker(client_factory, topic_resolver, max_attempts=4, base_delay=0.2,
+                           subscription_index=subscription_index, read_profile=read_profile)
+
+# Emails a user asks for within this many seconds are sent together as one digest email on the first
+# turn after the window closes, or when the session ends. Set to 0 to send every email right away.
+EMAIL_DIGEST_WINDOW = 0
+EMAIL_DIGEST_MAX_ITEMS = 5
+
+
+def send_email_job(handler_input, job):
+    # type: (HandlerInput, dict) -> None
+    """Put the email job on the queue, or publish it right away if there is no queue.
+
+    A queued job carries the Alexa API endpoint and access token of the request, which the worker
+    needs to read the user's name and email address.
+    """
+    if email_queue is not None:
+        system = handler_input.request_envelope.context.system
+        job["Profile"] = {"ApiEndpoint": system.api_endpoint, "ApiAccessToken": system.api_access_token}
+        email_queue.send(job)
+    else:
+        publish_email(client_factory.get_client('sns'), topic_resolver.get_topic_arn(), job)
+
+
+def flush_email_digest(handler_input):
+    # type: (HandlerInput) -> None
+    """Send the user's pending digest email, if there is one.
+
+    Each pending email keeps the summary and URI it was promised with, so the digest doesn't depend on
+    this container having seen the results. If sending fails, the digest stays pending.
+    """
+    state = dialog_state(handler_input)
+    digest = state.pending_emails
+    if not digest:
+        return
+    user_id = handler_input.request_envelope.context.system.user.user_id
+    send_email_job(handler_input, make_digest_job(user_id, digest["Name"], digest["Items"]))
+    state.pending_emails = None
+
+
+def find_candidates(query, deadline=None):
+    # type: (str, Deadline) -> list
+    """Return the ranked candidates for the query and save them in the result store."""
+    candidates = faq_index.lookup(query, MAX_CANDIDATES)
+    if candidates is None:
+        try:
+            result_items = kendra_searcher.search(query, deadline)
+        except Exception:
+            # Answer from the local index rather than apologizing, if it has anything for the question.
+            candidates = local_index.search(query, MAX_CANDIDATES)
+            if not candidates:
+                raise
+            logger.warning("Amazon Kendra couldn't answer, using the local index", exc_info=True)
+            count("local_fallbacks")
+        else:
+            candidates = select_candidates(result_items, MAX_CANDIDATES)
+    result_store.put_many(candidates)
+    return candidates
+
+
+def result_key(result):
+    # type: (dict) -> int
+    """Return a short key for the document behind a result, which stays the same when its result ID changes."""
+    source = result.get("DocumentId") or result.get("URI") or result["Text"]
+    return zlib.crc32(source.encode("utf-8"))
+
+
+def resolve_result(state, result_id, deadline=None):
+    # type: (DialogState, str, Deadline) -> dict
+    """Return the result the dialog state points to, or None if it can't be found.
+
+    If the session moved to a container that hasn't seen the result, the last query is run again.
+    A result that was already offered is only used if the new candidates still have its document,
+    so the user never hears or gets emailed a different one. A candidate that wasn't offered yet is
+    taken from the same rank. The state's pointers are updated to the new result IDs.
+    """
+    result = result_store.get(result_id)
+    candidate_ids = state.candidates or []
+    if result is not None or result_id not in candidate_ids:
+        return result
+    
+    try:
+        candidates = find_candidates(state.last_query, deadline)
+    except DeadlineExceeded:
+        logger.warning("Couldn't look up result %s again before the deadline", result_id)
+        return None
+    keys = [result_key(candidate) for candidate in candidates]
+    
+    def same_document(key):
+        return candidates[keys.index(key)] if key is not None and key in keys else None
+    
+    if result_id == state.result_id:
+        result = same_document(state.result_key)
+    elif result_id == state.last_doc_id:
+        result = same_document(state.last_doc_key)
+    else:
+        rank = candidate_ids.index(result_id)
+        result = candidates[rank] if rank < len(candidates) else None
+    if result is None:
+        logger.warning("Result %s isn't among the results for %r anymore", result_id, state.last_query)
+    
+    moved = same_document(state.result_key)
+    if moved is not None:
+        state.result_id = moved["Id"]
+    moved = same_document(state.last_doc_key)
+    if moved is not None:
+        state.last_doc_id = moved["Id"]
+    state.candidates = [candidate["Id"] for candidate in candidates]
+    return result
+
+
+def result_summary(result):
+    # type: (dict) -> str
+    """Return the answer text, or the document title if there is one."""
+    if result["Type"] == 'DOCUMENT' and result["Title"]:
+        return result["Title"]
+    return result["Text"]
+
+
+def offer_output(result):
+    # type: (dict) -> str
+    """Build what the skill says when it offers a result."""
+    if result["Type"] == 'DOCUMENT' and result["Title"]:
+        return "I found a document titled " + result["Title"] + ". Is this what you were looking for? If you're not sure, you can say 'read me an excerpt'."
+    return "I found this: " + result["Text"] + ". Is this what you were looking for?"
+
+
+def excerpt_output(chunk):
+    # type: (Chunk) -> str
+    """Build what the skill says when it reads a chunk of a document."""
+    intro = 'Here is an excerpt from the document:' if chunk.index == 0 else ''
+    text = chunk.text if chunk.text.endswith(('.', '!', '?')) else chunk.text + '.'
+    more = "To hear more, say 'continue'. " if chunk.next_start is not None else ''
+    return (intro +
+        '<audio src="soundbank://soundlibrary/musical/amzn_sfx_electronic_beep_03"/>' + text + 
+        '<audio src="soundbank://soundlibrary/musical/amzn_sfx_electronic_beep_03"/>' +
+        more + 'Is this what you were looking for?')
+
+
+def document_text(state, document, use_passages=True, deadline=None):
+    # type: (DialogState, dict, bool, Deadline) -> tuple
+    """Return the text to read from a document, and whether it is the document's passages about the last query.
+
+    The excerpt from the query result is returned when passages aren't wanted or there are none in time.
+    """
+    document_id = document.get("DocumentId")
+    if use_passages and document_id:
+        passages = passage_retriever.passages(document_id, state.last_query, deadline)
+        if passages:
+            return " ".join(passage.strip() for passage in passages), True
+    return document["Text"], False
+
+
+def read_chunk(state, document, offset=None, deadline=None):
+    # type: (DialogState, dict, int, Deadline) -> Chunk
+    """Return the chunk of the document that contains ``offset``, and remember it as the part read last.
+
+    Without an offset, the document is read from the start, from its passages if there are any. After
+    that the same text is read as long as the offset points into it, so "continue" picks up where
+    the user left off.
+    """
+    if offset is None:
+        text, state.read_passages = document_text(state, document, deadline=deadline)
+    else:
+        text, from_passages = document_text(state, document, bool(state.read_passages), deadline)
+        if from_passages != bool(state.read_passages):
+            # The passages read so far can't be fetched anymore, so start over with the excerpt.
+            logger.warning("Passages of %s are gone, reading its excerpt from the start", document["Id"])
+            state.read_passages = False
+            offset = 0
+    chunk = document_chunks.chunk(document["Id"], text, offset)
+    state.read_offset = chunk.start
+    return chunk
+
 
 class LaunchRequestHandler(AbstractRequestHandler):
     """Handler for Skill Launch."""
+    routes = [("LaunchRequest", None)]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_request_type("LaunchRequest")(handler_input)
@@ -34,11 +335,13 @@ class LaunchRequestHandler(AbstractRequestHandler):
         speak_output = "Welcome to Doc Support. What can I help you with?" 
         reprompt_output = "You can ask me about AWS documentation." # update according to your Amazon Kendra index
         
-        session_attr = handler_input.attributes_manager.session_attributes
-        session_attr["LastQuery"] = "no previous query"
-        session_attr["QueryStatus"] = "none asked"
-        session_attr["QueryCount"] = 0
-        session_attr["LastOutput"] = speak_output
+        state = dialog_state(handler_input)
+        state.transition(LAUNCHED)
+        state.last_query = NO_PREVIOUS_QUERY
+        state.query_count = 0
+        state.last_output = speak_output
+
+        prewarmer.start(Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN))
         
         return (
             handler_input.response_builder
@@ -50,99 +353,90 @@ class LaunchRequestHandler(AbstractRequestHandler):
 
 class CaptureQueryIntentHandler(AbstractRequestHandler):
     """Handler for Hello World Intent."""
+    routes = [("IntentRequest", "CaptureQueryIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_intent_name("CaptureQueryIntent")(handler_input)
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
-        session_attr = handler_input.attributes_manager.session_attributes
-        last_query = session_attr["LastQuery"]
+        state = dialog_state(handler_input)
+        last_query = state.last_query
 
         slots = handler_input.request_envelope.request.intent.slots
-        if session_attr["QueryStatus"] == "asked not answered":
+        if state.status == ASKED_NOT_ANSWERED:
             query = last_query
-        elif session_attr["QueryStatus"] == "new query":
+        elif state.status == NEW_QUERY:
             query = None
         else:
             query = slots["query"].value
             
         if query != last_query:
-            session_attr["QueryCount"] = 0
-            session_attr["QueryStatus"] = "new ask"
+            state.query_count = 0
+            state.transition(NEW_QUESTION)
         
-        if (session_attr["QueryStatus"] == "asked and answered" or query is None):
+        if (state.status == ASKED_AND_ANSWERED or query is None):
             speak_output = "You just asked about" + " " + last_query + ". What are you looking for now?"
-            session_attr["QueryStatus"] = "new ask"
-            session_attr["LastOutput"] = speak_output
+            state.transition(PROMPTED)
+            state.last_output = speak_output
             return (
                 handler_input.response_builder
                     .speak(speak_output)
                     .response
             )
 
-        if session_attr["QueryCount"] > 2:
+        deadline = Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN)
+        if state.status == ASKED_NOT_ANSWERED and state.candidates is not None:
+            # The user said "No", so offer the next candidate from the first query without calling Amazon Kendra again.
+            state.transition(NEXT_RESULT)
+            state.query_count += 1
+        else:
+            try:
+                candidates = find_candidates(query, deadline)
+            except DeadlineExceeded:
+                # The query keeps running and caches its results, so asking again is answered right away.
+                speak_output = "I'm still searching for an answer to that. Please ask me again in a moment."
+                state.last_output = speak_output
+                return (
+                    handler_input.response_builder
+                        .speak(speak_output)
+                        .response
+                )
+            state.candidates = [candidate["Id"] for candidate in candidates]
+            state.query_count = 0
+        
+        candidate = None
+        if state.query_count < len(state.candidates):
+            state.last_query = query
+            candidate = resolve_result(state, state.candidates[state.query_count], deadline)
+        
+        if candidate is None:
             speak_output = "I'm having trouble finding information on your question. Please try asking it another way."
-            session_attr["QueryCount"] = 0
-            session_attr["QueryStatus"] = "new ask"
-            session_attr["LastOutput"] = speak_output
+            state.query_count = 0
+            state.transition(NO_RESULTS)
+            state.last_output = speak_output
             return (
                 handler_input.response_builder
                     .speak(speak_output)
                     .response
             )
         
-        index_id = 'indexID' # replace with your index ID
-        
-        sts_client = boto3.client('sts')
-        assumed_role_object=sts_client.assume_role(RoleArn="<Your AWS resource role ARN>", RoleSessionName="AssumeRoleSession1") # replace with your AWS resource role ARN
-        credentials=assumed_role_object['Credentials']
-        
-        kendra = boto3.client('kendra', 
-                        aws_access_key_id=credentials['AccessKeyId'],
-                        aws_secret_access_key=credentials['SecretAccessKey'],
-                        aws_session_token=credentials['SessionToken'],
-                        region_name='us-east-1') # replace with your index region name
-
-        response = kendra.query(
-            QueryText = query,
-            IndexId = index_id)
-            
-        for query_result in response['ResultItems']:
-            
-            source_uri = query_result['DocumentURI']
-            
-            if session_attr["QueryStatus"] == "asked not answered": 
-                session_attr["QueryStatus"] = "new pass"
-                session_attr["QueryCount"] += 1
-                continue
-                   
-            if session_attr["QueryCount"] == 2:
-                session_attr["QueryCount"] += 1
-                continue
-            
-            if (query_result['Type']=='ANSWER' or query_result['Type']=='QUESTION_ANSWER'): # optionally add QUESTION_ANSWER type
-                answer_text = query_result['DocumentExcerpt']['Text']
-                session_attr["QueryResult"] = answer_text
-                speak_output = "I found this: " + answer_text + ". Is this what you were looking for?"    
-                break
-                
-            if query_result['Type']=='DOCUMENT':
-                document_text = query_result['DocumentExcerpt']['Text']
-                session_attr["LastDocText"] = document_text
-                if 'DocumentTitle' in query_result:
-                    document_title = query_result['DocumentTitle']['Text']
-                    session_attr["QueryResult"] = document_title
-                    speak_output = "I found a document titled " + document_title + ". Is this what you were looking for? If you're not sure, you can say 'read me an excerpt'."
-                else:
-                    session_attr["QueryResult"] = document_text
-                    speak_output = "I found this: " + document_text + ". Is this what you were looking for?"
-                break
+        state.result_id = candidate["Id"]
+        state.result_key = result_key(candidate)
+        if candidate["Type"] == 'DOCUMENT':
+            state.last_doc_id = candidate["Id"]
+            state.last_doc_key = state.result_key
+            state.read_offset = None
+            state.read_passages = None
+            if candidate.get("DocumentId"):
+                # The user may ask to hear an excerpt next, so fetch its passages while they answer.
+                passage_retriever.prefetch(candidate["DocumentId"], query)
+        speak_output = offer_output(candidate)
         
-        session_attr["LastQuery"] = query
-        session_attr["LastSourceURI"] = source_uri
-        session_attr["LastHandler"] = "capture query"
-        session_attr["LastOutput"] = speak_output
+        state.last_handler = CAPTURE_QUERY
+        # RepeatIntentHandler rebuilds the output from result_id, so the result text isn't kept in the session.
+        state.last_output = None
         
         return (
             handler_input.response_builder
@@ -154,23 +448,41 @@ class CaptureQueryIntentHandler(AbstractRequestHandler):
 
 class ReadDocIntentHandler(AbstractRequestHandler):
     """Handler for sending an email"""
+    routes = [("IntentRequest", "ReadDocIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_intent_name("ReadDocIntent")(handler_input)
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
-        session_attr = handler_input.attributes_manager.session_attributes
+        state = dialog_state(handler_input)
         
-        doc_text = session_attr["LastDocText"]
+        if state.last_doc_id is None:
+            speak_output = "I haven't found a document for you yet. What would you like to know about?"
+            state.last_output = speak_output
+            return (
+                handler_input.response_builder
+                    .speak(speak_output)
+                    .ask(speak_output)
+                    .response
+            )
+        
+        deadline = Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN)
+        document = resolve_result(state, state.last_doc_id, deadline)
+        if document is None:
+            speak_output = "Sorry, I can't find that document anymore. Please try asking your question again."
+            state.last_output = speak_output
+            return (
+                handler_input.response_builder
+                    .speak(speak_output)
+                    .response
+            )
         
-        speak_output = ('Here is an excerpt from the document:'
-            '<audio src="soundbank://soundlibrary/musical/amzn_sfx_electronic_beep_03"/>' + doc_text + '.' 
-            '<audio src="soundbank://soundlibrary/musical/amzn_sfx_electronic_beep_03"/>'
-            'Is this what you were looking for?')
+        speak_output = excerpt_output(read_chunk(state, document, deadline=deadline))
         
-        session_attr["LastHandler"] = "read doc"
-        session_attr["LastOutput"] = speak_output
+        state.last_handler = READ_DOC
+        state.last_output = None
         
         return (
             handler_input.response_builder
@@ -179,102 +491,183 @@ class ReadDocIntentHandler(AbstractRequestHandler):
         )
 
 
-class SendEmailIntentHandler(AbstractRequestHandler):
-    """Handler for sending an email"""
+class ContinueReadingIntentHandler(AbstractRequestHandler):
+    """Handler for reading the next chunk of the document."""
+    routes = [("IntentRequest", "ContinueReadingIntent"), ("IntentRequest", "AMAZON.NextIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
-        return ask_utils.is_intent_name("SendEmailIntent")(handler_input)
+        return (ask_utils.is_intent_name("ContinueReadingIntent")(handler_input) or
+                ask_utils.is_intent_name("AMAZON.NextIntent")(handler_input))
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
-        session_attr = handler_input.attributes_manager.session_attributes
-        last_query = session_attr["LastQuery"]
-        query_result = session_attr["QueryResult"]
-        source_uri = session_attr["LastSourceURI"]
+        state = dialog_state(handler_input)
         
-        service_client = handler_input.service_client_factory.get_ups_service()
+        if state.last_doc_id is None or state.read_offset is None:
+            speak_output = "I'm not reading a document right now. What would you like to know about?"
+            state.last_output = speak_output
+            return (
+                handler_input.response_builder
+                    .speak(speak_output)
+                    .ask(speak_output)
+                    .response
+            )
         
-        try:
-            email = service_client.get_profile_email() 
-            name = service_client.get_profile_given_name() 
-        except:
-            session_attr["LastOutput"] = "Please enable first name and email permissions in the Amazon Alexa app."
+        deadline = Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN)
+        document = resolve_result(state, state.last_doc_id, deadline)
+        if document is None:
+            speak_output = "Sorry, I can't find that document anymore. Please try asking your question again."
+            state.last_output = speak_output
             return (
                 handler_input.response_builder
-                    .speak("Please enable first name and email permissions in the Amazon Alexa app.")
-                    .set_card(AskForPermissionsConsentCard(permissions=PERMISSIONS))
+                    .speak(speak_output)
                     .response
             )
         
-        sts_client = boto3.client('sts')
-        assumed_role_object=sts_client.assume_role(RoleArn="<Your AWS resource role ARN>", RoleSessionName="AssumeRoleSession2") # replace with your AWS resource role ARN
-        credentials=assumed_role_object['Credentials']
-                
-        sns = boto3.client('sns',
-                        aws_access_key_id=credentials['AccessKeyId'],
-                        aws_secret_access_key=credentials['SecretAccessKey'],
-                        aws_session_token=credentials['SessionToken'])
+        chunk = read_chunk(state, document, state.read_offset, deadline)
+        if chunk.next_start is None:
+            speak_output = "That's the end of the excerpt. Is this what you were looking for?"
+            state.last_output = speak_output
+        else:
+            speak_output = excerpt_output(read_chunk(state, document, chunk.next_start, deadline))
+            state.last_output = None
         
-        user_id = handler_input.request_envelope.context.system.user.user_id
+        state.last_handler = READ_DOC
         
-        topic_arn_response = sns.create_topic(Name='DocSupportSNS')
-        topic_arn = topic_arn_response['TopicArn']
+        return (
+            handler_input.response_builder
+                .speak(speak_output)
+                .response
+        )
+
+
+def ask_for_permissions(handler_input):
+    # type: (HandlerInput) -> Response
+    """Ask the user to grant the name and email permissions the skill needs to send them emails."""
+    from ask_sdk_model.ui import AskForPermissionsConsentCard
+    speak_output = "Please enable first name and email permissions in the Amazon Alexa app."
+    dialog_state(handler_input).last_output = speak_output
+    return (
+        handler_input.response_builder
+            .speak(speak_output)
+            .set_card(AskForPermissionsConsentCard(permissions=PERMISSIONS))
+            .response
+    )
+
+
+class SendEmailIntentHandler(AbstractRequestHandler):
+    """Handler for sending an email"""
+    routes = [("IntentRequest", "SendEmailIntent")]
+
+    def can_handle(self, handler_input):
+        # type: (HandlerInput) -> bool
+        return ask_utils.is_intent_name("SendEmailIntent")(handler_input)
+
+    def handle(self, handler_input):
+        # type: (HandlerInput) -> Response
+        state = dialog_state(handler_input)
+        last_query = state.last_query
         
-        try:
-            sub_list = sns.list_subscriptions_by_topic(TopicArn=topic_arn)
-            sub_topic_arn = None
-            while sub_topic_arn is None:
-                for sub in sub_list['Subscriptions']:
-                    sub_arn = sub['SubscriptionArn']
-                    sub_attr = sns.get_subscription_attributes(SubscriptionArn=sub_arn)
-                    if sub_attr['Attributes']['FilterPolicy'] == '{"user_id": ["' + user_id + '"]}':
-                        sub_topic_arn = sub_attr['Attributes']['TopicArn']
-                        break
-                try:
-                    sub_list = sns.list_subscriptions_by_topic(TopicArn=sub_list['NextToken'])
-                except:
-                    break
-            
-            sns.publish(
-                TopicArn=sub_topic_arn,
-                Subject='You asked about ' + last_query,
-                Message=('Hi ' + name + ',\n' + 'You asked Doc Support about ' + last_query + '.' 
-                        ' We found this: \n' + query_result +'\n' 
-                        'More information can be found in the following documentation: ' + source_uri + ''),
-                MessageAttributes={
-                    'user_id':{
-                        'DataType': 'String',
-                        'StringValue': user_id
-                    }
-                }
+        if state.result_id is None:
+            speak_output = "I haven't found anything to email you yet. What would you like to know about?"
+            state.last_output = speak_output
+            return (
+                handler_input.response_builder
+                    .speak(speak_output)
+                    .ask(speak_output)
+                    .response
             )
-                
-        except:
-            filter_policy = '{"user_id": ["' + user_id + '"]}'
+        result = resolve_result(state, state.result_id,
+                                Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN))
+        if result is None:
+            speak_output = "Sorry, I can't find that result anymore. Please try asking your question again."
+            state.last_output = speak_output
+            return (
+                handler_input.response_builder
+                    .speak(speak_output)
+                    .response
+            )
+        query_result = result_summary(result)
+        source_uri = result["URI"]
+        
+        stopwatch = Stopwatch()
+        user = handler_input.request_envelope.context.system.user
+        user_id = user.user_id
+        
+        if email_queue is not None:
+            # The email worker reads the profile and checks the subscription, so this turn only needs
+            # to know that the user granted the permissions.
+            name = None
+            subscription = {"Status": CONFIRMED}
+            if user.permissions is None or not user.permissions.consent_token:
+                return ask_for_permissions(handler_input)
+        else:
+            service_client = InstrumentedClient(handler_input.service_client_factory.get_ups_service(), 'ups')
+            try:
+                with stopwatch.time("profile"):
+                    email = service_client.get_profile_email() 
+                    name = service_client.get_profile_given_name() 
+            except:
+                return ask_for_permissions(handler_input)
+            
+            with stopwatch.time("sns_client"):
+                sns = client_factory.get_client('sns')
             
-            sub_response = sns.subscribe(
-                            TopicArn=topic_arn,
-                            Protocol='email',
-                            Endpoint=email,
-                            Attributes={
-                                'FilterPolicy': filter_policy}
-                            )
-            sub_status = sub_response["SubscriptionArn"]
+            with stopwatch.time("topic"):
+                topic_arn = topic_resolver.get_topic_arn()
+            
+            with stopwatch.time("subscription_lookup"):
+                subscription = subscription_index.lookup(user_id)
+                if subscription is None or subscription["Status"] != CONFIRMED:
+                    # The user may have confirmed their subscription since the index was last refreshed.
+                    subscription_index.refresh(sns, topic_arn)
+                    subscription = subscription_index.lookup(user_id)
+        
+        if subscription is None or subscription["Status"] != CONFIRMED:
+            with stopwatch.time("subscribe"):
+                sub_response = sns.subscribe(
+                                TopicArn=topic_arn,
+                                Protocol='email',
+                                Endpoint=email,
+                                Attributes={
+                                    'FilterPolicy': filter_policy_for(user_id)}
+                                )
+            subscription = subscription_index.record_subscription(user_id, sub_response["SubscriptionArn"])
                         
-            if sub_status == 'pending confirmation':
+            if subscription["Status"] == PENDING:
+                logger.info("Email timings: %s", stopwatch.summary())
                 speak_output = ("Please check your inbox and confirm your subscription to the topic." 
                                 "You will only receive emails when you request them from Doc Support." 
                                 "Once you've confirmed, say 'send my email', or come back later and ask your question again.")
-                session_attr["LastOutput"] = speak_output
+                state.last_output = speak_output
                 return (
                     handler_input.response_builder
                         .speak(speak_output)
                         .response
                 )
         
-        speak_output = "Ok. I'm sending you an email with the documentation about your query, " + last_query + ". Would you like to ask something else?"
-        session_attr["LastHandler"] = "email"
-        session_attr["LastOutput"] = speak_output
+        if EMAIL_DIGEST_WINDOW:
+            # Collect the result in the session and send all of them in one email later.
+            digest = state.pending_emails or {"Name": name, "Since": time.time(), "Items": []}
+            digest["Items"].append(make_email_item(last_query, result["Id"], query_result, source_uri))
+            state.pending_emails = digest
+            if (time.time() - digest["Since"] >= EMAIL_DIGEST_WINDOW or
+                    len(digest["Items"]) >= EMAIL_DIGEST_MAX_ITEMS):
+                with stopwatch.time("send"):
+                    flush_email_digest(handler_input)
+            speak_output = "Ok. I'll include the documentation about your query, " + last_query + ", in your email. Would you like to ask something else?"
+        else:
+            with stopwatch.time("send"):
+                send_email_job(handler_input, make_email_job(user_id, name, last_query, result["Id"], query_result, source_uri))
+            speak_output = "Ok. I'm sending you an email with the documentation about your query, " + last_query + ". "
+            if email_queue is not None:
+                speak_output += "If it's your first email from Doc Support, confirm your subscription and it will follow. "
+            speak_output += "Would you like to ask something else?"
+        logger.info("Email timings: %s", stopwatch.summary())
+        
+        state.last_handler = EMAIL
+        state.last_output = speak_output
         
         return (
             handler_input.response_builder
@@ -285,6 +678,8 @@ class SendEmailIntentHandler(AbstractRequestHandler):
 
 class YesNoIntentHandler(AbstractRequestHandler):
     """Handler for Yes or No Intent."""
+    routes = [("IntentRequest", "AMAZON.YesIntent"), ("IntentRequest", "AMAZON.NoIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return (ask_utils.is_intent_name("AMAZON.YesIntent")(handler_input) or
@@ -292,50 +687,76 @@ class YesNoIntentHandler(AbstractRequestHandler):
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
-        session_attr = handler_input.attributes_manager.session_attributes
-        
+        state = dialog_state(handler_input)
         yes = ask_utils.is_intent_name("AMAZON.YesIntent")(handler_input)
-        no = ask_utils.is_intent_name("AMAZON.NoIntent")(handler_input)
+        event = YES_NO_EVENTS.get((state.last_handler, yes))
         
-        if (yes and (session_attr["LastHandler"] == "capture query" or session_attr["LastHandler"] == "read doc")): 
-            speak_output = "Great. I can email you the document or you can ask another question. Which would you like?" 
-            session_attr["QueryStatus"] = "asked and answered"
-            session_attr["QueryCount"] = 0
-            session_attr["LastOutput"] = speak_output
+        if event is None:
+            # Nothing was asked that a yes or no answers, e.g. the user said "yes" before asking a question.
+            speak_output = "What would you like to know about?"
+            state.last_output = speak_output
             return (
                 handler_input.response_builder
                     .speak(speak_output)
+                    .ask(speak_output)
                     .response
             )
-                    
-        if (no and (session_attr["LastHandler"] == "capture query" or session_attr["LastHandler"] == "read doc")): 
-            session_attr["QueryStatus"] = "asked not answered"
-            return CaptureQueryIntentHandler().handle(handler_input)
-        
-        if (yes and session_attr["LastHandler"] == "email"): 
-            session_attr["QueryStatus"] = "new query"
-            return CaptureQueryIntentHandler().handle(handler_input)
         
-        if (no and session_attr["LastHandler"] == "email"):
-            speak_output = "Ok. Goodbye!"
+        if event == ACCEPTED: 
+            speak_output = "Great. I can email you the document or you can ask another question. Which would you like?" 
+            state.transition(ACCEPTED)
+            state.query_count = 0
+            state.last_output = speak_output
             return (
                 handler_input.response_builder
                     .speak(speak_output)
-                    .set_should_end_session(True)
                     .response
             )
+                    
+        if event in (REJECTED, ANOTHER_QUESTION): 
+            state.transition(event)
+            return CaptureQueryIntentHandler().handle(handler_input)
+        
+        flush_email_digest(handler_input)
+        speak_output = "Ok. Goodbye!"
+        return (
+            handler_input.response_builder
+                .speak(speak_output)
+                .set_should_end_session(True)
+                .response
+        )
 
 
 class RepeatIntentHandler(AbstractRequestHandler):
     """Handler for Repeat Intent."""
+    routes = [("IntentRequest", "AMAZON.RepeatIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_intent_name("AMAZON.RepeatIntent")(handler_input)
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
-        session_attr = handler_input.attributes_manager.session_attributes
-        speak_output = session_attr["LastOutput"]
+        state = dialog_state(handler_input)
+        speak_output = state.last_output
+        if speak_output is None:
+            # The last output was built from a result, so build it again from the stored result.
+            reading = state.last_handler == READ_DOC
+            deadline = Deadline.from_context(handler_input.context, RESPONSE_BUDGET, DEADLINE_MARGIN)
+            result = resolve_result(state, state.last_doc_id if reading else state.result_id, deadline)
+            if result is None:
+                speak_output = "Sorry, I don't have anything to repeat. What would you like to know about?"
+                state.last_output = speak_output
+                return (
+                    handler_input.response_builder
+                        .speak(speak_output)
+                        .ask(speak_output)
+                        .response
+                )
+            if reading:
+                speak_output = excerpt_output(read_chunk(state, result, state.read_offset, deadline))
+            else:
+                speak_output = offer_output(result)
         
         return (
                 handler_input.response_builder
@@ -346,6 +767,8 @@ class RepeatIntentHandler(AbstractRequestHandler):
 
 class HelpIntentHandler(AbstractRequestHandler):
     """Handler for Help Intent."""
+    routes = [("IntentRequest", "AMAZON.HelpIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_intent_name("AMAZON.HelpIntent")(handler_input)
@@ -353,7 +776,7 @@ class HelpIntentHandler(AbstractRequestHandler):
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
         speak_output = "You can ask me about AWS documentation. How can I help?" # update according to your Amazon Kendra index
-        session_attr["LastOutput"] = speak_output
+        dialog_state(handler_input).last_output = speak_output
 
         return (
             handler_input.response_builder
@@ -365,6 +788,8 @@ class HelpIntentHandler(AbstractRequestHandler):
 
 class CancelOrStopIntentHandler(AbstractRequestHandler):
     """Single handler for Cancel and Stop Intent."""
+    routes = [("IntentRequest", "AMAZON.CancelIntent"), ("IntentRequest", "AMAZON.StopIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return (ask_utils.is_intent_name("AMAZON.CancelIntent")(handler_input) or
@@ -372,6 +797,7 @@ class CancelOrStopIntentHandler(AbstractRequestHandler):
 
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
+        flush_email_digest(handler_input)
         speak_output = "Goodbye!"
 
         return (
@@ -382,6 +808,8 @@ class CancelOrStopIntentHandler(AbstractRequestHandler):
 
 class FallbackIntentHandler(AbstractRequestHandler):
     """Single handler for Fallback Intent."""
+    routes = [("IntentRequest", "AMAZON.FallbackIntent")]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_intent_name("AMAZON.FallbackIntent")(handler_input)
@@ -391,12 +819,14 @@ class FallbackIntentHandler(AbstractRequestHandler):
         logger.info("In FallbackIntentHandler")
         speech = "Hmm, I'm not sure. You can ask about AWS documentation. What would you like to do?" # update according to your Amazon Kendra index
         reprompt = "I didn't catch that. What can I help you with?"
-        session_attr["LastOutput"] = speech
+        dialog_state(handler_input).last_output = speech
 
         return handler_input.response_builder.speak(speech).ask(reprompt).response
 
 class SessionEndedRequestHandler(AbstractRequestHandler):
     """Handler for Session End."""
+    routes = [("SessionEndedRequest", None)]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_request_type("SessionEndedRequest")(handler_input)
@@ -405,16 +835,35 @@ class SessionEndedRequestHandler(AbstractRequestHandler):
         # type: (HandlerInput) -> Response
 
         # Any cleanup logic goes here.
+        flush_email_digest(handler_input)
 
         return handler_input.response_builder.response
 
 
+class EmailDigestResponseInterceptor(AbstractResponseInterceptor):
+    """Sends the pending digest email on the first turn after its window has closed, whatever the turn is.
+
+    Response interceptors run before the exception handlers, so a failure here is only logged. The
+    turn keeps its response, and the digest stays pending for the next turn.
+    """
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        digest = dialog_state(handler_input).pending_emails
+        if digest and time.time() - digest["Since"] >= EMAIL_DIGEST_WINDOW:
+            try:
+                flush_email_digest(handler_input)
+            except Exception:
+                logger.error("Sending the digest email failed, keeping it for the next turn", exc_info=True)
+
+
 class IntentReflectorHandler(AbstractRequestHandler):
     """The intent reflector is used for interaction model testing and debugging.
     It will simply repeat the intent the user said. You can create custom handlers
     for your intents by defining them above, then also adding them to the request
     handler chain below.
     """
+    routes = [("IntentRequest", None)]
+
     def can_handle(self, handler_input):
         # type: (HandlerInput) -> bool
         return ask_utils.is_request_type("IntentRequest")(handler_input)
@@ -444,6 +893,7 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
     def handle(self, handler_input, exception):
         # type: (HandlerInput, Exception) -> Response
         logger.error(exception, exc_info=True)
+        request_metrics.finish(error=exception)
 
         speak_output = "Sorry, I had trouble doing what you asked. Please try again."
 
@@ -457,13 +907,15 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
 # The SkillBuilder object acts as the entry point for your skill, routing all request and response
 # payloads to the handlers above. Make sure any new handlers or interceptors you've
 # defined are included below. The order matters - they're processed top to bottom.
+# RoutedSkillBuilder finds the handler from the routes each handler declares instead of asking every
+# handler's can_handle in turn. Keep routes and can_handle in sync, or leave routes out to use can_handle.
 
-
-sb = CustomSkillBuilder(api_client=DefaultApiClient())
+sb = RoutedSkillBuilder(api_client=alexa_api_client)
 
 sb.add_request_handler(LaunchRequestHandler())
 sb.add_request_handler(CaptureQueryIntentHandler())
 sb.add_request_handler(ReadDocIntentHandler())
+sb.add_request_handler(ContinueReadingIntentHandler())
 sb.add_request_handler(SendEmailIntentHandler())
 sb.add_request_handler(YesNoIntentHandler())
 sb.add_request_handler(RepeatIntentHandler())
@@ -475,4 +927,74 @@ sb.add_request_handler(IntentReflectorHandler()) # make sure IntentReflectorHand
 
 sb.add_exception_handler(CatchAllExceptionHandler())
 
-lambda_handler = sb.lambda_handler()
+sb.add_global_request_interceptor(MetricsRequestInterceptor(request_metrics))
+sb.add_global_request_interceptor(DialogStateRequestInterceptor())
+sb.add_global_response_interceptor(EmailDigestResponseInterceptor()) # before the dialog state is saved
+sb.add_global_response_interceptor(DialogStateResponseInterceptor())
+sb.add_global_response_interceptor(MetricsResponseInterceptor(request_metrics))
+
+skill_handler = sb.lambda_handler()
+
+# Questions to run through Amazon Kendra on each warm-up, so the query cache has their results.
+# A warm-up event can list its own questions in "queries" instead.
+WARMUP_QUERIES = [] # add your most popular questions
+WARMUP_QUERY_LIMIT = 10
+
+
+def warm_clients(event, context):
+    # type: (dict, object) -> None
+    """Build the clients the next requests will use, and open a connection to Amazon Kendra."""
+    kendra_searcher.prime(Deadline.from_context(context, RESPONSE_BUDGET, DEADLINE_MARGIN), connect=True)
+    client_factory.get_client('sns')
+
+
+def warm_queries(event, context):
+    # type: (dict, object) -> None
+    """Put the results of the most popular questions in the query cache, and open a connection to Amazon Kendra."""
+    for query in (event.get("queries") or WARMUP_QUERIES)[:WARMUP_QUERY_LIMIT]:
+        kendra_searcher.search(query, Deadline.from_context(context, RESPONSE_BUDGET, DEADLINE_MARGIN))
+
+
+# Scheduled warm-up events prime the container instead of going to the skill.
+warmer = Warmer(request_metrics)
+warmer.add_step("credentials", lambda event, context: credential_provider.get_credentials())
+warmer.add_step("clients", warm_clients)
+warmer.add_step("topic", lambda event, context: topic_resolver.get_topic_arn())
+warmer.add_step("queries", warm_queries)
+warmer.add_step("local_index", lambda event, context: local_index.available())
+
+
+def lambda_handler(event, context):
+    """Entry point for the skill's Lambda function."""
+    if is_warmup_event(event):
+        return warmer.warm(event, context)
+    return skill_handler(event, context)
+
+
+def email_worker_handler(event, context):
+    """Entry point for the email worker Lambda function, triggered by the SQS email queue.
+
+    Failed jobs are reported back as batch item failures, so SQS only delivers those again.
+    """
+    request_metrics.start("EmailWorker")
+    records = []
+    jobs = []
+    for record in event.get("Records", []):
+        try:
+            job = json.loads(record["body"])
+        except (KeyError, TypeError, ValueError):
+            job = None
+        if not isinstance(job, dict) or "JobId" not in job:
+            # Delivering the message again can't fix it, so it is dropped instead of failing the batch.
+            logger.error("Skipping malformed email job in SQS message %s", record.get("messageId"))
+            continue
+        records.append(record)
+        jobs.append(job)
+    failed_ids = set(job["JobId"] for job in email_worker.process(jobs))
+    request_metrics.finish()
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": record["messageId"]}
+            for record, job in zip(records, jobs) if job["JobId"] in failed_ids
+        ]
+    }
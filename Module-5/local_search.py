@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# A small local search index, for answering when Amazon Kendra fails or is too slow.
+# It is built offline from a snapshot of document titles and excerpts, scores passages with BM25,
+# and is opened the first time the skill needs it.
+#
+# Build the index from the Module-5 folder:
+#   python local_search.py --snapshot snapshot.jsonl --output local_index.db
+# Each line of the snapshot is a JSON object with "Text", and optionally "Title", "URI", "DocumentId" and "Id".
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from array import array
+from collections import defaultdict
+
+from kendra_search import KendraResult, normalize_query
+from metrics import count
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Version of the file layout, which the skill checks before using a file.
+FORMAT = 1
+
+STOPWORDS = frozenset("""a an and are as at be but by can do does for from how i if in into is it its me my
+of on or so that the their then there these this to was what when where which who why will with you your""".split())
+
+
+def tokenize(text):
+    # type: (str) -> list
+    """Return the words of ``text`` that are worth searching for, lower-cased and without plural "s"."""
+    words = []
+    for word in normalize_query(text).split():
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+def build_local_index(path, passages, k1=1.2, b=0.75, title_weight=2, max_postings=1000):
+    # type: (str, iter, float, float, int, int) -> dict
+    """Write a BM25 index of ``passages`` (dicts with "Text" and optional "Title", "URI", "DocumentId", "Id") to ``path``.
+
+    A term's BM25 weight in a passage doesn't depend on the question, so it is worked out here. Each
+    term keeps its ``max_postings`` best postings, stored as two arrays, passage numbers and weights,
+    ordered from the highest weight down, so a search can read just the best postings of each term.
+    """
+    start = time.time()
+    postings = defaultdict(list)
+    lengths = array('I')
+    results = []
+    for number, passage in enumerate(passages):
+        title = passage.get("Title") or ""
+        words = tokenize(title) * title_weight + tokenize(passage["Text"])
+        frequencies = {}
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+        for word, frequency in frequencies.items():
+            postings[word].append((number, frequency))
+        lengths.append(len(words))
+        results.append(json.dumps([passage.get("Id") or "local-%d" % number, passage.get("Type") or 'DOCUMENT', passage["Text"],
+                                   title or None, passage.get("URI"), passage.get("DocumentId")], separators=(',', ':')))
+
+    passage_count = len(lengths)
+    average_length = float(sum(lengths)) / passage_count if passage_count else 0.0
+    meta = {"format": FORMAT, "version": time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(start)), "built_at": start,
+            "passages": passage_count, "terms": len(postings), "k1": k1, "b": b, "max_postings": max_postings}
+
+    def term_rows():
+        for term, entries in postings.items():
+            idf = math.log(1.0 + (passage_count - len(entries) + 0.5) / (len(entries) + 0.5))
+            weighted = heapq.nlargest(max_postings, (
+                (idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * lengths[number] / average_length)), number)
+                for number, frequency in entries))
+            yield (term, len(entries), array('I', [number for _, number in weighted]).tobytes(),
+                   array('f', [weight for weight, _ in weighted]).tobytes())
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.local_index_', suffix='.db', dir=directory)
+    os.close(handle)
+    try:
+        db = sqlite3.connect(temp_path)
+        try:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+            db.execute("CREATE TABLE terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL, passages BLOB NOT NULL, weights BLOB NOT NULL) WITHOUT ROWID")
+            db.execute("CREATE TABLE passages (number INTEGER PRIMARY KEY, result TEXT NOT NULL)")
+            db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [(key, json.dumps(value)) for key, value in meta.items()])
+            db.executemany("INSERT INTO terms (term, df, passages, weights) VALUES (?, ?, ?, ?)", term_rows())
+            db.executemany("INSERT INTO passages (number, result) VALUES (?, ?)", enumerate(results))
+            db.commit()
+            db.execute("VACUUM")
+        finally:
+            db.close()
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    meta["build_seconds"] = time.time() - start
+    return meta
+
+
+class LocalIndex(object):
+    """Searches the passages in a file written by ``build_local_index``, for when Amazon Kendra can't answer.
+
+    The file is opened read-only and memory-mapped on the first search, so containers that never
+    need it don't pay for it. Each query word reads at most ``max_postings`` of its best postings,
+    and words found in more than ``common_fraction`` of the passages are skipped when the question
+    has rarer words, which keeps a search under a millisecond even in a large index.
+    """
+    def __init__(self, path, max_postings=250, common_fraction=0.1, mmap_size=256 * 1024 * 1024):
+        # type: (str, int, float, int) -> None
+        self.path = path
+        self.max_postings = max_postings
+        self.common_fraction = common_fraction
+        self.mmap_size = mmap_size
+        self.meta = {}
+        self.stats = {"searches": 0, "empty": 0}
+
+        self._lock = threading.Lock()
+        self._db = None
+        self._opened = False
+
+    def available(self):
+        # type: () -> bool
+        """Return True if there is a usable index file, opening it if it hasn't been opened yet."""
+        with self._lock:
+            return self._connect() is not None
+
+    def search(self, query, limit=3):
+        # type: (str, int) -> list
+        """Return up to ``limit`` results for the question, best first, as ``KendraResult`` objects."""
+        words = set(tokenize(query))
+        with self._lock:
+            db = self._connect()
+            if db is None or not words:
+                return []
+            self.stats["searches"] += 1
+            size = 4 * self.max_postings
+            rows = [row for row in (db.execute("SELECT df, substr(passages, 1, ?), substr(weights, 1, ?) FROM terms WHERE term = ?",
+                                               (size, size, word)).fetchone() for word in words) if row is not None]
+            rows.sort(key=lambda row: row[0])
+            common = self.common_fraction * self.meta.get("passages", 0)
+            if rows and rows[0][0] <= common:
+                rows = [row for row in rows if row[0] <= common]
+
+            scores = {}
+            for _, passages, weights in rows:
+                numbers = array('I')
+                numbers.frombytes(passages)
+                values = array('f')
+                values.frombytes(weights)
+                if not scores:
+                    scores = dict(zip(numbers, values))
+                    continue
+                get = scores.get
+                for number, weight in zip(numbers, values):
+                    scores[number] = get(number, 0.0) + weight
+            if not scores:
+                self.stats["empty"] += 1
+                count("local_search_misses")
+                return []
+            best = heapq.nlargest(limit, scores, key=scores.get)
+            rows = dict(db.execute("SELECT number, result FROM passages WHERE number IN (%s)" % ','.join('?' * len(best)), best))
+        count("local_search_hits")
+        return [KendraResult(*json.loads(rows[number])) for number in best]
+
+    def _connect(self):
+        if self._opened:
+            return self._db
+        self._opened = True
+        if not os.path.exists(self.path):
+            logger.info("No local search index at %s", self.path)
+            return None
+        try:
+            uri = 'file:%s?mode=ro&immutable=1' % urllib.parse.quote(os.path.abspath(self.path))
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            db.execute("PRAGMA mmap_size = %d" % int(self.mmap_size))
+            self.meta = dict((key, json.loads(value)) for key, value in db.execute("SELECT key, value FROM meta"))
+        except sqlite3.Error:
+            logger.warning("Could not open the local search index at %s", self.path, exc_info=True)
+            return None
+        if self.meta.get("format") != FORMAT:
+            logger.warning("Ignoring the local search index at %s, it has format %r instead of %d", self.path, self.meta.get("format"), FORMAT)
+            db.close()
+            return None
+        logger.info("Opened local search index version %s with %d passages", self.meta.get("version"), self.meta.get("passages", 0))
+        self._db = db
+        return db
+
+
+def read_snapshot(path):
+    # type: (str) -> iter
+    """Yield the passages of a snapshot file with one JSON object per line."""
+    with open(path) as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the local search index the Doc Support skill falls back to.')
+    parser.add_argument('--snapshot', required=True, help='JSON lines file with the passages to index')
+    parser.add_argument('--output', default='local_index.db', help='file to write')
+    args = parser.parse_args()
+
+    meta = build_local_index(args.output, read_snapshot(args.snapshot))
+    print('Indexed %d passages and %d terms in %.1f s into %s (%d bytes)' % (
+        meta["passages"], meta["terms"], meta["build_seconds"], args.output, os.path.getsize(args.output)))
+
+
+if __name__ == '__main__':
+    main()
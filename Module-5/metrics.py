@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# Timing helpers for finding out where the time goes inside a single request.
+# MetricsRecorder writes one CloudWatch embedded metric format (EMF) log line per request, with the
+# time spent in handler dispatch and in every AWS call, so CloudWatch can chart them without any
+# extra API calls from the skill.
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import ask_sdk_core.utils as ask_utils
+from ask_sdk_core.dispatch_components import AbstractRequestInterceptor, AbstractResponseInterceptor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The metrics of the request being handled. Code running on another thread for the request
+# (such as a Kendra query on an executor) has to be started with a copy of the caller's context.
+_current = contextvars.ContextVar("doc_support_request_metrics", default=None)
+
+
+class Stopwatch(object):
+    """Records how many milliseconds each named step of a request takes."""
+    def __init__(self):
+        # type: () -> None
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def time(self, name):
+        # type: (str) -> None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000.0
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def summary(self):
+        # type: () -> str
+        """Return the timings as one line, e.g. ``profile=12.3ms publish=40.1ms total=52.4ms``."""
+        parts = ["%s=%.1fms" % (name, elapsed) for name, elapsed in self.timings.items()]
+        parts.append("total=%.1fms" % sum(self.timings.values()))
+        return " ".join(parts)
+
+
+class RequestMetrics(object):
+    """Timings (in milliseconds) and counts recorded while handling one request."""
+    def __init__(self, name, cold_start):
+        # type: (str, bool) -> None
+        self.name = name
+        self.cold_start = cold_start
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+        self.properties = {}
+        self.overhead = 0.0
+        self.closed = False
+
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    def add_timing(self, name, milliseconds):
+        # type: (str, float) -> None
+        with self._lock:
+            if not self.closed:
+                self.timings[name] = self.timings.get(name, 0.0) + milliseconds
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def add_count(self, name, value=1):
+        # type: (str, int) -> None
+        with self._lock:
+            if not self.closed:
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def cache_result(self):
+        # type: () -> str
+        """Return "faq" for answers from the FAQ index, "hit" if every Kendra cache lookup hit, "miss" if any missed,
+        or "none" without lookups."""
+        if self.counts.get("faq_hits"):
+            return "faq"
+        if self.counts.get("kendra_cache_misses"):
+            return "miss"
+        if self.counts.get("kendra_cache_hits"):
+            return "hit"
+        return "none"
+
+    def to_emf(self, namespace):
+        # type: (str) -> dict
+        """Return the metrics as an embedded metric format record."""
+        record = OrderedDict()
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [["Intent", "ColdStart"], ["Intent", "CacheHit"]],
+                "Metrics": ([{"Name": name, "Unit": "Milliseconds"} for name in self.timings] +
+                            [{"Name": name, "Unit": "Count"} for name in self.counts if name not in self.timings]),
+            }],
+        }
+        record["Intent"] = self.name
+        record["ColdStart"] = "cold" if self.cold_start else "warm"
+        record["CacheHit"] = self.cache_result()
+        for name, milliseconds in self.timings.items():
+            record[name] = round(milliseconds, 3)
+        record["Calls"] = dict((name, count) for name, count in self.counts.items() if name in self.timings and name != "dispatch")
+        for name, count in self.counts.items():
+            if name not in self.timings:
+                record[name] = count
+        record["MetricsOverheadMs"] = round(self.overhead * 1000.0, 3)
+        record.update(self.properties)
+        return record
+
+
+def current_metrics():
+    # type: () -> RequestMetrics
+    """Return the metrics of the request being handled, or None outside a request."""
+    return _current.get()
+
+
+@contextmanager
+def timed(name):
+    # type: (str) -> None
+    """Add the time spent in the ``with`` block to the current request's metrics, if there is a request."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        metrics.add_timing(name, (end - start) * 1000.0)
+        metrics.overhead += time.perf_counter() - end
+
+
+def count(name, value=1):
+    # type: (str, int) -> None
+    """Add to a count in the current request's metrics, if there is a request."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_count(name, value)
+
+
+class InstrumentedClient(object):
+    """Wraps a boto3 or Alexa service client and times each API call as ``<service>.<operation>``.
+
+    Everything else is passed through to the client, so it can be used in place of the client.
+    """
+    # Client attributes that aren't API calls.
+    PASSTHROUGH = frozenset(['meta', 'exceptions', 'can_paginate', 'get_paginator', 'get_waiter', 'generate_presigned_url'])
+
+    def __init__(self, client, service_name):
+        # type: (object, str) -> None
+        self._client = client
+        self._service_name = service_name
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or name in self.PASSTHROUGH or not callable(attribute):
+            return attribute
+        metric_name = self._service_name + "." + name
+
+        def call(*args, **kwargs):
+            with timed(metric_name):
+                return attribute(*args, **kwargs)
+        # Keep the wrapper, so later calls don't build it again.
+        self.__dict__[name] = call
+        return call
+
+
+class MetricsRecorder(object):
+    """Collects the metrics of each request and writes them as one embedded metric format JSON line.
+
+    The first request a container handles is reported as a cold start. Lines are written to stdout,
+    where Lambda sends them to CloudWatch Logs, unless another ``emit`` function is given.
+    ``stats["overhead_ms"]`` is the total time spent recording and writing metrics.
+    """
+    def __init__(self, namespace='DocSupport', emit=None, enabled=True):
+        # type: (str, object, bool) -> None
+        self.namespace = namespace
+        self.emit = emit or self._write
+        self.enabled = enabled
+        self.stats = {"requests": 0, "overhead_ms": 0.0}
+
+        self._cold_start = True
+
+    @property
+    def cold_start(self):
+        # type: () -> bool
+        """True until the container's first request has been recorded."""
+        return self._cold_start
+
+    def start(self, name):
+        # type: (str) -> RequestMetrics
+        """Start recording a request, which becomes the current request of this context."""
+        cold_start = self._cold_start
+        self._cold_start = False
+        if not self.enabled:
+            return None
+        metrics = RequestMetrics(name, cold_start)
+        _current.set(metrics)
+        return metrics
+
+    def finish(self, error=None):
+        # type: (Exception) -> dict
+        """Finish the current request and write its metrics, and return the record that was written."""
+        metrics = _current.get()
+        if metrics is None:
+            return None
+        start = time.perf_counter()
+        _current.set(None)
+        metrics.add_timing("dispatch", (start - metrics._started) * 1000.0)
+        if error is not None:
+            metrics.add_count("errors")
+            metrics.properties["Error"] = type(error).__name__
+        metrics.closed = True
+        metrics.overhead += time.perf_counter() - start
+        record = metrics.to_emf(self.namespace)
+        self.emit(json.dumps(record))
+        self.stats["requests"] += 1
+        self.stats["overhead_ms"] += (metrics.overhead + time.perf_counter() - start) * 1000.0
+        return record
+
+    @staticmethod
+    def _write(line):
+        sys.stdout.write(line + "\n")
+
+
+def request_name(handler_input):
+    # type: (HandlerInput) -> str
+    """Return the intent name of an intent request, or the request type of any other request."""
+    request_type = ask_utils.get_request_type(handler_input)
+    if request_type == "IntentRequest":
+        return ask_utils.get_intent_name(handler_input)
+    return request_type
+
+
+class MetricsRequestInterceptor(AbstractRequestInterceptor):
+    """Starts recording metrics before the request is dispatched to its handler."""
+    def __init__(self, recorder):
+        # type: (MetricsRecorder) -> None
+        self.recorder = recorder
+
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        metrics = self.recorder.start(request_name(handler_input))
+        if metrics is not None:
+            request_id = getattr(handler_input.context, 'aws_request_id', None)
+            if request_id:
+                metrics.properties["RequestId"] = request_id
+
+
+class MetricsResponseInterceptor(AbstractResponseInterceptor):
+    """Writes the request's metrics after its handler has returned.
+
+    Response interceptors don't run when a handler raises, so the exception handler calls
+    ``MetricsRecorder.finish`` itself.
+    """
+    def __init__(self, recorder):
+        # type: (MetricsRecorder) -> None
+        self.recorder = recorder
+
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        self.recorder.finish()
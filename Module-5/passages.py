@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# Longer passages from a document, for ReadDocIntentHandler to read instead of the short excerpt
+# that came with the query result.
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from kendra_search import normalize_query, _submit
+from metrics import count
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class PassageCache(object):
+    """In-process cache of document passages with a time-to-live and least-recently-used eviction.
+
+    Entries are keyed by document ID and the normalized query text, and are shared by every session
+    that lands on the same warm container.
+    """
+    def __init__(self, max_size=128, ttl=900):
+        # type: (int, int) -> None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(document_id, query):
+        # type: (str, str) -> tuple
+        return (document_id, normalize_query(query))
+
+    def get(self, document_id, query):
+        # type: (str, str) -> list
+        """Return the cached passages, or None if they are missing or expired."""
+        key = self.make_key(document_id, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, document_id, query, passages):
+        # type: (str, str, list) -> None
+        """Store the passages, evicting the least recently used entries if the cache is full."""
+        key = self.make_key(document_id, query)
+        with self._lock:
+            self._entries[key] = (time.time(), passages)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PassageRetriever(object):
+    """Fetches the passages of one document that are relevant to a query, through the passage cache.
+
+    Passages come from the Amazon Kendra Retrieve API, which clients have from boto3 1.26.159. Only the
+    passages from the wanted document are kept, and the indexes are tried in order until one has
+    passages from it. Older clients have no passages to offer, because a regular query would only
+    return the excerpt the caller already has, so once the first fetch finds no Retrieve API, nothing
+    more is fetched and every call returns an empty list.
+
+    ``prefetch`` fetches passages in the background, so a later ``passages`` call for the same
+    document and query only waits for the part of the fetch that is still running, and for at most
+    ``max_wait`` seconds of the turn's deadline. After that the caller reads the excerpt instead.
+    """
+    def __init__(self, client_factory, passage_cache, indexes, page_size=20, max_passages=5, max_workers=2,
+                 max_wait=0.3):
+        # type: (object, PassageCache, list, int, int, int, float) -> None
+        self.client_factory = client_factory
+        self.passage_cache = passage_cache
+        self.indexes = indexes
+        self.page_size = page_size
+        self.max_passages = max_passages
+        self.max_wait = max_wait
+        self.stats = {"fetches": 0, "prefetches": 0, "failures": 0, "timeouts": 0}
+
+        # None until a client has been asked, then whether it has the Retrieve API.
+        self._supported = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def passages(self, document_id, query, deadline=None):
+        # type: (str, str, Deadline) -> list
+        """Return the passages of the document for the query, or an empty list if there are none in time."""
+        if self._supported is False:
+            return []
+        passages = self.passage_cache.get(document_id, query)
+        if passages is not None:
+            count("passage_cache_hits")
+            return passages
+        count("passage_cache_misses")
+
+        if deadline is None:
+            future = self._in_flight_fetch(document_id, query)
+            return future.result() if future is not None else self._fetch(document_id, query)
+        try:
+            return self._start(document_id, query).result(timeout=min(deadline.remaining(), self.max_wait))
+        except FutureTimeoutError:
+            self._count("timeouts")
+            logger.warning("Passages for %s weren't ready in time, reading the excerpt", document_id)
+            return []
+
+    def prefetch(self, document_id, query):
+        # type: (str, str) -> None
+        """Start fetching the passages in the background, unless they are cached or already being fetched."""
+        if self._supported is not False and self.passage_cache.get(document_id, query) is None:
+            self._count("prefetches")
+            self._start(document_id, query)
+
+    def _in_flight_fetch(self, document_id, query):
+        with self._lock:
+            return self._in_flight.get(PassageCache.make_key(document_id, query))
+
+    def _start(self, document_id, query):
+        key = PassageCache.make_key(document_id, query)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = _submit(self._executor, self._fetch, document_id, query)
+            self._in_flight[key] = future
+        # Outside the lock, because the callback runs right away if the fetch has already finished.
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _fetch(self, document_id, query):
+        self._count("fetches")
+        passages = []
+        try:
+            for index_id, region_name in self.indexes:
+                kendra = self.client_factory.get_client('kendra', region_name=region_name)
+                self._supported = hasattr(kendra, 'retrieve')
+                if not self._supported:
+                    logger.info("The Kendra client has no Retrieve API, so documents are read from their excerpts")
+                    return []
+                passages = self._retrieve(kendra, index_id, document_id, query)
+                if passages:
+                    break
+        except Exception:
+            # The caller falls back to the excerpt it already has, and the next call tries again.
+            self._count("failures")
+            logger.warning("Could not fetch passages for %s", document_id, exc_info=True)
+            return []
+        self.passage_cache.put(document_id, query, passages)
+        return passages
+
+    def _retrieve(self, kendra, index_id, document_id, query):
+        response = kendra.retrieve(IndexId=index_id, QueryText=query, PageSize=self.page_size)
+        passages = [item['Content'] for item in response['ResultItems'] if item.get('DocumentId') == document_id]
+        return passages[:self.max_passages]
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
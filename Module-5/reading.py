@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Reading long documents a piece at a time.
+# A document is split into chunks that end at a sentence boundary and stay under a size budget, so
+# Alexa can start speaking the first chunk right away and the user can say "continue" to hear the next.
+import bisect
+import logging
+import re
+import threading
+
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# A sentence ends at ".", "!" or "?", possibly followed by closing quotes or brackets, and whitespace.
+SENTENCE_END = re.compile(r'[.!?]["\')\]]*\s+')
+
+# One chunk of a document. ``start`` is its offset in the text, and ``next_start`` the offset of the
+# next chunk, or None for the last chunk.
+Chunk = namedtuple('Chunk', ['index', 'count', 'start', 'text', 'next_start'])
+
+
+def chunk_starts(text, max_chars):
+    # type: (str, int) -> list
+    """Return the offsets where the chunks of ``text`` start.
+
+    Chunks hold as many whole sentences as fit in ``max_chars`` characters. A sentence that is longer
+    than that on its own is split at the last space that fits, or at ``max_chars`` if there is none.
+    """
+    ends = [match.end() for match in SENTENCE_END.finditer(text)]
+    if not ends or ends[-1] != len(text):
+        ends.append(len(text))
+
+    starts = [0]
+    start = fits = 0
+    for end in ends:
+        while end - start > max_chars:
+            if fits > start:
+                start = fits
+            else:
+                space = text.rfind(' ', start + 1, start + max_chars)
+                start = space + 1 if space > start else start + max_chars
+            starts.append(start)
+        fits = end
+    return starts
+
+
+class DocumentChunks(object):
+    """Chunk boundaries of the documents read recently, computed once per document and container.
+
+    Only the start offsets are kept, so a chunk is a slice of the document text the result store
+    already holds. Boundaries are keyed by document ID and text length, so a document whose text
+    changes is split again.
+    """
+    def __init__(self, max_chars=600, max_documents=256):
+        # type: (int, int) -> None
+        self.max_chars = max_chars
+        self.max_documents = max_documents
+        self.stats = {"hits": 0, "misses": 0}
+
+        self._lock = threading.Lock()
+        self._starts = OrderedDict()
+
+    def starts(self, doc_id, text):
+        # type: (str, str) -> list
+        """Return the offsets where the chunks of the document start."""
+        key = (doc_id, len(text))
+        with self._lock:
+            starts = self._starts.get(key)
+            if starts is not None:
+                self._starts.move_to_end(key)
+                self.stats["hits"] += 1
+                return starts
+            self.stats["misses"] += 1
+
+        starts = chunk_starts(text, self.max_chars)
+        with self._lock:
+            self._starts[key] = starts
+            while len(self._starts) > self.max_documents:
+                self._starts.popitem(last=False)
+        return starts
+
+    def chunk(self, doc_id, text, offset=0):
+        # type: (str, str, int) -> Chunk
+        """Return the chunk of the document that contains ``offset``."""
+        starts = self.starts(doc_id, text)
+        index = max(0, bisect.bisect_right(starts, offset or 0) - 1)
+        next_start = starts[index + 1] if index + 1 < len(starts) else None
+        end = next_start if next_start is not None else len(text)
+        return Chunk(index, len(starts), starts[index], text[starts[index]:end].strip(), next_start)
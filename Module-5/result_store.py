@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Compact store for the Amazon Kendra results the skill has offered.
+# Session attributes only carry result IDs, and handlers look the text up here when they need it.
+import json
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ResultStore(object):
+    """Results keyed by Kendra result ID, held in container memory with a local SQLite file as fallback.
+
+    The most recently used results are kept in memory. Results evicted from memory are written to
+    ``path`` (by default in the Lambda ``/tmp`` directory), so they can still be read back on the same
+    container, and only the ``max_disk_items`` most recently written ones are kept there. Storing
+    results that fit in memory never touches the file. If the file cannot be used, the store keeps
+    working from memory only.
+    """
+    def __init__(self, path='/tmp/doc_support_results.db', max_memory_items=1024, max_disk_items=10000):
+        # type: (str, int, int) -> None
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "spills": 0}
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._db = None
+        self._db_failed = False
+
+    def put(self, result):
+        # type: (dict) -> str
+        """Store a result (a dict, or anything ``dict()`` accepts, with an ``Id``) and return its ID."""
+        self.put_many([result])
+        return result["Id"]
+
+    def put_many(self, results):
+        # type: (list) -> None
+        """Store several results at once, with at most a single write to the fallback file."""
+        with self._lock:
+            evicted = []
+            for result in results:
+                evicted.extend(self._remember(result["Id"], result))
+            self._spill(evicted)
+
+    def get(self, result_id):
+        # type: (str) -> dict
+        """Return the result with this ID, or None if it is not in memory or in the fallback file."""
+        if result_id is None:
+            return None
+        with self._lock:
+            result = self._memory.get(result_id)
+            if result is not None:
+                self._memory.move_to_end(result_id)
+                self.stats["memory_hits"] += 1
+                return result
+
+            db = self._connect()
+            if db is not None:
+                try:
+                    row = db.execute("SELECT body FROM results WHERE id = ?", (result_id,)).fetchone()
+                except sqlite3.Error:
+                    logger.warning("Could not read results from %s", self.path, exc_info=True)
+                    row = None
+                if row is not None:
+                    result = json.loads(row[0])
+                    self._spill(self._remember(result_id, result))
+                    self.stats["disk_hits"] += 1
+                    return result
+
+            self.stats["misses"] += 1
+            return None
+
+    def _remember(self, result_id, result):
+        # Returns the results that no longer fit in memory.
+        self._memory[result_id] = result
+        self._memory.move_to_end(result_id)
+        evicted = []
+        while len(self._memory) > self.max_memory_items:
+            evicted.append(self._memory.popitem(last=False))
+        return evicted
+
+    def _spill(self, evicted):
+        db = self._connect() if evicted else None
+        if db is None:
+            return
+        try:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO results (id, body) VALUES (?, ?)",
+                               [(result_id, json.dumps(dict(result))) for result_id, result in evicted])
+                # Replaced rows get a new rowid, so the lowest rowids are the results written longest ago.
+                db.execute("DELETE FROM results WHERE rowid <= (SELECT MAX(rowid) FROM results) - ?", (self.max_disk_items,))
+            self.stats["spills"] += len(evicted)
+        except sqlite3.Error:
+            logger.warning("Could not write results to %s", self.path, exc_info=True)
+
+    def _connect(self):
+        if self._db is None and not self._db_failed:
+            try:
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS results (id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+            except sqlite3.Error:
+                logger.warning("Result store file %s is not usable, keeping results in memory only", self.path, exc_info=True)
+                self._db = None
+                self._db_failed = True
+        return self._db
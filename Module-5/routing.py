@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Request routing for the Doc Support skill.
+# The SDK asks every handler's can_handle in registration order until one accepts the request.
+# IntentRouter looks the request type and intent name up in an index built once per container instead,
+# and only calls can_handle for handlers that don't declare the requests they handle.
+import importlib
+import json
+import logging
+
+from ask_sdk_core.handler_input import HandlerInput
+from ask_sdk_core.skill import CustomSkill
+from ask_sdk_core.skill_builder import CustomSkillBuilder
+from ask_sdk_model import RequestEnvelope, Request, Intent
+from ask_sdk_runtime.dispatch_components import GenericRequestMapper
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def request_key(handler_input):
+    # type: (HandlerInput) -> tuple
+    """Return ``(request type, intent name)`` for a request, with None as the intent name of requests without an intent."""
+    request = handler_input.request_envelope.request
+    intent = getattr(request, 'intent', None)
+    return (request.object_type, intent.name if intent is not None else None)
+
+
+def handler_routes(handler):
+    # type: (AbstractRequestHandler) -> list
+    """Return the ``(request type, intent name)`` pairs a handler declares in its ``routes`` attribute, or None.
+
+    An intent name of None matches every request of that type. Handlers without ``routes`` are
+    routed by calling their ``can_handle``.
+    """
+    return getattr(handler, 'routes', None)
+
+
+class IntentRouter(GenericRequestMapper):
+    """Request mapper that finds the handler for a request with a dictionary lookup.
+
+    For every declared ``(request type, intent name)`` pair, and for every request type, the index
+    holds the handler chains that could accept such a request, in registration order, up to the first
+    one that declares it. Dispatching walks that short list: handlers without ``routes`` are asked with
+    ``can_handle`` as before, and the first handler that declares the request is picked without asking.
+    The handler picked is always the one the SDK's linear search would pick, as long as each handler's
+    ``routes`` match its ``can_handle``.
+    """
+    def __init__(self, request_handler_chains):
+        # type: (list) -> None
+        GenericRequestMapper.__init__(self, request_handler_chains)
+        self._build_index()
+
+    def add_request_handler_chain(self, request_handler_chain):
+        GenericRequestMapper.add_request_handler_chain(self, request_handler_chain)
+        self._index = None
+
+    def get_request_handler_chain(self, handler_input):
+        # type: (HandlerInput) -> GenericRequestHandlerChain
+        if self._index is None:
+            self._build_index()
+        request_type, intent_name = request_key(handler_input)
+        candidates = self._index.get((request_type, intent_name))
+        if candidates is None:
+            candidates = self._by_type.get(request_type, self._unrouted)
+        for chain, declared in candidates:
+            if declared or chain.request_handler.can_handle(handler_input):
+                return chain
+        return None
+
+    def _build_index(self):
+        chains = self.request_handler_chains
+        routes = [handler_routes(chain.request_handler) for chain in chains]
+        keys = set()
+        for chain_routes in routes:
+            for request_type, intent_name in chain_routes or ():
+                keys.add((request_type, intent_name))
+                keys.add((request_type, None))
+
+        def candidates(request_type, intent_name):
+            result = []
+            for chain, chain_routes in zip(chains, routes):
+                if chain_routes is None:
+                    result.append((chain, False))
+                elif (request_type, intent_name) in chain_routes or (request_type, None) in chain_routes:
+                    result.append((chain, True))
+                    break
+            return result
+
+        self._index = dict((key, candidates(*key)) for key in keys if key[1] is not None)
+        # Requests with an intent nobody declares, or of a type without an intent.
+        self._by_type = dict((key[0], candidates(key[0], None)) for key in keys if key[1] is None)
+        self._unrouted = [(chain, False) for chain, chain_routes in zip(chains, routes) if chain_routes is None]
+
+
+class RoutedSkillBuilder(CustomSkillBuilder):
+    """Skill builder that dispatches requests with an ``IntentRouter``.
+
+    The SDK's ``lambda_handler`` builds a new skill, and a new request mapper, for every request.
+    This one builds the skill and its routing index on the first request and reuses them on warm
+    invocations. Handlers and interceptors have to be added before the first request.
+    """
+    def __init__(self, *args, **kwargs):
+        CustomSkillBuilder.__init__(self, *args, **kwargs)
+        self._skill = None
+
+    @property
+    def skill_configuration(self):
+        skill_config = super(RoutedSkillBuilder, self).skill_configuration
+        skill_config.request_mappers = [IntentRouter(self.runtime_configuration_builder.request_handler_chains)]
+        return skill_config
+
+    def skill(self):
+        # type: () -> CustomSkill
+        """Return the skill, building it on first use."""
+        if self._skill is None:
+            self._skill = CustomSkill(skill_configuration=self.skill_configuration)
+        return self._skill
+
+    def lambda_handler(self):
+        def wrapper(event, context):
+            skill = self.skill()
+            request_envelope = skill.serializer.deserialize(
+                payload=json.dumps(event), obj_type=RequestEnvelope)
+            response_envelope = skill.invoke(
+                request_envelope=request_envelope, context=context)
+            return skill.serializer.serialize(response_envelope)
+        return wrapper
+
+
+def check_routes(request_handler_chains, keys):
+    # type: (list, list) -> list
+    """Return the ``(request type, intent name)`` keys for which IntentRouter and the SDK's linear search disagree.
+
+    Use it after changing a handler's ``routes`` or ``can_handle``.
+    """
+    linear = GenericRequestMapper(request_handler_chains)
+    router = IntentRouter(request_handler_chains)
+    mismatches = []
+    for request_type, intent_name in keys:
+        handler_input = sample_handler_input(request_type, intent_name)
+        if linear.get_request_handler_chain(handler_input) is not router.get_request_handler_chain(handler_input):
+            mismatches.append((request_type, intent_name))
+    return mismatches
+
+
+def sample_handler_input(request_type, intent_name=None):
+    # type: (str, str) -> HandlerInput
+    """Return a handler input for a request of this type and intent, to test routing with."""
+    module_name, _, class_name = Request.discriminator_value_class_map[request_type].rpartition('.')
+    request = getattr(importlib.import_module(module_name), class_name)()
+    if intent_name is not None:
+        request.intent = Intent(name=intent_name)
+    return HandlerInput(request_envelope=RequestEnvelope(request=request))
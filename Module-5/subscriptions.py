@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Index of the Amazon SNS email subscriptions on the Doc Support topic, keyed by Alexa user ID.
+# Looking up a user is a dictionary read instead of one get_subscription_attributes call per subscriber.
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONFIRMED = "confirmed"
+PENDING = "pending"
+
+
+def filter_policy_for(user_id):
+    # type: (str) -> str
+    """Return the filter policy that routes a user's emails to their subscription only."""
+    return '{"user_id": ["' + user_id + '"]}'
+
+
+def user_id_from_filter_policy(filter_policy):
+    # type: (str) -> str
+    """Return the user ID a subscription's filter policy routes to, or None."""
+    try:
+        user_ids = json.loads(filter_policy).get("user_id")
+    except (TypeError, ValueError, AttributeError):
+        return None
+    if not user_ids:
+        return None
+    return user_ids[0]
+
+
+class SubscriptionIndex(object):
+    """Maps user IDs to their subscription ARN and status, in memory and in a local SQLite file.
+
+    ``refresh`` pages through the topic's subscriptions with ``NextToken`` and only calls
+    ``get_subscription_attributes`` for subscriptions the index hasn't seen before.
+    ``record_subscription`` adds a user as soon as ``sns.subscribe`` succeeds.
+    """
+    def __init__(self, path='/tmp/doc_support_subscriptions.db', min_refresh_interval=30):
+        # type: (str, int) -> None
+        self.path = path
+        self.min_refresh_interval = min_refresh_interval
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "attribute_calls": 0}
+
+        self._lock = threading.Lock()
+        self._by_user = None
+        self._arns = set()
+        self._last_refresh = 0.0
+        self._db = None
+        self._db_failed = False
+
+    def lookup(self, user_id):
+        # type: (str) -> dict
+        """Return ``{"SubscriptionArn": ..., "Status": ...}`` for the user, or None if they aren't subscribed."""
+        with self._lock:
+            self._load()
+            subscription = self._by_user.get(user_id)
+            if subscription is not None and subscription["Status"] == CONFIRMED:
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+            return subscription
+
+    def record_subscription(self, user_id, subscription_arn):
+        # type: (str, str) -> dict
+        """Record the result of ``sns.subscribe``, which returns 'pending confirmation' until the user confirms."""
+        if subscription_arn is None or subscription_arn.lower() in ('pending confirmation', 'pendingconfirmation'):
+            subscription = {"SubscriptionArn": None, "Status": PENDING}
+        else:
+            subscription = {"SubscriptionArn": subscription_arn, "Status": CONFIRMED}
+        with self._lock:
+            self._load()
+            self._store(user_id, subscription)
+        return subscription
+
+    def refresh(self, sns, topic_arn, force=False):
+        # type: (object, str, bool) -> bool
+        """Bring the index up to date with the topic, and return False if it was refreshed too recently."""
+        with self._lock:
+            self._load()
+            if not force and time.time() - self._last_refresh < self.min_refresh_interval:
+                return False
+            self._last_refresh = time.time()
+            self.stats["refreshes"] += 1
+
+            listed_arns = set()
+            kwargs = {'TopicArn': topic_arn}
+            while True:
+                sub_list = sns.list_subscriptions_by_topic(**kwargs)
+                for sub in sub_list['Subscriptions']:
+                    sub_arn = sub['SubscriptionArn']
+                    if not sub_arn.startswith('arn:'):
+                        # Pending subscriptions have no ARN yet, and no attributes to read.
+                        continue
+                    listed_arns.add(sub_arn)
+                    if sub_arn in self._arns:
+                        continue
+                    self.stats["attribute_calls"] += 1
+                    sub_attr = sns.get_subscription_attributes(SubscriptionArn=sub_arn)
+                    user_id = user_id_from_filter_policy(sub_attr['Attributes'].get('FilterPolicy'))
+                    if user_id is not None:
+                        self._store(user_id, {"SubscriptionArn": sub_arn, "Status": CONFIRMED})
+                if 'NextToken' not in sub_list:
+                    break
+                kwargs['NextToken'] = sub_list['NextToken']
+
+            # Forget confirmed subscriptions that were deleted from the topic.
+            for user_id, subscription in list(self._by_user.items()):
+                if subscription["Status"] == CONFIRMED and subscription["SubscriptionArn"] not in listed_arns:
+                    self._delete(user_id)
+            return True
+
+    def _load(self):
+        if self._by_user is not None:
+            return
+        self._by_user = {}
+        db = self._connect()
+        if db is None:
+            return
+        try:
+            rows = db.execute("SELECT user_id, subscription_arn, status FROM subscriptions").fetchall()
+        except sqlite3.Error:
+            logger.warning("Could not read subscriptions from %s", self.path, exc_info=True)
+            return
+        for user_id, subscription_arn, status in rows:
+            self._by_user[user_id] = {"SubscriptionArn": subscription_arn, "Status": status}
+            if subscription_arn:
+                self._arns.add(subscription_arn)
+
+    def _store(self, user_id, subscription):
+        old = self._by_user.get(user_id)
+        if old is not None and old["SubscriptionArn"]:
+            self._arns.discard(old["SubscriptionArn"])
+        self._by_user[user_id] = subscription
+        if subscription["SubscriptionArn"]:
+            self._arns.add(subscription["SubscriptionArn"])
+        self._write("INSERT OR REPLACE INTO subscriptions (user_id, subscription_arn, status) VALUES (?, ?, ?)",
+                    (user_id, subscription["SubscriptionArn"], subscription["Status"]))
+
+    def _delete(self, user_id):
+        old = self._by_user.pop(user_id, None)
+        if old is not None and old["SubscriptionArn"]:
+            self._arns.discard(old["SubscriptionArn"])
+        self._write("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+
+    def _write(self, statement, parameters):
+        db = self._connect()
+        if db is None:
+            return
+        try:
+            with db:
+                db.execute(statement, parameters)
+        except sqlite3.Error:
+            logger.warning("Could not write subscriptions to %s", self.path, exc_info=True)
+
+    def _connect(self):
+        if self._db is None and not self._db_failed:
+            try:
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS subscriptions "
+                                 "(user_id TEXT PRIMARY KEY, subscription_arn TEXT, status TEXT NOT NULL)")
+            except sqlite3.Error:
+                logger.warning("Subscription index file %s is not usable, keeping it in memory only", self.path, exc_info=True)
+                self._db = None
+                self._db_failed = True
+        return self._db
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Keeping Lambda containers warm.
+# A scheduled Amazon EventBridge rule invokes the skill's function every few minutes. Those
+# invocations skip Alexa dispatch and prime the credentials, clients and caches the first
+# question of a session would otherwise wait for.
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from metrics import count, timed
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def is_warmup_event(event):
+    # type: (dict) -> bool
+    """Return True for a scheduled EventBridge event, or an event with ``"warmup": true``, instead of an Alexa request."""
+    if not isinstance(event, dict):
+        return False
+    if event.get("warmup") is True:
+        return True
+    return event.get("source") == "aws.events" and event.get("detail-type") == "Scheduled Event"
+
+
+class Warmer(object):
+    """Runs the steps that prime a container, one after the other, and reports how long each took.
+
+    Each step is called with the event and the Lambda context. A step that fails is logged and
+    reported, and the next step still runs. The warm-up is recorded as a ``WarmUp`` request in the
+    request metrics, with the ``ColdStart`` dimension telling whether it found a cold container.
+    """
+    def __init__(self, recorder):
+        # type: (MetricsRecorder) -> None
+        self.recorder = recorder
+        self.stats = {"runs": 0, "cold_runs": 0}
+
+        self._steps = []
+
+    def add_step(self, name, step):
+        # type: (str, object) -> None
+        self._steps.append((name, step))
+
+    def warm(self, event, context):
+        # type: (dict, object) -> dict
+        """Run every step and return a summary, which becomes the invocation's result."""
+        cold_start = self.recorder.cold_start
+        self.stats["runs"] += 1
+        self.stats["cold_runs"] += cold_start
+        self.recorder.start("WarmUp")
+        timings = OrderedDict()
+        errors = {}
+        for name, step in self._steps:
+            start = time.perf_counter()
+            try:
+                with timed("warmup_" + name):
+                    step(event, context)
+            except Exception as e:
+                logger.warning("Warm-up step %s failed", name, exc_info=True)
+                errors[name] = type(e).__name__
+            timings[name] = round((time.perf_counter() - start) * 1000.0, 3)
+        self.recorder.finish()
+        logger.info("Warmed %s container in %.1fms: %s", "cold" if cold_start else "warm", sum(timings.values()),
+                    " ".join("%s=%.1fms" % item for item in timings.items()))
+        return {"warmup": True, "coldStart": cold_start, "timingsMs": timings, "errors": errors}
+
+
+class Prewarmer(object):
+    """Runs the steps that prime a container on a background thread, and waits briefly for them.
+
+    LaunchRequestHandler starts it, so the credentials and the connection to Amazon Kendra are ready
+    by the time the user asks their first question. Each step is called with the deadline passed to
+    ``start``. Only one thread runs at a time, and steps that all succeeded less than ``min_interval``
+    seconds ago aren't run again.
+
+    Lambda freezes the container as soon as the handler returns, so ``start`` waits up to ``max_wait``
+    seconds for the steps to finish. Beyond that the pre-warm is best effort: the thread is a daemon
+    thread and holds no lock of its own while a step runs, so when the container is thawed it just
+    carries on, and a request that needs the same credentials only waits for it as long as the
+    credential provider's ``wait_timeout``.
+    """
+    def __init__(self, min_interval=60, max_wait=0.5):
+        # type: (float, float) -> None
+        self.min_interval = min_interval
+        self.max_wait = max_wait
+        self.timings = OrderedDict()
+        self.stats = {"starts": 0, "skipped": 0, "failures": 0, "unfinished": 0}
+
+        self._steps = []
+        self._lock = threading.Lock()
+        self._thread = None
+        # Wall clock time, because the monotonic clock may not advance while the container is frozen.
+        self._finished_at = None
+
+    def add_step(self, name, step):
+        # type: (str, object) -> None
+        self._steps.append((name, step))
+
+    def running(self):
+        # type: () -> bool
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, deadline):
+        # type: (Deadline) -> bool
+        """Run the steps on a background thread for up to ``max_wait`` seconds, and return False if they are running or ran recently."""
+        with self._lock:
+            if (self._thread is not None and self._thread.is_alive()) or (
+                    self._finished_at is not None and time.time() - self._finished_at < self.min_interval):
+                self.stats["skipped"] += 1
+                return False
+            self.stats["starts"] += 1
+            self._thread = threading.Thread(target=self._run, args=(deadline,), name="prewarm", daemon=True)
+            thread = self._thread
+        thread.start()
+        count("prewarm_starts")
+        thread.join(max(0.0, min(self.max_wait, deadline.remaining())))
+        if thread.is_alive():
+            with self._lock:
+                self.stats["unfinished"] += 1
+            count("prewarm_unfinished")
+            logger.info("Pre-warm still running after %.1fs, leaving it to finish in the background", self.max_wait)
+        return True
+
+    def _run(self, deadline):
+        timings = OrderedDict()
+        failed = False
+        for name, step in self._steps:
+            start = time.perf_counter()
+            try:
+                step(deadline)
+            except Exception:
+                failed = True
+                logger.warning("Pre-warm step %s failed", name, exc_info=True)
+            timings[name] = round((time.perf_counter() - start) * 1000.0, 3)
+        with self._lock:
+            self.timings = timings
+            self.stats["failures"] += failed
+            # After a failure the steps run again on the next launch.
+            self._finished_at = None if failed else time.time()
+        logger.info("Pre-warmed in %.1fms: %s", sum(timings.values()), " ".join("%s=%.1fms" % item for item in timings.items()))
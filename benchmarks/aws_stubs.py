@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+# Deterministic stand-ins for the AWS services and Alexa APIs the skill calls, for running the
+# lambda functions from Modules 1-5 offline. Each stand-in can add a configurable latency.
+import datetime
+import hashlib
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+EXCERPT = ("To create a bucket, sign in to the AWS Management Console and open the Amazon S3 console. "
+           "Choose Create bucket, enter a name and choose a Region. ")
+
+
+class Latency(object):
+    """Sleeps for ``mean_ms`` milliseconds per call, give or take ``jitter`` (a fraction of the mean).
+
+    ``slow_fraction`` of the calls take ``slow_factor`` times longer, to model a latency tail.
+    """
+    def __init__(self, mean_ms=0.0, jitter=0.0, slow_fraction=0.0, slow_factor=10.0, seed=0):
+        self.mean_ms = mean_ms
+        self.jitter = jitter
+        self.slow_fraction = slow_fraction
+        self.slow_factor = slow_factor
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.mean_ms <= 0:
+            return
+        with self._lock:
+            delay = self.mean_ms * (1.0 + self._random.uniform(-self.jitter, self.jitter))
+            if self._random.random() < self.slow_fraction:
+                delay *= self.slow_factor
+        time.sleep(delay / 1000.0)
+
+
+class _Stub(object):
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        self.latency.wait()
+
+
+def make_result_item(query, rank, all_attributes=True):
+    """Return a result item shaped like the ones Amazon Kendra returns for ``query``."""
+    digest = hashlib.md5((query + str(rank)).encode('utf-8')).hexdigest()
+    item = {
+        'Id': '%s-%s' % (digest[:16], digest[16:]),
+        'Type': 'ANSWER' if rank == 0 else 'DOCUMENT',
+        'AdditionalAttributes': [{
+            'Key': 'AnswerText',
+            'ValueType': 'TEXT_WITH_HIGHLIGHTS_VALUE',
+            'Value': {'TextWithHighlightsValue': {
+                'Text': EXCERPT,
+                'Highlights': [{'BeginOffset': i * 10, 'EndOffset': i * 10 + 6, 'TopAnswer': i == 0} for i in range(6)]}},
+        }] if rank == 0 else [],
+        'DocumentId': 's3://docs-bucket/guides/%s-%d.pdf' % (digest[:8], rank),
+        'DocumentTitle': {
+            'Text': 'Result %d for %s' % (rank, query),
+            'Highlights': [{'BeginOffset': 0, 'EndOffset': 6, 'TopAnswer': False}]},
+        'DocumentExcerpt': {
+            'Text': EXCERPT * 2,
+            'Highlights': [{'BeginOffset': i * 20, 'EndOffset': i * 20 + 6, 'TopAnswer': False} for i in range(4)]},
+        'DocumentURI': 'https://docs.aws.amazon.com/guide/%s-%d.html' % (digest[:8], rank),
+        'DocumentAttributes': [{'Key': '_source_uri', 'Value': {
+            'StringValue': 'https://docs.aws.amazon.com/guide/%s-%d.html' % (digest[:8], rank)}}],
+        'ScoreAttributes': {'ScoreConfidence': 'HIGH' if rank < 2 else 'MEDIUM'},
+        'FeedbackToken': 'AYADeLJ4' + 'x' * 400,
+    }
+    if all_attributes:
+        item['DocumentAttributes'] += [
+            {'Key': '_data_source_id', 'Value': {'StringValue': 'a1b2c3d4-e5f6-7890-abcd-ef1234567890'}},
+            {'Key': '_category', 'Value': {'StringValue': 'User Guide'}},
+            {'Key': '_created_at', 'Value': {'DateValue': '2021-06-01T00:00:00Z'}},
+            {'Key': '_last_updated_at', 'Value': {'DateValue': '2021-07-15T00:00:00Z'}},
+            {'Key': '_file_type', 'Value': {'StringValue': 'PDF'}},
+            {'Key': '_language_code', 'Value': {'StringValue': 'en'}},
+            {'Key': '_view_count', 'Value': {'LongValue': 1234}},
+            {'Key': 'product', 'Value': {'StringListValue': ['Amazon S3', 'AWS Management Console']}},
+        ]
+    return item
+
+
+def make_passage_item(query, rank, passage):
+    """Return a passage item shaped like the ones the Amazon Kendra Retrieve API returns for ``query``."""
+    document = make_result_item(query, rank, all_attributes=False)
+    return {
+        'Id': '%s-p%d' % (document['Id'], passage),
+        'DocumentId': document['DocumentId'],
+        'DocumentTitle': document['DocumentTitle']['Text'],
+        'DocumentURI': document['DocumentURI'],
+        'Content': ' '.join('Passage %d, part %d of %s. %s' % (passage, part, document['DocumentTitle']['Text'], EXCERPT)
+                            for part in range(3)),
+        'DocumentAttributes': document['DocumentAttributes'],
+        'ScoreAttributes': {'ScoreConfidence': 'HIGH'},
+    }
+
+
+class FakeSTS(_Stub):
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self._call('assume_role')
+        return {'Credentials': {
+            'AccessKeyId': 'ASIAFAKEACCESSKEY',
+            'SecretAccessKey': 'fake-secret-access-key',
+            'SessionToken': 'fake-session-token',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+        }}
+
+
+class FakeKendra(_Stub):
+    """Returns ``page_size`` results for every query, the same ones every time for the same query text.
+
+    ``retrieve`` stands in for the Retrieve API of newer boto3 versions, and returns
+    ``passages_per_document`` passages from each document the same query would return.
+    """
+    def __init__(self, latency=None, page_size=10, passages_per_document=2):
+        _Stub.__init__(self, latency)
+        self.page_size = page_size
+        self.passages_per_document = passages_per_document
+
+    def query(self, QueryText, IndexId, PageSize=None, RequestedDocumentAttributes=None, **kwargs):
+        self._call('query')
+        page_size = min(PageSize or self.page_size, self.page_size)
+        all_attributes = RequestedDocumentAttributes is None
+        return {
+            'QueryId': hashlib.md5(QueryText.encode('utf-8')).hexdigest(),
+            'ResultItems': [make_result_item(QueryText, rank, all_attributes) for rank in range(page_size)],
+            'FacetResults': [],
+            'TotalNumberOfResults': 100,
+        }
+
+    def retrieve(self, QueryText, IndexId, PageSize=None, **kwargs):
+        self._call('retrieve')
+        passages = self.passages_per_document
+        return {
+            'QueryId': hashlib.md5(QueryText.encode('utf-8')).hexdigest(),
+            'ResultItems': [make_passage_item(QueryText, number // passages, number % passages)
+                            for number in range(min(PageSize or 10, self.page_size * passages))],
+        }
+
+
+    def describe_index(self, Id, **kwargs):
+        self._call('describe_index')
+        return {'Id': Id, 'Name': 'DocSupportIndex', 'Status': 'ACTIVE', 'Edition': 'DEVELOPER_EDITION'}
+
+
+class FakeSNS(_Stub):
+    """An SNS topic whose email subscriptions are confirmed as soon as they are made, unless ``auto_confirm`` is off."""
+    def __init__(self, latency=None, auto_confirm=True, subscribers=0):
+        _Stub.__init__(self, latency)
+        self.auto_confirm = auto_confirm
+        self.topic_arn = 'arn:aws:sns:us-east-1:123456789012:DocSupportSNS'
+        self.subscriptions = []
+        self.published = []
+        for i in range(subscribers):
+            self._add_subscription('{"user_id": ["amzn1.ask.account.OTHER%d"]}' % i)
+
+    def _add_subscription(self, filter_policy):
+        arn = '%s:%08d' % (self.topic_arn, len(self.subscriptions))
+        self.subscriptions.append((arn, filter_policy))
+        return arn
+
+    def create_topic(self, Name, **kwargs):
+        self._call('create_topic')
+        return {'TopicArn': self.topic_arn}
+
+    def get_topic_attributes(self, TopicArn):
+        self._call('get_topic_attributes')
+        return {'Attributes': {'TopicArn': TopicArn}}
+
+    def list_subscriptions_by_topic(self, TopicArn, NextToken=None):
+        self._call('list_subscriptions_by_topic')
+        start = int(NextToken or 0)
+        page = self.subscriptions[start:start + 100]
+        response = {'Subscriptions': [{'SubscriptionArn': arn, 'TopicArn': TopicArn, 'Protocol': 'email'} for arn, _ in page]}
+        if start + 100 < len(self.subscriptions):
+            response['NextToken'] = str(start + 100)
+        return response
+
+    def get_subscription_attributes(self, SubscriptionArn):
+        self._call('get_subscription_attributes')
+        filter_policy = dict(self.subscriptions)[SubscriptionArn]
+        return {'Attributes': {'FilterPolicy': filter_policy, 'TopicArn': self.topic_arn, 'SubscriptionArn': SubscriptionArn}}
+
+    def subscribe(self, TopicArn, Protocol, Endpoint, Attributes=None, **kwargs):
+        self._call('subscribe')
+        filter_policy = (Attributes or {}).get('FilterPolicy')
+        for arn, existing_policy in self.subscriptions:
+            if existing_policy == filter_policy:
+                return {'SubscriptionArn': arn}
+        if not self.auto_confirm:
+            return {'SubscriptionArn': 'pending confirmation'}
+        return {'SubscriptionArn': self._add_subscription(filter_policy)}
+
+    def publish(self, **kwargs):
+        self._call('publish')
+        self.published.append(kwargs)
+        return {'MessageId': 'message-%d' % len(self.published)}
+
+
+class FakeSQS(_Stub):
+    def __init__(self, latency=None):
+        _Stub.__init__(self, latency)
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call('send_message')
+        self.messages.append(MessageBody)
+        return {'MessageId': 'message-%d' % len(self.messages)}
+
+
+class FakeUPS(_Stub):
+    """Stand-in for the Alexa customer profile (UPS) service client."""
+    def get_profile_email(self):
+        self._call('get_profile_email')
+        return 'user@example.com'
+
+    def get_profile_given_name(self):
+        self._call('get_profile_given_name')
+        return 'Sam'
+
+
+class FakeLambdaContext(object):
+    """Lambda context with the remaining-time method the skill uses for its deadlines."""
+    def __init__(self, timeout_ms=8000):
+        self._expires_at = time.monotonic() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0.0, self._expires_at - time.monotonic()) * 1000)
+
+
+class AwsStubs(object):
+    """One stand-in per service, with latencies given in milliseconds by service name."""
+    def __init__(self, latencies=None, jitter=0.0, seed=0, auto_confirm=True, subscribers=0):
+        latencies = latencies or {}
+
+        def latency(name):
+            return Latency(latencies.get(name, 0.0), jitter, seed=seed)
+
+        self.sts = FakeSTS(latency('sts'))
+        self.kendra = FakeKendra(latency('kendra'))
+        self.sns = FakeSNS(latency('sns'), auto_confirm=auto_confirm, subscribers=subscribers)
+        self.sqs = FakeSQS(latency('sqs'))
+        self.ups = FakeUPS(latency('ups'))
+        self.clients_built = 0
+
+    def client(self, service_name, *args, **kwargs):
+        self.clients_built += 1
+        return getattr(self, service_name)
+
+    def calls(self):
+        """Return every stand-in's call counts, keyed like ``kendra.query``."""
+        counts = {}
+        for name in ('sts', 'kendra', 'sns', 'sqs', 'ups'):
+            for call, count in getattr(self, name).calls.items():
+                counts[name + '.' + call] = count
+        return counts
+
+
+@contextmanager
+def installed(stubs):
+    """Route ``boto3.client``, boto3 session clients and the Alexa UPS client to the stand-ins."""
+    import boto3
+    import boto3.session
+    from ask_sdk_model.services import ServiceClientFactory
+
+    saved = (boto3.client, boto3.session.Session.client, ServiceClientFactory.get_ups_service)
+    boto3.client = stubs.client
+    boto3.session.Session.client = lambda session, service_name, *args, **kwargs: stubs.client(service_name)
+    ServiceClientFactory.get_ups_service = lambda factory: stubs.ups
+    try:
+        yield stubs
+    finally:
+        boto3.client, boto3.session.Session.client, ServiceClientFactory.get_ups_service = saved
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks the first question a Module 5 container answers: cold, after a keep-warm event, and after
+# a LaunchRequest, which waits briefly for its pre-warm before answering. Each trial loads the module
+# afresh, as a new Lambda container would, so the STS credentials, clients and caches start empty.
+# The AWS services are the stand-ins from aws_stubs.py.
+#
+# Run from the repository root:
+#   python benchmarks/bench_cold_start.py --latency kendra=120,sts=40,sns=30 --trials 10
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aws_stubs import AwsStubs, FakeLambdaContext, installed
+from bench_handlers import LAUNCH, QUERY, load_module, parse_latencies, percentile, turn_envelope
+
+
+def first_query(stubs, state_dir, mode, queries, think_time):
+    """Load a fresh module, prepare it as ``mode`` says, and time its first CaptureQuery turn."""
+    with installed(stubs):
+        module = load_module(5, state_dir)
+        warmup_ms = 0.0
+        attributes = {}
+        if mode == 'warmed':
+            start = time.perf_counter()
+            summary = module.lambda_handler({"warmup": True, "queries": queries}, FakeLambdaContext())
+            warmup_ms = (time.perf_counter() - start) * 1000.0
+            assert summary.get("warmup") and not summary["errors"], summary
+        elif mode == 'launched':
+            start = time.perf_counter()
+            response = module.lambda_handler(turn_envelope(LAUNCH, {}), FakeLambdaContext())
+            warmup_ms = (time.perf_counter() - start) * 1000.0
+            attributes = response.get('sessionAttributes') or {}
+            # The user listens to the greeting. Lambda would freeze the container meanwhile, so the
+            # default think time of 0 only counts what the pre-warm finished during the launch.
+            time.sleep(think_time)
+        calls_before = stubs.calls()
+        start = time.perf_counter()
+        module.lambda_handler(turn_envelope(QUERY, attributes), FakeLambdaContext())
+        query_ms = (time.perf_counter() - start) * 1000.0
+        calls = dict((name, count - calls_before.get(name, 0)) for name, count in stubs.calls().items()
+                     if count != calls_before.get(name, 0))
+    return query_ms, warmup_ms, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the first question of a new Module 5 container, cold, after a keep-warm event and after a launch.')
+    parser.add_argument('--trials', type=int, default=10, help='fresh containers per mode')
+    parser.add_argument('--latency', default='kendra=120,sts=40,sns=30', help='milliseconds per call by service')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter, as a fraction of the mean')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds between the LaunchRequest and the first question')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    latencies = parse_latencies(args.latency)
+    state_dir = tempfile.mkdtemp(prefix='doc_support_cold_')
+    query = QUERY[2]['query']
+    results = {}
+    print('%-8s %9s %9s %9s %11s  %s' % ('mode', 'p50 ms', 'max ms', 'prior ms', 'trials', 'AWS calls in the first turn'))
+    for mode in ('cold', 'warmed', 'launched'):
+        timings = []
+        warmups = []
+        calls = {}
+        for trial in range(args.trials):
+            stubs = AwsStubs(latencies, jitter=args.jitter, seed=trial)
+            query_ms, warmup_ms, calls = first_query(stubs, state_dir, mode, [query], args.think_time)
+            timings.append(query_ms)
+            warmups.append(warmup_ms)
+        timings.sort()
+        results[mode] = {'p50_ms': percentile(timings, 0.5), 'max_ms': timings[-1],
+                         'prior_turn_ms': sum(warmups) / len(warmups), 'first_turn_calls': calls}
+        print('%-8s %9.1f %9.1f %9.1f %11d  %s' % (mode, percentile(timings, 0.5), timings[-1], results[mode]['prior_turn_ms'],
+                                                args.trials, ' '.join('%s=%d' % item for item in sorted(calls.items()))))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks the FAQ index from Module-5/faq_index.py: how long building it takes, how large the
+# file gets, and how long a lookup takes for a question that is in the index, one that only matches
+# after normalization, and one that isn't there, compared with a Kendra query cache hit.
+#
+# Run from the repository root:  python benchmarks/bench_faq_index.py --questions 1000,5000
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Module-5'))
+
+from aws_stubs import FakeKendra
+from faq_index import FaqIndex, build_faq_index
+from kendra_search import QueryCache, select_candidates
+
+
+def question(number):
+    return 'How do I configure feature %d of my bucket' % number
+
+
+def measure(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building and reading the FAQ index.')
+    parser.add_argument('--questions', default='1000,5000', help='comma separated index sizes')
+    parser.add_argument('--candidates', type=int, default=3, help='results kept per question')
+    parser.add_argument('--number', type=int, default=20000, help='lookups per timing run')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    kendra = FakeKendra()
+    directory = tempfile.mkdtemp(prefix='doc_support_faq_')
+    results = {}
+    print('%9s %9s %10s %11s %13s %10s %12s' % ('questions', 'build s', 'file KiB', 'exact us', 'normalized us', 'miss us', 'cache hit us'))
+    for size in [int(value) for value in args.questions.split(',')]:
+        path = os.path.join(directory, 'faq_index_%d.db' % size)
+        search = lambda query: kendra.query(QueryText=query, IndexId='index', PageSize=10)['ResultItems']
+        start = time.perf_counter()
+        build_faq_index(path, [question(number) for number in range(size)], search, args.candidates)
+        build_seconds = time.perf_counter() - start
+
+        faq_index = FaqIndex(path)
+        middle = question(size // 2)
+        assert faq_index.lookup(middle) is not None and faq_index.lookup(middle.upper() + '?') is not None
+        exact_us = measure(lambda: faq_index.lookup(middle, args.candidates), args.number)
+        normalized_us = measure(lambda: faq_index.lookup('  ' + middle.upper() + '?', args.candidates), args.number)
+        miss_us = measure(lambda: faq_index.lookup('what is the meaning of life', args.candidates), args.number)
+
+        # What the skill did before for a popular question: a query cache hit, then candidate selection.
+        query_cache = QueryCache(max_size=size)
+        query_cache.put('index', middle, search(middle))
+        cache_us = measure(lambda: select_candidates(query_cache.get('index', middle), args.candidates), args.number)
+
+        results[size] = {'build_s': build_seconds, 'file_bytes': os.path.getsize(path), 'exact_us': exact_us,
+                         'normalized_us': normalized_us, 'miss_us': miss_us, 'cache_hit_us': cache_us}
+        print('%9d %9.2f %10.1f %11.2f %13.2f %10.2f %12.2f' % (
+            size, build_seconds, os.path.getsize(path) / 1024.0, exact_us, normalized_us, miss_us, cache_us))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks the skill handlers of Modules 1-5 offline.
+# Builds Alexa request envelopes for each intent and session state, drives them through each module's
+# lambda_handler with STS, Kendra, SNS and the Alexa customer profile API replaced by deterministic
+# stand-ins, and reports per-intent throughput, latency percentiles and allocations.
+#
+# Run from the repository root:
+#   python benchmarks/bench_handlers.py
+#   python benchmarks/bench_handlers.py --modules 5 --latency kendra=120,sts=40,sns=30 --iterations 50
+#   python benchmarks/bench_handlers.py --save-baseline baseline.json
+#   python benchmarks/bench_handlers.py --compare baseline.json --threshold 0.2
+import argparse
+import copy
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aws_stubs import AwsStubs, FakeLambdaContext, installed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 'amzn1.ask.account.BENCHMARK'
+ERROR_SPEECH = 'Sorry, I had trouble doing what you asked.'
+
+LAUNCH = ('LaunchRequest', None, None)
+QUERY = ('IntentRequest', 'CaptureQueryIntent', {'query': 'how do I create a bucket'})
+NO = ('IntentRequest', 'AMAZON.NoIntent', None)
+YES = ('IntentRequest', 'AMAZON.YesIntent', None)
+
+# name: (first module with the intent, turns that set up the session, the measured turn)
+# A "{i}" in a slot value is replaced by the iteration number, so every query misses the caches.
+SCENARIOS = [
+    ('Launch', 1, [], LAUNCH),
+    ('HelloWorld', 1, [LAUNCH], ('IntentRequest', 'HelloWorldIntent', None)),
+    ('Help', 1, [LAUNCH], ('IntentRequest', 'AMAZON.HelpIntent', None)),
+    ('Fallback', 1, [LAUNCH], ('IntentRequest', 'AMAZON.FallbackIntent', None)),
+    ('Stop', 1, [LAUNCH], ('IntentRequest', 'AMAZON.StopIntent', None)),
+    ('SessionEnded', 1, [LAUNCH], ('SessionEndedRequest', None, None)),
+    ('CaptureQuery', 2, [LAUNCH], QUERY),
+    ('CaptureQuery.uncached', 2, [LAUNCH], ('IntentRequest', 'CaptureQueryIntent', {'query': 'how do I create bucket {i}'})),
+    ('No', 3, [LAUNCH, QUERY], NO),
+    ('CaptureQuery.next', 3, [LAUNCH, QUERY, NO], QUERY),
+    ('Yes', 3, [LAUNCH, QUERY], YES),
+    ('ReadDoc', 4, [LAUNCH, QUERY, NO, QUERY], ('IntentRequest', 'ReadDocIntent', None)),
+    ('SendEmail', 4, [LAUNCH, QUERY], ('IntentRequest', 'SendEmailIntent', None)),
+    ('Repeat', 5, [LAUNCH, QUERY], ('IntentRequest', 'AMAZON.RepeatIntent', None)),
+    ('ReadDoc.continue', 5, [LAUNCH, QUERY, NO, QUERY, ('IntentRequest', 'ReadDocIntent', None)],
+     ('IntentRequest', 'ContinueReadingIntent', None)),
+]
+# Module 1 is the hello world skill, and later modules replace its intent with CaptureQueryIntent.
+LAST_MODULE = {'HelloWorld': 1}
+
+
+def make_envelope(request_type, intent_name=None, slots=None, attributes=None, new=False, user_id=USER_ID):
+    """Return an Alexa request envelope, as the Alexa service sends it to the skill's Lambda function."""
+    request = {
+        'type': request_type,
+        'requestId': 'amzn1.echo-api.request.' + str(uuid.uuid4()),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'locale': 'en-US',
+    }
+    if request_type == 'IntentRequest':
+        request['intent'] = {
+            'name': intent_name,
+            'confirmationStatus': 'NONE',
+            'slots': dict((name, {'name': name, 'value': value, 'confirmationStatus': 'NONE'})
+                          for name, value in (slots or {}).items()),
+        }
+    elif request_type == 'SessionEndedRequest':
+        request['reason'] = 'USER_INITIATED'
+
+    application = {'applicationId': 'amzn1.ask.skill.BENCHMARK'}
+    user = {'userId': user_id, 'permissions': {'consentToken': 'benchmark-consent-token'}}
+    return {
+        'version': '1.0',
+        'session': {
+            'new': new,
+            'sessionId': 'amzn1.echo-api.session.BENCHMARK',
+            'application': application,
+            'attributes': attributes or {},
+            'user': user,
+        },
+        'context': {'System': {
+            'application': application,
+            'user': user,
+            'device': {'deviceId': 'amzn1.ask.device.BENCHMARK', 'supportedInterfaces': {}},
+            'apiEndpoint': 'https://api.amazonalexa.com',
+            'apiAccessToken': 'benchmark-access-token',
+        }},
+        'request': request,
+    }
+
+
+def turn_envelope(turn, attributes, iteration=0):
+    request_type, intent_name, slots = turn
+    if slots:
+        slots = dict((name, value.replace('{i}', str(iteration))) for name, value in slots.items())
+    return make_envelope(request_type, intent_name, slots, copy.deepcopy(attributes), new=request_type == 'LaunchRequest')
+
+
+def speech(response):
+    output = (response.get('response') or {}).get('outputSpeech') or {}
+    return output.get('ssml') or output.get('text') or ''
+
+
+def load_module(number, state_dir):
+    """Import ``Module-N/lambda_function_module_N.py``, with its container state kept under ``state_dir``."""
+    directory = os.path.join(ROOT, 'Module-%d' % number)
+    name = 'lambda_function_module_%d' % number
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(directory, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+
+    # Module 5 writes a metrics line per request to stdout, which would drown the report.
+    if hasattr(module, 'request_metrics'):
+        module.request_metrics.emit = lambda line: None
+    # Module 5 keeps results and subscriptions in /tmp, which would carry over from earlier runs.
+    if hasattr(module, 'result_store'):
+        module.result_store = type(module.result_store)(path=os.path.join(state_dir, 'results-%d.db' % number))
+    if hasattr(module, 'subscription_index'):
+        module.subscription_index = type(module.subscription_index)(path=os.path.join(state_dir, 'subscriptions-%d.db' % number))
+    return module
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def metrics_overhead(module):
+    """Return how many requests module 5 recorded metrics for, and the milliseconds spent recording them."""
+    recorder = getattr(module, 'request_metrics', None)
+    if recorder is None:
+        return 0, 0.0
+    return recorder.stats["requests"], recorder.stats["overhead_ms"]
+
+
+def run_scenario(module, stubs, setup, turn, iterations, warmup):
+    """Run the setup turns once, then the measured turn ``iterations`` times from the same session state."""
+    attributes = {}
+    for setup_turn in setup:
+        response = module.lambda_handler(turn_envelope(setup_turn, attributes), FakeLambdaContext())
+        attributes = response.get('sessionAttributes') or {}
+
+    for iteration in range(warmup):
+        module.lambda_handler(turn_envelope(turn, attributes, 'warmup%d' % iteration), FakeLambdaContext())
+
+    calls_before = stubs.calls()
+    overhead_before = metrics_overhead(module)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for iteration in range(iterations):
+        envelope = turn_envelope(turn, attributes, iteration)
+        context = FakeLambdaContext()
+        call_started = time.perf_counter()
+        response = module.lambda_handler(envelope, context)
+        latencies.append((time.perf_counter() - call_started) * 1000.0)
+        if ERROR_SPEECH in speech(response):
+            errors += 1
+    elapsed = time.perf_counter() - started
+    calls_after = stubs.calls()
+    overhead_after = metrics_overhead(module)
+
+    # Allocations are measured in a separate pass, because tracing slows every call down.
+    alloc_iterations = max(1, min(iterations, 20))
+    peaks = []
+    tracemalloc.start()
+    try:
+        for iteration in range(alloc_iterations):
+            envelope = turn_envelope(turn, attributes, iterations + iteration)
+            context = FakeLambdaContext()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            module.lambda_handler(envelope, context)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    aws_calls = dict((name, round(float(count - calls_before.get(name, 0)) / iterations, 2))
+                     for name, count in calls_after.items() if count != calls_before.get(name, 0))
+    return {
+        'iterations': iterations,
+        'throughput_per_s': iterations / elapsed if elapsed else 0.0,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'alloc_peak_kb': sum(peaks) / len(peaks) / 1024.0,
+        'errors': errors,
+        'aws_calls_per_turn': aws_calls,
+        'metrics_overhead_ms': (overhead_after[1] - overhead_before[1]) / max(1, overhead_after[0] - overhead_before[0]),
+    }
+
+
+def run(modules, scenario_names, iterations, warmup, latencies, jitter, subscribers, metrics=True):
+    results = {}
+    state_dir = tempfile.mkdtemp(prefix='doc_support_bench_')
+    for number in modules:
+        stubs = AwsStubs(latencies, jitter=jitter, subscribers=subscribers)
+        with installed(stubs):
+            module = load_module(number, state_dir)
+            if hasattr(module, 'request_metrics'):
+                module.request_metrics.enabled = metrics
+            for name, first_module, setup, turn in SCENARIOS:
+                if number < first_module or number > LAST_MODULE.get(name, number):
+                    continue
+                if scenario_names and name not in scenario_names:
+                    continue
+                results['module-%d/%s' % (number, name)] = run_scenario(module, stubs, setup, turn, iterations, warmup)
+    return results
+
+
+def compare(results, baseline, threshold, metric):
+    """Return the lines describing scenarios whose ``metric`` got worse than the baseline by more than ``threshold``."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        before = baseline.get('results', {}).get(key)
+        if before is None or not before.get(metric):
+            continue
+        change = (result[metric] - before[metric]) / before[metric]
+        if change > threshold:
+            regressions.append('%-36s %s %.3f -> %.3f ms (%+.0f%%)' % (key, metric, before[metric], result[metric], change * 100))
+    return regressions
+
+
+def parse_latencies(value):
+    """Parse ``kendra=120,sts=40`` into milliseconds per service."""
+    latencies = {}
+    for part in filter(None, (value or '').split(',')):
+        service, _, milliseconds = part.partition('=')
+        latencies[service.strip()] = float(milliseconds)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the skill handlers of Modules 1-5 with stubbed AWS services.')
+    parser.add_argument('--modules', default='1,2,3,4,5', help='comma separated module numbers')
+    parser.add_argument('--scenarios', help='comma separated scenario names, for example CaptureQuery,SendEmail')
+    parser.add_argument('--iterations', type=int, default=200, help='measured turns per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured turns per scenario')
+    parser.add_argument('--latency', help='milliseconds per call by service, for example kendra=120,sts=40,sns=30,ups=20')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter, as a fraction of the mean')
+    parser.add_argument('--subscribers', type=int, default=0, help='other email subscriptions on the SNS topic')
+    parser.add_argument('--no-metrics', action='store_true', help='turn off the Module 5 request metrics, to measure their overhead')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--save-baseline', help='write the results and settings to this baseline file')
+    parser.add_argument('--compare', help='compare with this baseline file and exit with status 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown over the baseline, as a fraction')
+    parser.add_argument('--metric', default='p95_ms', help='metric compared with the baseline')
+    args = parser.parse_args()
+
+    # The skill logs every request, which would dominate the timings.
+    logging.disable(logging.CRITICAL)
+
+    settings = {
+        'iterations': args.iterations,
+        'latency': parse_latencies(args.latency),
+        'jitter': args.jitter,
+        'subscribers': args.subscribers,
+        'metrics': not args.no_metrics,
+        'python': sys.version.split()[0],
+    }
+    results = run([int(number) for number in args.modules.split(',')],
+                  set(args.scenarios.split(',')) if args.scenarios else None,
+                  args.iterations, args.warmup, settings['latency'], args.jitter, args.subscribers, not args.no_metrics)
+
+    print('%-36s %9s %8s %8s %8s %10s %6s %10s' % ('scenario', 'turns/s', 'p50 ms', 'p95 ms', 'p99 ms', 'alloc KiB', 'errors', 'metrics ms'))
+    for key, result in sorted(results.items()):
+        print('%-36s %9.1f %8.3f %8.3f %8.3f %10.1f %6d %10.3f' % (
+            key, result['throughput_per_s'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['alloc_peak_kb'], result['errors'], result['metrics_overhead_ms']))
+
+    report = {'settings': settings, 'results': results}
+    for path in filter(None, (args.json, args.save_baseline)):
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings', {}).get('latency') != settings['latency']:
+            print('Warning: the baseline was recorded with different stub latencies: %s' % baseline.get('settings', {}).get('latency'))
+        regressions = compare(results, baseline, args.threshold, args.metric)
+        if regressions:
+            print('\nRegressions over %.0f%%:' % (args.threshold * 100))
+            for line in regressions:
+                print('  ' + line)
+            sys.exit(1)
+        print('\nNo regressions over %.0f%% in %s.' % (args.threshold * 100, args.metric))
+
+
+if __name__ == '__main__':
+    main()
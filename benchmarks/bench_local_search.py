@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks the local BM25 index from Module-5/local_search.py on a synthetic corpus: build time,
+# peak process memory while building, file size, memory used once opened, and search latency percentiles.
+# Word frequencies follow a Zipf distribution, so common words have long postings lists like in real text.
+#
+# Run from the repository root:  python benchmarks/bench_local_search.py --passages 10000,100000
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Module-5'))
+
+from bench_handlers import percentile
+from local_search import LocalIndex, build_local_index
+
+
+class Corpus(object):
+    """Passages of random words, with word frequencies that follow a Zipf distribution."""
+    def __init__(self, vocabulary, seed):
+        self.words = ['term%d' % number for number in range(vocabulary)]
+        self.cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(vocabulary)))
+        self.random = random.Random(seed)
+
+    def sentence(self, length):
+        return ' '.join(self.random.choices(self.words, cum_weights=self.cum_weights, k=length))
+
+    def passages(self, count, length):
+        for number in range(count):
+            yield {'Title': self.sentence(6), 'Text': self.sentence(length) + '.',
+                   'URI': 'https://docs.example.com/guide/%d.html' % number, 'DocumentId': 'doc-%d' % (number // 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building and searching the local BM25 index.')
+    parser.add_argument('--passages', default='10000,100000', help='comma separated corpus sizes')
+    parser.add_argument('--words', type=int, default=40, help='words per passage')
+    parser.add_argument('--vocabulary', type=int, default=30000, help='distinct words in the corpus')
+    parser.add_argument('--queries', type=int, default=2000, help='searches to time per corpus')
+    parser.add_argument('--max-postings', type=int, default=250, help='postings read per query word')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='doc_support_local_')
+    results = {}
+    print('%9s %8s %10s %10s %10s %9s %9s %9s %9s' % (
+        'passages', 'build s', 'peak MiB', 'file MiB', 'open KiB', 'p50 us', 'p95 us', 'p99 us', 'max us'))
+    for size in [int(value) for value in args.passages.split(',')]:
+        corpus = Corpus(args.vocabulary, args.seed)
+        path = os.path.join(directory, 'local_index_%d.db' % size)
+        start = time.perf_counter()
+        build_local_index(path, corpus.passages(size, args.words))
+        build_seconds = time.perf_counter() - start
+        # tracemalloc would slow the build down several times, so this is the peak size of the whole process.
+        build_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        index = LocalIndex(path, max_postings=args.max_postings)
+        tracemalloc.start()
+        assert index.available()
+        index.search(corpus.sentence(3))
+        open_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        timings = []
+        empty = 0
+        for _ in range(args.queries):
+            query = corpus.sentence(corpus.random.randint(2, 6))
+            start = time.perf_counter()
+            found = index.search(query, 3)
+            timings.append((time.perf_counter() - start) * 1e6)
+            empty += not found
+        timings.sort()
+        results[size] = {
+            'build_s': build_seconds, 'build_peak_bytes': build_peak, 'file_bytes': os.path.getsize(path),
+            'open_bytes': open_bytes, 'p50_us': percentile(timings, 0.5), 'p95_us': percentile(timings, 0.95),
+            'p99_us': percentile(timings, 0.99), 'max_us': timings[-1], 'empty': empty,
+        }
+        print('%9d %8.1f %10.1f %10.1f %10.1f %9.1f %9.1f %9.1f %9.1f' % (
+            size, build_seconds, build_peak / 1048576.0, os.path.getsize(path) / 1048576.0, open_bytes / 1024.0,
+            percentile(timings, 0.5), percentile(timings, 0.95), percentile(timings, 0.99), timings[-1]))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks parsing a Kendra query response into the candidates the skill offers.
+# Compares the old dict-per-candidate projection with the lazy KendraResult projection,
+# and the size and JSON parse time of a full response with one that only asks for the attributes we use.
+#
+# Run from the repository root:  python benchmarks/bench_parse.py
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Module-5'))
+
+from aws_stubs import make_result_item
+from kendra_search import CANDIDATE_TYPES, select_candidates
+
+QUERY = 'how do I create a bucket'
+
+
+def make_response(page_size=10, all_attributes=True):
+    return {
+        'QueryId': 'q-1234',
+        'ResultItems': [make_result_item(QUERY, rank, all_attributes) for rank in range(page_size)],
+        'FacetResults': [],
+        'TotalNumberOfResults': 250,
+    }
+
+
+def dict_candidates(result_items, limit):
+    """The projection the skill used before, building a dict per candidate."""
+    candidates = []
+    for query_result in result_items:
+        if len(candidates) >= limit:
+            break
+        if query_result['Type'] not in CANDIDATE_TYPES:
+            continue
+        title = query_result.get('DocumentTitle')
+        candidates.append({
+            "Id": query_result['Id'],
+            "Type": query_result['Type'],
+            "Text": query_result['DocumentExcerpt']['Text'],
+            "Title": title['Text'] if title else None,
+            "URI": query_result['DocumentURI'],
+        })
+    return candidates
+
+
+def measure(function, number):
+    """Return microseconds per call, and bytes and blocks still allocated per call for what it returns.
+
+    Allocations are measured over 1000 calls whose results are kept alive, so free lists
+    don't hide them, and tracemalloc's own allocations are left out.
+    """
+    seconds = min(timeit.repeat(function, number=number, repeat=5)) / number
+    calls = 1000
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [function() for _ in range(calls)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del kept
+    return {"us_per_call": seconds * 1e6, "bytes": size // calls, "blocks": blocks // calls}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--limit', type=int, default=3, help='candidates to select, like MAX_CANDIDATES')
+    parser.add_argument('--number', type=int, default=20000, help='calls per timing run')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    full_body = json.dumps(make_response(all_attributes=True))
+    projected_body = json.dumps(make_response(all_attributes=False))
+    result_items = json.loads(full_body)['ResultItems']
+
+    results = {
+        "select_dicts": measure(lambda: dict_candidates(result_items, args.limit), args.number),
+        "select_slots": measure(lambda: select_candidates(result_items, args.limit), args.number),
+        "parse_full_response": measure(lambda: json.loads(full_body), args.number // 10),
+        "parse_projected_response": measure(lambda: json.loads(projected_body), args.number // 10),
+    }
+    results["parse_full_response"]["response_bytes"] = len(full_body)
+    results["parse_projected_response"]["response_bytes"] = len(projected_body)
+
+    for name, result in results.items():
+        line = "%-26s %9.2f us/call %8d bytes %6d blocks" % (name, result["us_per_call"], result["bytes"], result["blocks"])
+        if "response_bytes" in result:
+            line += " %8d bytes on the wire" % result["response_bytes"]
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks finding the handler for a request: the SDK's linear can_handle search against the
+# IntentRouter index from Module-5/routing.py, as the number of handlers grows.
+# It also checks that both pick the same handler for every intent of the Module 5 skill.
+#
+# Run from the repository root:  python benchmarks/bench_routing.py --handlers 10,50,200
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Module-5'))
+
+import ask_sdk_core.utils as ask_utils
+
+from ask_sdk_core.dispatch_components import AbstractRequestHandler
+from ask_sdk_runtime.dispatch_components import GenericRequestHandlerChain, GenericRequestMapper
+
+from aws_stubs import AwsStubs, installed
+from bench_handlers import load_module
+from routing import IntentRouter, check_routes, sample_handler_input
+
+
+class IntentHandler(AbstractRequestHandler):
+    """A handler like the skill's, for one intent."""
+    def __init__(self, intent_name):
+        self.intent_name = intent_name
+        self.routes = [("IntentRequest", intent_name)]
+
+    def can_handle(self, handler_input):
+        return ask_utils.is_intent_name(self.intent_name)(handler_input)
+
+    def handle(self, handler_input):
+        return None
+
+
+class ReflectorHandler(AbstractRequestHandler):
+    routes = [("IntentRequest", None)]
+
+    def can_handle(self, handler_input):
+        return ask_utils.is_request_type("IntentRequest")(handler_input)
+
+    def handle(self, handler_input):
+        return None
+
+
+def make_chains(count):
+    handlers = [IntentHandler('Intent%d' % number) for number in range(count)] + [ReflectorHandler()]
+    return [GenericRequestHandlerChain(request_handler=handler) for handler in handlers]
+
+
+def measure(mapper, handler_input, number):
+    seconds = min(timeit.repeat(lambda: mapper.get_request_handler_chain(handler_input), number=number, repeat=3))
+    return seconds / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark linear and indexed request routing.')
+    parser.add_argument('--handlers', default='10,25,50,100,200', help='comma separated handler counts')
+    parser.add_argument('--number', type=int, default=20000, help='lookups per timing run')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    # The Module 5 skill's routes have to pick the same handler as its can_handle methods.
+    with installed(AwsStubs()):
+        module = load_module(5, tempfile.mkdtemp(prefix='doc_support_routing_'))
+    chains = module.sb.runtime_configuration_builder.request_handler_chains
+    keys = [('LaunchRequest', None), ('SessionEndedRequest', None), ('IntentRequest', 'UnknownIntent')]
+    for chain in chains:
+        keys.extend(key for key in getattr(chain.request_handler, 'routes', None) or () if key[1] is not None)
+    mismatches = check_routes(chains, keys)
+    if mismatches:
+        print('Routes that disagree with can_handle: %s' % mismatches)
+        sys.exit(1)
+    print('Module 5 routes agree with can_handle for %d requests.\n' % len(keys))
+
+    results = {}
+    print('%8s  %-22s %12s %12s %8s' % ('handlers', 'request', 'linear us', 'indexed us', 'speedup'))
+    for count in [int(value) for value in args.handlers.split(',')]:
+        chains = make_chains(count)
+        linear = GenericRequestMapper(chains)
+        router = IntentRouter(chains)
+        for label, handler_input in [('first intent', sample_handler_input('IntentRequest', 'Intent0')),
+                                     ('last intent', sample_handler_input('IntentRequest', 'Intent%d' % (count - 1))),
+                                     ('unknown intent', sample_handler_input('IntentRequest', 'Unknown'))]:
+            assert linear.get_request_handler_chain(handler_input) is router.get_request_handler_chain(handler_input)
+            linear_us = measure(linear, handler_input, args.number)
+            router_us = measure(router, handler_input, args.number)
+            results['%d/%s' % (count, label)] = {'linear_us': linear_us, 'indexed_us': router_us}
+            print('%8d  %-22s %12.3f %12.3f %7.1fx' % (count, label, linear_us, router_us, linear_us / router_us))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
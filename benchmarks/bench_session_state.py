@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Compares the session attributes of the original Module 5 skill, one attribute per field with the
+# text of the last result, with the compact dialog state from Module-5/dialog_state.py: the size of
+# the serialized session attributes that go back and forth with every request, and the time to read
+# and write them once per request.
+#
+# Run from the repository root:  python benchmarks/bench_session_state.py
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Module-5'))
+
+from aws_stubs import make_result_item
+from dialog_state import DialogState, NEW_ASK, ASKED_AND_ANSWERED, CAPTURE_QUERY, READ_DOC, EMAIL
+
+QUERY = 'how do I create a bucket'
+WELCOME = 'Welcome to Doc Support. What can I help you with?'
+BEEP = '<audio src="soundbank://soundlibrary/musical/amzn_sfx_electronic_beep_03"/>'
+
+
+def sample_sessions(candidates):
+    """Return a few points of a conversation as ``(label, original session attributes, compact state)``.
+
+    The original attributes are the ones the first version of the skill kept, and the compact state
+    is what the skill keeps at the same point now.
+    """
+    items = [make_result_item(QUERY, rank) for rank in range(candidates)]
+    document = items[1]
+    title = document['DocumentTitle']['Text']
+    excerpt = document['DocumentExcerpt']['Text']
+    launched = {'LastQuery': 'no previous query', 'QueryStatus': 'none asked', 'QueryCount': 0, 'LastOutput': WELCOME}
+    offered = dict(launched, LastQuery=QUERY, QueryStatus='new ask', QueryResult=title, LastDocText=excerpt,
+                   LastSourceURI=document['DocumentURI'], LastHandler='capture query',
+                   LastOutput="I found a document titled " + title + ". Is this what you were looking for? "
+                              "If you're not sure, you can say 'read me an excerpt'.")
+    read = dict(offered, LastHandler='read doc', LastOutput=('Here is an excerpt from the document:' + BEEP + excerpt +
+                                                            '.' + BEEP + 'Is this what you were looking for?'))
+    emailed = dict(read, QueryStatus='asked and answered', LastHandler='email',
+                   LastOutput="Ok. I'm sending you an email with the documentation about your query, " + QUERY +
+                              ". Would you like to ask something else?")
+
+    compact_launched = DialogState()
+    compact_launched.last_output = WELCOME
+    compact_offered = DialogState.decode(compact_launched.encode())
+    compact_offered.status = NEW_ASK
+    compact_offered.last_handler = CAPTURE_QUERY
+    compact_offered.last_query = QUERY
+    compact_offered.candidates = [item['Id'] for item in items]
+    compact_offered.result_id = compact_offered.last_doc_id = document['Id']
+    compact_offered.result_key = compact_offered.last_doc_key = 3994994627
+    compact_offered.last_output = None
+    compact_read = DialogState.decode(compact_offered.encode())
+    compact_read.last_handler = READ_DOC
+    compact_read.read_offset = 0
+    compact_read.read_passages = False
+    compact_emailed = DialogState.decode(compact_read.encode())
+    compact_emailed.status = ASKED_AND_ANSWERED
+    compact_emailed.last_handler = EMAIL
+    compact_emailed.last_output = emailed['LastOutput']
+    return [('launched', launched, compact_launched), ('offered', offered, compact_offered),
+            ('read', read, compact_read), ('emailed', emailed, compact_emailed)]
+
+
+def legacy_round_trip(payload):
+    # The original handlers read and wrote a few attributes in place.
+    session_attr = json.loads(payload)
+    session_attr['LastOutput'] = session_attr['LastOutput']
+    return json.dumps(session_attr)
+
+
+def compact_round_trip(payload):
+    session_attr = json.loads(payload)
+    DialogState.load(session_attr).save(session_attr)
+    return json.dumps(session_attr)
+
+
+def measure(fn, payload, number):
+    return min(timeit.repeat(lambda: fn(payload), number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the size and cost of the Module 5 session state formats.')
+    parser.add_argument('--candidates', type=int, default=5, help='Kendra results kept for the last query')
+    parser.add_argument('--number', type=int, default=20000, help='round trips per timing run')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    print('%-10s %12s %12s %10s %12s %12s' % ('session', 'legacy B', 'compact B', 'saved', 'legacy us', 'compact us'))
+    for label, session_attr, state in sample_sessions(args.candidates):
+        legacy = json.dumps(session_attr)
+        compact = json.dumps({'S': state.encode()})
+        # The compact state has to read back as the same state, and a migrated session keeps no original attributes.
+        assert DialogState.load(json.loads(compact)).encode() == state.encode()
+        migrated = json.loads(legacy)
+        DialogState.load(migrated)
+        assert list(migrated) == ['S'], migrated
+        legacy_us = measure(legacy_round_trip, legacy, args.number)
+        compact_us = measure(compact_round_trip, compact, args.number)
+        results[label] = {'legacy_bytes': len(legacy), 'compact_bytes': len(compact),
+                          'legacy_us': legacy_us, 'compact_us': compact_us}
+        print('%-10s %12d %12d %9.0f%% %12.2f %12.2f' % (label, len(legacy), len(compact),
+                                                       100.0 * (1 - float(len(compact)) / len(legacy)), legacy_us, compact_us))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# Load generator for whole conversations with the Module 5 skill.
+# Simulates many concurrent users, each following a dialog path such as
+# Launch -> CaptureQuery -> No -> No -> Yes -> SendEmail, and carries the session attributes from
+# one turn to the next like Alexa does. AWS services are replaced by the stand-ins in aws_stubs.py.
+#
+# Run from the repository root:
+#   python benchmarks/load_dialogs.py --sessions 2000 --concurrency 200 --latency kendra=120,sts=40,sns=30
+#   python benchmarks/load_dialogs.py --mix answered=1,email=1 --think-ms 500
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aws_stubs import AwsStubs, FakeLambdaContext, installed
+from bench_handlers import ERROR_SPEECH, load_module, make_envelope, parse_latencies, percentile, speech
+
+TURNS = {
+    'launch': ('LaunchRequest', None, None),
+    'query': ('IntentRequest', 'CaptureQueryIntent', {'query': '{query}'}),
+    'yes': ('IntentRequest', 'AMAZON.YesIntent', None),
+    'no': ('IntentRequest', 'AMAZON.NoIntent', None),
+    'readdoc': ('IntentRequest', 'ReadDocIntent', None),
+    'continue': ('IntentRequest', 'ContinueReadingIntent', None),
+    'email': ('IntentRequest', 'SendEmailIntent', None),
+    'repeat': ('IntentRequest', 'AMAZON.RepeatIntent', None),
+    'help': ('IntentRequest', 'AMAZON.HelpIntent', None),
+    'fallback': ('IntentRequest', 'AMAZON.FallbackIntent', None),
+    'stop': ('IntentRequest', 'AMAZON.StopIntent', None),
+    'end': ('SessionEndedRequest', None, None),
+}
+
+# The dialog paths users follow, as turn names.
+PATHS = {
+    'answered': ['launch', 'query', 'yes', 'stop'],
+    'second_answer': ['launch', 'query', 'no', 'yes', 'stop'],
+    'email': ['launch', 'query', 'no', 'no', 'yes', 'email', 'no'],
+    'email_then_ask': ['launch', 'query', 'email', 'yes', 'query', 'yes', 'stop'],
+    'read_doc': ['launch', 'query', 'no', 'readdoc', 'continue', 'repeat', 'yes', 'email', 'no'],
+    'help_first': ['launch', 'help', 'query', 'repeat', 'yes', 'stop'],
+    'abandoned': ['launch', 'query', 'end'],
+    # Users don't always follow the happy path.
+    'out_of_order': ['launch', 'readdoc', 'fallback', 'yes', 'query', 'yes', 'stop'],
+}
+DEFAULT_MIX = 'answered=4,second_answer=2,email=2,email_then_ask=1,read_doc=1,help_first=1,abandoned=1,out_of_order=1'
+
+
+class ErrorCollector(logging.Handler):
+    """Collects the exceptions the skill logs from its CatchAllExceptionHandler, per thread."""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.local = threading.local()
+
+    def emit(self, record):
+        if record.exc_info and record.exc_info[1] is not None:
+            exception = record.exc_info[1]
+            self.local.exception = '%s: %s' % (type(exception).__name__, exception)
+
+    def take(self):
+        exception = getattr(self.local, 'exception', None)
+        self.local.exception = None
+        return exception
+
+
+def parse_mix(value):
+    """Parse ``answered=4,email=1`` into a list of (path name, weight)."""
+    mix = []
+    for part in filter(None, value.split(',')):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in PATHS:
+            raise SystemExit('Unknown dialog path %r, expected one of %s' % (name, ', '.join(sorted(PATHS))))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def run_session(module, errors, session_number, path_name, query, think_ms):
+    """Run one conversation and return its timings and any state-machine errors."""
+    user_id = 'amzn1.ask.account.LOAD%07d' % session_number
+    session_id = 'amzn1.echo-api.session.LOAD%07d' % session_number
+    attributes = {}
+    turns = []
+    problems = []
+    path = PATHS[path_name]
+    for position, turn_name in enumerate(path):
+        if position and think_ms:
+            time.sleep(think_ms / 1000.0)
+        request_type, intent_name, slots = TURNS[turn_name]
+        if slots:
+            slots = dict((name, value.replace('{query}', query)) for name, value in slots.items())
+        envelope = make_envelope(request_type, intent_name, slots, attributes, new=position == 0, user_id=user_id)
+        envelope['session']['sessionId'] = session_id
+
+        errors.take()
+        started = time.perf_counter()
+        try:
+            response = module.lambda_handler(envelope, FakeLambdaContext())
+        except Exception as exception:
+            response = None
+            errors.local.exception = '%s: %s' % (type(exception).__name__, exception)
+        turns.append((turn_name, (time.perf_counter() - started) * 1000.0))
+
+        exception = errors.take()
+        if exception is not None or response is None or ERROR_SPEECH in speech(response):
+            problems.append((turn_name, exception or 'error response'))
+        elif request_type != 'SessionEndedRequest' and not (response.get('response') or {}).get('outputSpeech'):
+            problems.append((turn_name, 'no output speech'))
+        if response is None:
+            break
+
+        attributes = response.get('sessionAttributes') or {}
+        if (response.get('response') or {}).get('shouldEndSession') and position < len(path) - 1:
+            problems.append((turn_name, 'session ended before the %s turn' % path[position + 1]))
+            break
+    return {'path': path_name, 'turns': turns, 'problems': problems}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run concurrent multi-turn conversations against the Module 5 skill.')
+    parser.add_argument('--sessions', type=int, default=2000, help='conversations to run')
+    parser.add_argument('--concurrency', type=int, default=100, help='conversations in progress at once')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='dialog paths and their weights, from: ' + ', '.join(sorted(PATHS)))
+    parser.add_argument('--queries', type=int, default=200, help='distinct questions, asked with a skew towards popular ones')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='pause between the turns of a conversation')
+    parser.add_argument('--latency', help='milliseconds per call by service, for example kendra=120,sts=40,sns=30,ups=20')
+    parser.add_argument('--jitter', type=float, default=0.2, help='latency jitter, as a fraction of the mean')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    questions = ['how do I configure feature %d' % rank for rank in range(args.queries)]
+    # Popular questions are asked much more often, like in a real skill.
+    question_weights = [1.0 / (rank + 1) for rank in range(args.queries)]
+    plan = [(number,
+             rng.choices([name for name, _ in mix], [weight for _, weight in mix])[0],
+             rng.choices(questions, question_weights)[0])
+            for number in range(args.sessions)]
+
+    # Keep the skill's own logging out of the output and the timings, apart from the errors collected below.
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.CRITICAL)
+    errors = ErrorCollector()
+
+    stubs = AwsStubs(parse_latencies(args.latency), jitter=args.jitter, seed=args.seed)
+    with installed(stubs):
+        module = load_module(5, tempfile.mkdtemp(prefix='doc_support_load_'))
+        skill_logger = logging.getLogger(module.__name__)
+        skill_logger.setLevel(logging.ERROR)
+        skill_logger.propagate = False
+        skill_logger.addHandler(errors)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            sessions = list(executor.map(
+                lambda session: run_session(module, errors, session[0], session[1], session[2], args.think_ms), plan))
+        elapsed = time.perf_counter() - started
+
+    turn_count = sum(len(session['turns']) for session in sessions)
+    session_ms = sorted(sum(ms for _, ms in session['turns']) for session in sessions)
+    by_path = defaultdict(list)
+    by_turn = defaultdict(list)
+    problems = Counter()
+    failed_sessions = Counter()
+    for session in sessions:
+        by_path[session['path']].append(sum(ms for _, ms in session['turns']))
+        for turn_name, ms in session['turns']:
+            by_turn[turn_name].append(ms)
+        for turn_name, problem in session['problems']:
+            problems[(session['path'], turn_name, problem)] += 1
+        if session['problems']:
+            failed_sessions[session['path']] += 1
+
+    print('%d sessions, %d turns in %.2f s: %.1f turns/s, %.1f sessions/s, concurrency %d' % (
+        len(sessions), turn_count, elapsed, turn_count / elapsed, len(sessions) / elapsed, args.concurrency))
+    print('Session handler time: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (
+        percentile(session_ms, 0.50), percentile(session_ms, 0.95), percentile(session_ms, 0.99)))
+
+    print('\n%-16s %8s %9s %9s %9s %8s' % ('path', 'sessions', 'p50 ms', 'p95 ms', 'p99 ms', 'failed'))
+    for path_name, values in sorted(by_path.items()):
+        values.sort()
+        print('%-16s %8d %9.2f %9.2f %9.2f %8d' % (path_name, len(values), percentile(values, 0.50),
+                                                  percentile(values, 0.95), percentile(values, 0.99), failed_sessions[path_name]))
+
+    print('\n%-16s %8s %9s %9s %9s' % ('turn', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for turn_name, values in sorted(by_turn.items()):
+        values.sort()
+        print('%-16s %8d %9.2f %9.2f %9.2f' % (turn_name, len(values), percentile(values, 0.50),
+                                              percentile(values, 0.95), percentile(values, 0.99)))
+
+    print('\nAWS calls: ' + ', '.join('%s %d' % item for item in sorted(stubs.calls().items())))
+    if problems:
+        print('\nState-machine errors:')
+        for (path_name, turn_name, problem), count in problems.most_common():
+            print('  %6d  %s at %s: %s' % (count, path_name, turn_name, problem))
+    else:
+        print('\nNo state-machine errors.')
+
+    if args.json:
+        report = {
+            'settings': vars(args),
+            'elapsed_s': elapsed,
+            'turns_per_s': turn_count / elapsed,
+            'sessions_per_s': len(sessions) / elapsed,
+            'session_ms': {'p50': percentile(session_ms, 0.50), 'p95': percentile(session_ms, 0.95), 'p99': percentile(session_ms, 0.99)},
+            'paths': dict((name, {'sessions': len(values), 'failed': failed_sessions[name],
+                                  'p50_ms': percentile(values, 0.50), 'p95_ms': percentile(values, 0.95)})
+                          for name, values in by_path.items()),
+            'turns': dict((name, {'count': len(values), 'p50_ms': percentile(values, 0.50), 'p95_ms': percentile(values, 0.95)})
+                          for name, values in by_turn.items()),
+            'aws_calls': stubs.calls(),
+            'errors': [{'path': path_name, 'turn': turn_name, 'error': problem, 'count': count}
+                       for (path_name, turn_name, problem), count in problems.most_common()],
+        }
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Reports what importing a skill's Lambda module costs, module by module, so startup regressions are caught.
+# Each run imports the module in a fresh interpreter with ``python -X importtime`` and the report shows
+# the median over the runs. A module's cumulative time includes the modules it imported first.
+#
+# Run from the repository root:
+#   python benchmarks/profile_imports.py
+#   python benchmarks/profile_imports.py --packages --forbid boto3,botocore,requests
+#   python benchmarks/profile_imports.py --save-baseline imports.json
+#   python benchmarks/profile_imports.py --compare imports.json --threshold 0.2
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def profile(module, directory, python=sys.executable):
+    """Import ``module`` from ``directory`` in a fresh interpreter and return its imports in order.
+
+    Each import is a dict with the module ``name``, its ``depth`` in the import tree, and its
+    ``self_ms`` and ``cumulative_ms``. Modules the interpreter imported before ``module`` are left out.
+    """
+    process = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module], cwd=directory,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('Importing %s failed:\n%s' % (module, process.stderr[-2000:]))
+    imports = []
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            imports.append({'name': match.group(4), 'depth': len(match.group(3)) // 2,
+                            'self_ms': int(match.group(1)) / 1000.0, 'cumulative_ms': int(match.group(2)) / 1000.0})
+    # -X importtime lists a module after the modules it imported, so everything the target pulled in
+    # comes after the last top-level module that the interpreter imported on its own.
+    end = max(index for index, entry in enumerate(imports) if entry['name'] == module)
+    start = max([index for index, entry in enumerate(imports[:end]) if entry['depth'] == 0] or [-1]) + 1
+    return imports[start:end + 1]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(runs):
+    """Return the median self and cumulative milliseconds of each module over the runs, its depth, and in how many runs it was imported."""
+    samples = defaultdict(list)
+    for imports in runs:
+        for entry in imports:
+            samples[entry['name']].append(entry)
+    modules = {}
+    for name, entries in samples.items():
+        modules[name] = {'self_ms': median([entry['self_ms'] for entry in entries]),
+                         'cumulative_ms': median([entry['cumulative_ms'] for entry in entries]),
+                         'depth': min(entry['depth'] for entry in entries), 'runs': len(entries)}
+    return modules
+
+
+def by_package(modules):
+    """Return the self milliseconds and module count of each top-level package."""
+    packages = defaultdict(lambda: {'self_ms': 0.0, 'modules': 0})
+    for name, module in modules.items():
+        package = packages[name.split('.')[0]]
+        package['self_ms'] += module['self_ms']
+        package['modules'] += 1
+    return dict(packages)
+
+
+def compare(packages, total_ms, baseline, threshold, min_ms):
+    """Return the lines describing what got slower than the baseline by more than ``threshold``.
+
+    Packages are compared by their self time, because a module's cumulative time moves to another
+    module whenever that one happens to import a shared dependency first.
+    """
+    regressions = []
+    before_total = baseline.get('total_ms')
+    if before_total and (total_ms - before_total) / before_total > threshold:
+        regressions.append('%-40s %.1f -> %.1f ms (%+.0f%%)' % (
+            'total', before_total, total_ms, (total_ms - before_total) / before_total * 100))
+    before_packages = baseline.get('packages', {})
+    for name, package in sorted(packages.items(), key=lambda item: -item[1]['self_ms']):
+        before = before_packages.get(name)
+        if before is None:
+            if package['self_ms'] >= min_ms:
+                regressions.append('%-40s new import, %.1f ms' % (name, package['self_ms']))
+            continue
+        change = package['self_ms'] - before['self_ms']
+        if change >= min_ms and change / max(before['self_ms'], 0.001) > threshold:
+            regressions.append('%-40s %.1f -> %.1f ms (%+.0f%%)' % (
+                name, before['self_ms'], package['self_ms'], change / before['self_ms'] * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the import time of a skill module, module by module.')
+    parser.add_argument('--module', default='lambda_function_module_5', help='module to import')
+    parser.add_argument('--directory', default=os.path.join(ROOT, 'Module-5'), help='folder the module is imported from')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to take the median of')
+    parser.add_argument('--top', type=int, default=30, help='modules to list, by cumulative time')
+    parser.add_argument('--packages', action='store_true', help='also list the self time of each top-level package')
+    parser.add_argument('--forbid', help='comma separated modules that must not be imported, for example boto3,requests')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--save-baseline', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare with this baseline file and exit with status 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown over the baseline, as a fraction')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='smallest slowdown of one package that counts as a regression')
+    args = parser.parse_args()
+
+    runs = [profile(args.module, args.directory) for _ in range(args.runs)]
+    modules = summarize(runs)
+    total_ms = modules[args.module]['cumulative_ms']
+
+    print('Importing %s took %.1f ms (median of %d runs) and imported %d modules.\n' % (
+        args.module, total_ms, args.runs, len(modules)))
+    print('%-48s %10s %10s %7s' % ('module', 'self ms', 'cum ms', 'share'))
+    for name, module in sorted(modules.items(), key=lambda item: -item[1]['cumulative_ms'])[:args.top]:
+        print('%-48s %10.1f %10.1f %6.1f%%' % (('  ' * module['depth'] + name)[:48], module['self_ms'], module['cumulative_ms'],
+                                              module['cumulative_ms'] / total_ms * 100 if total_ms else 0.0))
+
+    packages = by_package(modules)
+    if args.packages:
+        print('\n%-48s %10s %10s %7s' % ('package', 'self ms', 'modules', 'share'))
+        for name, package in sorted(packages.items(), key=lambda item: -item[1]['self_ms'])[:args.top]:
+            print('%-48s %10.1f %10d %6.1f%%' % (name, package['self_ms'], package['modules'],
+                                                package['self_ms'] / total_ms * 100 if total_ms else 0.0))
+
+    report = {'module': args.module, 'python': sys.version.split()[0], 'runs': args.runs, 'total_ms': total_ms,
+              'modules': modules, 'packages': packages}
+    for path in filter(None, (args.json, args.save_baseline)):
+        with open(path, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    failed = False
+    forbidden = [name for name in (args.forbid or '').split(',') if name and name in modules]
+    if forbidden:
+        print('\nImported at startup, but expected to load lazily: %s' % ', '.join(forbidden))
+        failed = True
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(packages, total_ms, baseline, args.threshold, args.min_ms)
+        if regressions:
+            print('\nImport time regressions over %.0f%%:' % (args.threshold * 100))
+            for line in regressions:
+                print('  ' + line)
+            failed = True
+        else:
+            print('\nNo import time regressions over %.0f%%.' % (args.threshold * 100))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()